@@ -16,7 +16,7 @@ from setuptools_scm import get_version  # noqa: E402
 INSTALL_REQUIRES = ['future;python_version<"3.2"']
 DEPENDENCY_LINKS = []
 SETUP_REQUIRES = ['pytest-runner','setuptools_scm']
-TESTS_REQUIRE = ['pytest', 'pytest-logging', 'psutil', 'virtualenv;python_version<"3.2"']
+TESTS_REQUIRE = ['pytest', 'pytest-logging', 'psutil', 'virtualenv;python_version<"3.2"', 'mock;python_version<"3.3"']
 EXTRAS_REQUIRE = {}
 
 # ************** ID card *****************
@@ -137,11 +137,11 @@ setup(
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
     # pip to create the appropriate form of executable for the target platform.
-    # entry_points={
-    #     'console_scripts': [
-    #         'sample=sample:main',
-    #     ],
-    # },
+    entry_points={
+        'console_scripts': [
+            'spawny-server=spawny.main_server:main',
+        ],
+    },
 
     # explicitly setting the flag to avoid `ply` being downloaded
     # see https://github.com/smarie/python-getversion/pull/5
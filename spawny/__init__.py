@@ -1,6 +1,16 @@
 from spawny.main_remotes_and_defs import ScriptDefinition, InstanceDefinition, ModuleDefinition
-from spawny.main import ObjectProxy, DaemonProxy, run_script, run_module, run_object, DaemonCouldNotSendMsgError, \
+from spawny.main import ObjectProxy, DaemonProxy, ForkedDaemonProxy, run_script, run_module, run_object, thread_safe, \
+    terminate_all, DaemonCouldNotSendMsgError, DaemonTimeoutError, DaemonRestartedError, DaemonDiedError, \
     UnknownException
+from spawny.main_pool import DaemonPool, PoolObjectProxy, WarmSpares
+from spawny.main_server import DaemonServer, ConnectedDaemonProxy, DaemonConnectionPool
+from spawny.main_supervisor import SupervisedDaemonProxy
+
+try:  # python 3.4+
+    from spawny.main_async import AsyncDaemonProxy, AsyncObjectProxy
+    _async_symbols = ['AsyncDaemonProxy', 'AsyncObjectProxy']
+except ImportError:
+    _async_symbols = []
 
 try:
     # -- Distribution mode: import from _version.py generated by setuptools_scm during release
@@ -20,6 +30,10 @@ __all__ = [
     'main',
     # symbols
     'run_script', 'run_module', 'run_object',
-    'ObjectProxy', 'DaemonProxy', 'InstanceDefinition', 'ScriptDefinition', 'ModuleDefinition',
-    'DaemonCouldNotSendMsgError', 'UnknownException'
-]
+    'ObjectProxy', 'DaemonProxy', 'ForkedDaemonProxy', 'InstanceDefinition', 'ScriptDefinition', 'ModuleDefinition',
+    'thread_safe', 'terminate_all', 'DaemonCouldNotSendMsgError', 'DaemonTimeoutError', 'DaemonRestartedError',
+    'DaemonDiedError', 'UnknownException',
+    'DaemonPool', 'PoolObjectProxy', 'WarmSpares',
+    'DaemonServer', 'ConnectedDaemonProxy', 'DaemonConnectionPool',
+    'SupervisedDaemonProxy'
+] + _async_symbols
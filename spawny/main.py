@@ -1,15 +1,47 @@
+import errno
 import multiprocessing as mp
+import operator
 import os
-from logging import Logger
+import signal
+import stat
+from collections import deque
+from contextlib import contextmanager
+from itertools import count, islice
+from threading import Condition, Lock, RLock, Thread, local
+from logging import Logger, DEBUG
 
 import sys
-from pickle import PicklingError
-from types import FunctionType
+from pickle import PicklingError, dumps
+from types import FunctionType, BuiltinFunctionType, GeneratorType, MemberDescriptorType
+from weakref import ref
 
-from six import with_metaclass, raise_from
+from six import with_metaclass, raise_from, string_types
+from six.moves import builtins
+from six.moves.queue import Queue
+
+try:  # python 3.3+
+    from collections.abc import Iterator
+except ImportError:
+    from collections import Iterator
+
+try:  # python 3.3+
+    from multiprocessing.connection import wait as _wait
+except ImportError:
+    _wait = None
+
+try:  # python 3.3+
+    from time import monotonic as _now
+except ImportError:
+    from time import time as _now
+
+try:  # python 3.3+
+    TimeoutError = TimeoutError
+except NameError:
+    class TimeoutError(OSError):
+        pass
 
 try: # python 3.5+
-    from typing import Union, Any, List, Dict, Tuple, Type, Iterable, Callable
+    from typing import Union, Any, List, Dict, Tuple, Type, Iterable, Callable, Set, Optional
 except SyntaxError:
     # strange error on some python 3.7 distributions ?!!
     pass
@@ -17,8 +49,12 @@ except ImportError:
     pass
 
 from spawny.main_remotes_and_defs import InstanceDefinition, ScriptDefinition, ModuleDefinition, Definition
+from spawny.utils_attr_cache import AttrMetadataCache, CACHE_NEVER
 from spawny.utils_logging import default_logger
-from spawny.utils_object_proxy import ProxifyDunderMeta, replace_all_dundermethods_with_getattr
+from spawny.utils_object_proxy import ProxifyDunderMeta, replace_all_dundermethods_with_getattr, TypeDescriptor
+from spawny.utils_compression import Compressor
+from spawny.utils_serializers import Serializer
+from spawny.utils_transport import Transport, DEFAULT_COMPRESSION_THRESHOLD
 
 
 PY2 = sys.version_info < (3, 0)
@@ -32,9 +68,10 @@ PY2 = sys.version_info < (3, 0)
 #     mp.set_start_method('spawn')
 
 
-def run_script(script_str,            # type: str
-               python_exe=None,       # type: str
-               logger=default_logger  # type: Logger
+def run_script(script_str,             # type: str
+               python_exe=None,        # type: str
+               logger=default_logger,  # type: Logger
+               serializer=None         # type: Union[str, Serializer]
                ):
     # type: (...) -> ObjectProxy
     """
@@ -46,16 +83,19 @@ def run_script(script_str,            # type: str
     :param script_str:
     :param python_exe:
     :param logger:
+    :param serializer: see `DaemonProxy`
     :return:
     """
-    d = DaemonProxy(ScriptDefinition(script_str), python_exe=python_exe, logger=logger)
+    d = DaemonProxy(ScriptDefinition(script_str), python_exe=python_exe, logger=logger, serializer=serializer)
     return d.obj_proxy
 
 
-def run_module(module_name,           # type: str
-               module_path=None,      # type: str
-               python_exe=None,       # type: str
-               logger=default_logger  # type: Logger
+def run_module(module_name,            # type: str
+               module_path=None,       # type: str
+               python_exe=None,        # type: str
+               logger=default_logger,  # type: Logger
+               serializer=None,        # type: Union[str, Serializer]
+               remote_type=False       # type: bool
                ):
     # type: (...) -> ObjectProxy
     """
@@ -68,19 +108,25 @@ def run_module(module_name,           # type: str
     :param module_path:
     :param python_exe:
     :param logger:
+    :param serializer: see `DaemonProxy`
+    :param remote_type: see `DaemonProxy`
     :return:
     """
-    d = DaemonProxy(ModuleDefinition(module_name, module_path=module_path), python_exe=python_exe, logger=logger)
+    d = DaemonProxy(ModuleDefinition(module_name, module_path=module_path), python_exe=python_exe, logger=logger,
+                    serializer=serializer, remote_type=remote_type)
     return d.obj_proxy
 
 
 def run_object(
                object_instance_or_definition,  # type: Union[Any, Definition]
                python_exe=None,                # type: str
-               logger=default_logger           # type: Logger
+               logger=default_logger,          # type: Logger
+               serializer=None,                # type: Union[str, Serializer]
+               remote_type=False               # type: bool
                ):
     # type: (...) -> ObjectProxy
-    d = DaemonProxy(object_instance_or_definition, python_exe=python_exe, logger=logger)
+    d = DaemonProxy(object_instance_or_definition, python_exe=python_exe, logger=logger, serializer=serializer,
+                    remote_type=remote_type)
     return d.obj_proxy
 
 
@@ -90,10 +136,50 @@ ERR_FLAG = False
 START_CMD = -1
 EXIT_CMD = 0
 EXEC_CMD = 1  # this will send a function to execute
+FORK_CMD = 2  # this will fork the daemon, the child serving the connection sent with the command
+RELEASE_CMD = 3  # this will release the handles sent with the command. The daemon does not respond to it
+
+# every command is sent with a request id, and the daemon sends it back in the corresponding response.
+# The response to the daemon start has the following id. Commands ids start at 1.
+START_REQ_ID = 0
+
+# what to do with a daemon when a call times out, see `DaemonProxy`
+TIMEOUT_RAISE = 'raise'
+TIMEOUT_RESTART = 'restart'
+
+# the default time given to daemons to exit after being asked to, before they are terminated with signals
+DEFAULT_TERMINATION_GRACE = 5.0
+
+# the default maximum size of the requests sent to a daemon and not answered yet, see `DaemonProxy._make_room`. It
+# should not exceed the capacity of the pipe: unix sockets hold about 200kB on linux, but only 8kB on other platforms
+# (and windows named pipes too)
+MAX_UNANSWERED_BYTES = 65536 if sys.platform.startswith('linux') else 8192
 
 
 # --------- all the functions that will be pickled so as to be remotely executed
 
+_handles = dict()
+"""The objects kept in the daemon process on behalf of the client, by handle id. See `RemoteHandle`"""
+
+_handle_ids = count(1)
+
+_daemon_impl = None
+"""The object served by the daemon in this process, against which the references received are resolved"""
+
+_remote_types = False
+"""If True, the types sent to the client are described with a `TypeDescriptor` (except builtin types), so that the
+client does not import their module. See `remote_type` in `DaemonProxy`"""
+
+_receiving = local()
+"""The state of the message being received by the current thread: `reference_errors`, the errors raised when resolving
+the references it contains (see `resolve_reference`). Thread-local since a `DaemonServer` receives messages from several
+connections concurrently"""
+
+_handle_owner = local()
+"""In a `DaemonServer`, `handle_ids` is the set of the handles created for the connection served by the current thread,
+released when it is closed"""
+
+
 def get_object(o,
                names
                ):
@@ -101,11 +187,20 @@ def get_object(o,
     Command used to get the object o.name1.name2.name3 where name1, name2, name3 are provided in `names`
     It is located here so that it can be pickled and sent over the wire
 
+    If the first element of `names` is a handle id instead of a name (see `RemoteHandle`), the path starts from the
+    object kept with this handle instead of `o`.
+
     :param o:
     :param names:
     :return:
     """
     result = o
+    if len(names) > 0 and not isinstance(names[0], string_types):
+        try:
+            result = _handles[names[0]]
+        except KeyError:
+            raise ValueError("Unknown handle: %s. It may have been released already" % names[0])
+        names = names[1:]
     for n in names:
         result = getattr(result, n)
     return result
@@ -113,7 +208,10 @@ def get_object(o,
 
 def is_function(o,
                 names):
-    o = get_object(o, names)
+    return is_function_object(get_object(o, names))
+
+
+def is_function_object(o):
     if isinstance(o, FunctionType):
         return True
     elif hasattr(o, 'im_self'):
@@ -124,6 +222,83 @@ def is_function(o,
         return False
 
 
+def resolve_attribute(o,
+                      names,
+                      with_value=False
+                      ):
+    """
+    Command used to resolve the object o.name1.name2.name3 in a single round trip. It returns a tuple
+    `(is_func, typ, has_value, value)` where
+
+     - `is_func` indicates if the object is a function (see `is_function`). In that case all other items are empty.
+     - `typ` is the object's type, or a `TypeDescriptor` if the type can not be pickled or if the daemon was started
+       with `remote_type` (see `get_sendable_type`)
+     - `has_value` and `value` contain the object itself if `with_value` is True and its type can be pickled. The value
+       is not serialized here to check that it can be sent: if sending the response fails, the client receives a
+       `DaemonCouldNotSendMsgError` and asks again without the value, so as to create (and cache the metadata of) a
+       proxy for it.
+
+    :param o:
+    :param names:
+    :param with_value:
+    :return:
+    """
+    obj = get_object(o, names)
+    if is_function_object(obj):
+        return True, None, False, None
+
+    typ = get_sendable_type(obj)
+    if isinstance(typ, TypeDescriptor):
+        # the type is not importable: the object can not be pickled either
+        return False, typ, False, None
+
+    if with_value:
+        return False, typ, True, obj
+    else:
+        return False, typ, False, None
+
+
+def resolve_reference(names):
+    """
+    Returns the object at attribute path `names` in the daemon. An `ObjectProxy` sent to its daemon is unpickled with
+    this function, so that the remote object is used instead of a copy of it.
+
+    Since errors can not be raised while the message is being unpickled, they are stored in
+    `_receiving.reference_errors` and raised by the daemon before executing the command.
+
+    :param names:
+    :return:
+    """
+    try:
+        return get_object(_daemon_impl, names)
+    except Exception as e:
+        try:
+            _receiving.reference_errors.append(e)
+        except AttributeError:
+            _receiving.reference_errors = [e]
+        return None
+
+
+def get_sendable_type(obj):
+    """
+    Returns the type of `obj`, or a `TypeDescriptor` describing it if it can not be pickled. If the daemon was started
+    with `remote_type`, all types except the builtin ones are described, so that the client does not import their
+    module when unpickling them.
+
+    :param obj:
+    :return:
+    """
+    typ = obj.__class__
+    if _remote_types and getattr(typ, '__module__', None) != builtins.__name__:
+        return TypeDescriptor.create_from(typ)
+    try:
+        # this is cheap since types are pickled by reference
+        dumps(typ)
+    except Exception:
+        return TypeDescriptor.create_from(typ)
+    return typ
+
+
 def call_method_on_object(o,
                           *args,
                           # names,
@@ -132,6 +307,105 @@ def call_method_on_object(o,
     return get_object(o, names)(*args, **kwargs)
 
 
+def call_method_by_ref(o,
+                       *args,
+                       # names,
+                       **kwargs):
+    """
+    Command used to call method o.name1.name2.name3 and keep its result in the daemon instead of sending it back. It
+    returns a tuple `(handle_id, typ)` where `typ` is the type of the result, or a `TypeDescriptor` (see
+    `get_sendable_type`).
+
+    :param o:
+    :param args:
+    :param kwargs:
+    :return:
+    """
+    names = kwargs.pop('names')
+    result = get_object(o, names)(*args, **kwargs)
+    return store_handle(result), get_sendable_type(result)
+
+
+def call_method_or_iterate(o,
+                           *args,
+                           # names,
+                           **kwargs):
+    """
+    Command used to call method o.name1.name2.name3, like `call_method_on_object`. If the result is an iterator (for
+    example a generator), it is kept in the daemon instead of being sent back, so that it can be consumed by chunks
+    with `next_chunk`. Returns a tuple `(is_iterator, result_or_handle_id)`.
+
+    :param o:
+    :param args:
+    :param kwargs:
+    :return:
+    """
+    names = kwargs.pop('names')
+    result = get_object(o, names)(*args, **kwargs)
+    if isinstance(result, (GeneratorType, Iterator)):
+        return True, store_handle(result)
+    else:
+        return False, result
+
+
+def next_chunk(o,
+               names,     # type: List[Any]
+               chunksize  # type: int
+               ):
+    """
+    Command used to get the next `chunksize` items of iterator o.name1.name2.name3. Returns a tuple
+    `(items, done, error)` where `done` is True if the iterator is exhausted or raised `error`. In that case `items`
+    contains the items obtained before.
+
+    :param o:
+    :param names:
+    :param chunksize:
+    :return:
+    """
+    it = get_object(o, names)
+    items = []
+    try:
+        for _ in range(chunksize):
+            items.append(next(it))
+    except StopIteration:
+        return items, True, None
+    except Exception as e:
+        return items, True, e
+    return items, False, None
+
+
+def store_handle(obj):
+    # type: (...) -> int
+    """
+    Keeps `obj` in the table of handles of the daemon, and returns its handle id. See `RemoteHandle`.
+
+    :param obj:
+    :return:
+    """
+    handle_id = next(_handle_ids)
+    _handles[handle_id] = obj
+    owned = getattr(_handle_owner, 'handle_ids', None)
+    if owned is not None:
+        owned.add(handle_id)
+    return handle_id
+
+
+def call_method_on_chunk(o,
+                         chunk,  # type: List[Any]
+                         names   # type: List[str]
+                         ):
+    """
+    Command used to apply method o.name1.name2.name3 on all elements of `chunk`, and return the list of results.
+
+    :param o:
+    :param chunk:
+    :param names:
+    :return:
+    """
+    method = get_object(o, names)
+    return [method(item) for item in chunk]
+
+
 def call_method_using_cmp_py2(o,
                               *args,
                               # names,
@@ -167,9 +441,342 @@ def call_method_using_cmp_py2(o,
     else:
         raise ValueError("invalid method: %s" % method_to_replace)
 
+
+def set_attribute(o,
+                  names,  # type: List[Any]
+                  value   # type: Any
+                  ):
+    """
+    Command used to set attribute o.name1.name2.name3 to `value`.
+
+    :param o:
+    :param names:
+    :param value:
+    :return:
+    """
+    setattr(get_object(o, names[0:-1]), names[-1], value)
+
+
+BATCH_GET = 0
+BATCH_CALL = 1
+BATCH_SET = 2
+
+
+def execute_batch(o,
+                  ops,                # type: List[Tuple[int, List[str], Tuple[Any], Dict[str, Any]]]
+                  stop_on_error=True  # type: bool
+                  ):
+    """
+    Command used to execute a list of operations recorded by a `RemoteBatch`, in sequence. Each operation is a tuple
+    `(kind, names, args, kwargs)` where kind is `BATCH_GET` (`get_object`), `BATCH_CALL` (`call_method_on_object`) or
+    `BATCH_SET` (`set_attribute`, with the value in `args`).
+
+    It returns the list of `(flag, result_or_error)` for all operations executed. If `stop_on_error` is True, the
+    execution stops at the first error, so the list may be shorter than `ops`.
+
+    :param o:
+    :param ops:
+    :param stop_on_error:
+    :return:
+    """
+    results = []
+    for kind, names, args, kwargs in ops:
+        try:
+            if kind == BATCH_GET:
+                res = get_object(o, names)
+            elif kind == BATCH_CALL:
+                res = get_object(o, names)(*args, **kwargs)
+            elif kind == BATCH_SET:
+                res = set_attribute(o, names, args[0])
+            else:
+                raise ValueError("invalid batch operation kind: %s" % kind)
+        except Exception as e:
+            results.append((ERR_FLAG, e))
+            if stop_on_error:
+                break
+        else:
+            results.append((OK_FLAG, res))
+    return results
+
+
+LAZY_GETATTR = 0
+LAZY_CALL = 1
+LAZY_GETITEM = 2
+LAZY_APPLY = 3
+
+
+def evaluate_expression(o,
+                        names,         # type: List[Any]
+                        ops,           # type: List[Tuple[Any, ...]]
+                        iterate=False  # type: bool
+                        ):
+    """
+    Command used to evaluate an expression recorded by a `LazyProxy`, starting from object o.name1.name2.name3. Each
+    operation is a tuple whose first element is its kind:
+
+     - `(LAZY_GETATTR, name)` gets an attribute,
+     - `(LAZY_CALL, args, kwargs)` calls the current object,
+     - `(LAZY_GETITEM, key)` gets an item,
+     - `(LAZY_APPLY, func, args)` applies `func(current, *args)`, for example `operator.eq` or `str`.
+
+    If `iterate` is True, an iterator on the result is kept in the daemon and its handle id is returned, so that it can
+    be consumed with `next_chunk`.
+
+    :param o:
+    :param names:
+    :param ops:
+    :param iterate:
+    :return:
+    """
+    result = get_object(o, names)
+    for op in ops:
+        kind = op[0]
+        if kind == LAZY_GETATTR:
+            result = getattr(result, op[1])
+        elif kind == LAZY_CALL:
+            result = result(*op[1], **op[2])
+        elif kind == LAZY_GETITEM:
+            result = result[op[1]]
+        elif kind == LAZY_APPLY:
+            result = op[1](result, *op[2])
+        else:
+            raise ValueError("invalid expression operation kind: %s" % kind)
+    if iterate:
+        return store_handle(iter(result))
+    return result
+
+
+COMMANDS = dict((f.__name__, f) for f in (get_object, is_function, resolve_attribute, call_method_on_object,
+                                          call_method_by_ref, call_method_or_iterate, next_chunk, call_method_on_chunk,
+                                          call_method_using_cmp_py2, set_attribute, execute_batch,
+                                          evaluate_expression))
+"""The functions above, by name. They are sent by name to the daemon, so that messages only contain builtin types
+whenever possible (see `spawny.utils_serializers.FallbackSerializer`)"""
+
 # ---------- end of picklable functions
 
 
+THREAD_SAFE_ATTR = '__spawny_thread_safe__'
+"""The attribute set by `thread_safe` on the functions and classes declared thread-safe"""
+
+_CALL_COMMANDS = (call_method_on_object, call_method_by_ref, call_method_or_iterate, call_method_on_chunk)
+"""The commands calling the method at path `names`, that may be executed concurrently if this method is thread-safe"""
+
+_READ_COMMANDS = (get_object, is_function, resolve_attribute)
+"""The commands only reading the attribute at path `names`, that may be executed concurrently if it is a plain attribute
+(see `is_plain_attribute_path`)"""
+
+_PLAIN_DESCRIPTOR_TYPES = (FunctionType, BuiltinFunctionType, type(str.join), type(object.__init__), staticmethod,
+                           classmethod, MemberDescriptorType)
+"""The descriptors that do not execute code of the object when read: methods and slots, see `is_plain_attribute_path`"""
+
+_MISSING = object()
+
+
+def thread_safe(f_or_cls):
+    """
+    Decorator declaring that a function, method, or all methods of a class, may be called concurrently from several
+    threads. In a daemon started with `threads` (or in a `DaemonServer`), the remote calls to them are executed
+    concurrently with each other, instead of one at a time. All functions of a module can be declared thread-safe by
+    setting `__spawny_thread_safe__ = True` at module level.
+
+    :param f_or_cls:
+    :return:
+    """
+    setattr(f_or_cls, THREAD_SAFE_ATTR, True)
+    return f_or_cls
+
+
+def is_thread_safe_call(o,
+                        to_execute,         # type: Union[str, Callable[[Any], Any]]
+                        to_execute_kwargs,  # type: Dict[str, Any]
+                        thread_safe=None    # type: Union[bool, Set[str]]
+                        ):
+    # type: (...) -> bool
+    """
+    Returns True if command `to_execute` calls a method declared thread-safe: either with the `thread_safe` decorator
+    (on the function or on the class of its object), or in `thread_safe`, the set of the thread-safe paths
+    (`'name1.name2'`) or True if all methods are thread-safe. The commands reading a plain attribute (for example
+    `resolve_attribute`, sent by `ObjectProxy` before each call) are thread-safe too. Other commands are not.
+
+    :param o: the object served by the daemon
+    :param to_execute:
+    :param to_execute_kwargs:
+    :param thread_safe:
+    :return:
+    """
+    if isinstance(to_execute, string_types):
+        to_execute = COMMANDS.get(to_execute)
+    if to_execute in _READ_COMMANDS and to_execute_kwargs:
+        return is_plain_attribute_path(o, to_execute_kwargs.get('names'))
+    if to_execute not in _CALL_COMMANDS or not to_execute_kwargs:
+        return False
+
+    names = to_execute_kwargs.get('names')
+    if thread_safe is True:
+        return True
+    elif thread_safe and all(isinstance(n, string_types) for n in names) and '.'.join(names) in thread_safe:
+        return True
+
+    try:
+        method = get_object(o, names)
+    except Exception:
+        # the command will raise the error
+        return False
+    if getattr(method, THREAD_SAFE_ATTR, False) is True:
+        return True
+    owner = getattr(method, '__self__', None)
+    if owner is not None:
+        return getattr(owner, THREAD_SAFE_ATTR, False) is True
+    elif isinstance(method, FunctionType):
+        # the module of a function
+        return method.__globals__.get(THREAD_SAFE_ATTR, False) is True
+    return False
+
+
+def is_plain_attribute_path(o,
+                            names  # type: List[Union[str, int]]
+                            ):
+    # type: (...) -> bool
+    """
+    Returns True if the object at attribute path `names` (see `get_object`) can be read without executing code of the
+    object: each attribute is a module or instance attribute, a method, a slot or a class attribute that is not a
+    descriptor, but neither a property (nor any other descriptor, for example a `cached_property`) nor provided by
+    `__getattr__`. Reading it is then thread-safe.
+
+    :param o: the object served by the daemon
+    :param names:
+    :return:
+    """
+    result = o
+    if len(names) > 0 and not isinstance(names[0], string_types):
+        result = _handles.get(names[0], _MISSING)
+        if result is _MISSING:
+            # the command will raise the error
+            return False
+        names = names[1:]
+
+    for n in names:
+        class_attr = _MISSING
+        for klass in getattr(type(result), '__mro__', ()):
+            if n in klass.__dict__:
+                class_attr = klass.__dict__[n]
+                break
+        if class_attr is not _MISSING and hasattr(type(class_attr), '__set__') \
+                and not isinstance(class_attr, MemberDescriptorType):
+            # a property: its getter may not be thread-safe
+            return False
+
+        instance_dict = getattr(result, '__dict__', None)
+        if isinstance(instance_dict, dict) and n in instance_dict:
+            result = instance_dict[n]
+        elif class_attr is not _MISSING:
+            if hasattr(type(class_attr), '__get__') and not isinstance(class_attr, _PLAIN_DESCRIPTOR_TYPES):
+                # a descriptor that may execute code, for example a `cached_property`
+                return False
+            # a method, a class attribute, or a slot
+            try:
+                result = getattr(result, n)
+            except AttributeError:
+                # an empty slot: the command will raise the error
+                return False
+        else:
+            # provided by `__getattr__`, or missing
+            return False
+    return True
+
+
+def _get_thread_safe_paths(thread_safe=None  # type: Union[bool, Iterable[str]]
+                           ):
+    # type: (...) -> Union[bool, Set[str]]
+    """
+    Validates the `thread_safe` argument of `DaemonProxy` and `DaemonServer`: returns True, None, or the set of paths.
+
+    :param thread_safe:
+    :return:
+    """
+    if thread_safe is None or thread_safe is True:
+        return thread_safe
+    elif thread_safe is False:
+        return None
+    elif isinstance(thread_safe, string_types):
+        raise TypeError("thread_safe should be a boolean or a collection of paths, found: %r" % thread_safe)
+    else:
+        return frozenset(thread_safe)
+
+
+class SharedExclusiveLock(object):
+    """
+    A lock held either by any number of thread-safe commands at once (shared), or by a single other command
+    (exclusive). Threads waiting for the exclusive lock have priority over new shared holders. It may be released by
+    another thread than the one that acquired it.
+    """
+    __slots__ = '_cond', '_shared', '_exclusive', '_waiting_exclusive'
+
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._shared = 0
+        self._exclusive = False
+        self._waiting_exclusive = 0
+
+    def acquire_shared(self):
+        with self._cond:
+            while self._exclusive or self._waiting_exclusive > 0:
+                self._cond.wait()
+            self._shared += 1
+
+    def release_shared(self):
+        with self._cond:
+            self._shared -= 1
+            if self._shared == 0:
+                self._cond.notify_all()
+
+    def acquire_exclusive(self):
+        with self._cond:
+            self._waiting_exclusive += 1
+            try:
+                while self._exclusive or self._shared > 0:
+                    self._cond.wait()
+            finally:
+                self._waiting_exclusive -= 1
+            self._exclusive = True
+
+    def release_exclusive(self):
+        with self._cond:
+            self._exclusive = False
+            self._cond.notify_all()
+
+
+class _ThreadPool(object):
+    """The threads executing the thread-safe commands received by a daemon started with `threads`"""
+    __slots__ = '_queue', '_threads'
+
+    def __init__(self,
+                 size  # type: int
+                 ):
+        self._queue = Queue()
+        self._threads = [Thread(target=self._work, name='spawny-daemon-%s' % i) for i in range(size)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            task[0](*task[1:])
+
+    def submit(self, f, *args):
+        self._queue.put((f, ) + args)
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
+
 class ObjectProxy(with_metaclass(ProxifyDunderMeta, object)):
     """
     Represents a proxy to an object. It relies on a daemon proxy to communicate.
@@ -182,10 +789,16 @@ class ObjectProxy(with_metaclass(ProxifyDunderMeta, object)):
 
     __myslots__ = 'daemon', 'is_multi_object', 'child_names'  # 'instance_type',
 
+    def __reduce__(self):
+        return _reduce_as_reference(self.daemon, self.child_names or [])
+
+    def __reduce_ex__(self, protocol):
+        return self.__reduce__()
+
     def __init__(self,
                  daemon,              # type: DaemonProxy
                  is_multi_object,     # type: bool
-                 instance_type=None,  # type: Type[Any]
+                 instance_type=None,  # type: Union[Type[Any], TypeDescriptor]
                  #attr_methods=None,   # type: List[str]
                  child_names=None     # type: List[str]
                  ):
@@ -214,7 +827,7 @@ class ObjectProxy(with_metaclass(ProxifyDunderMeta, object)):
         if item in ObjectProxy.__myslots__:
             # real local attributes
             return super(ObjectProxy, self).__getattribute__(item)
-        elif item in ('terminate_daemon', ):
+        elif item in ('terminate_daemon', 'invalidate_attr_cache'):
             # real daemon attributes
             return getattr(self.daemon, item)
         else:
@@ -224,136 +837,801 @@ class ObjectProxy(with_metaclass(ProxifyDunderMeta, object)):
             else:
                 names = [item]
 
-            # first let's check what kind of object this is so that we can determine what to do
-            try:
-                is_func = self.daemon.remote_call_using_pipe(EXEC_CMD, is_function, names=names, log_errors=False)
-            except AttributeError as e:
-                # Rich comparison operators might be missing
-                if PY2 and item in ('__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__'):
-                    def remote_method_proxy(*args, **kwargs):
-                        return self.daemon.remote_call_using_pipe(EXEC_CMD, call_method_using_cmp_py2,
-                                                                  to_execute_args=args, names=names[0:-1],
-                                                                  method_to_replace=item, **kwargs)
-                    return remote_method_proxy
-                else:
-                    raise_from(e, e)
+            # first let's check what kind of object this is so that we can determine what to do.
+            # Paths starting from a handle are not cached, so that the cache does not keep the handle alive
+            cacheable = isinstance(names[0], string_types)
+            metadata = self.daemon.attr_cache.get(names) if cacheable else None
+            if metadata is not None:
+                is_func, typ = metadata
+                has_value = value_unsendable = False
+            else:
+                # a single round trip to get the kind, type, and if relevant the value
+                with_value = not self.is_multi_object
+                try:
+                    is_func, typ, has_value, value = self.daemon.remote_call_using_pipe(EXEC_CMD, resolve_attribute,
+                                                                                       names=names,
+                                                                                       with_value=with_value,
+                                                                                       log_errors=False)
+                except AttributeError as e:
+                    # Rich comparison operators might be missing
+                    if PY2 and item in ('__eq__', '__ne__', '__lt__', '__le__', '__gt__', '__ge__'):
+                        def remote_method_proxy(*args, **kwargs):
+                            return self.daemon.remote_call_using_pipe(EXEC_CMD, call_method_using_cmp_py2,
+                                                                      to_execute_args=args, names=names[0:-1],
+                                                                      method_to_replace=item, **kwargs)
+                        return remote_method_proxy
+                    else:
+                        raise_from(e, e)
+                except DaemonCouldNotSendMsgError:
+                    if not with_value:
+                        raise
+                    # the value can not be sent (whatever the error raised by the serializer). Not important, we can
+                    # still create a proxy: get the metadata without the value
+                    is_func, typ, has_value, value = self.daemon.remote_call_using_pipe(EXEC_CMD, resolve_attribute,
+                                                                                       names=names, with_value=False,
+                                                                                       log_errors=False)
+
+                # the daemon could not send the value
+                value_unsendable = with_value and not is_func and not has_value
+
+                if cacheable:
+                    self.daemon.attr_cache.put(names, is_func, typ)
 
             if is_func:
                 # a function (not a callable object ): generate a remote method proxy with that name
-                def remote_method_proxy(*args, **kwargs):
-                    return self.daemon.remote_call_using_pipe(EXEC_CMD, call_method_on_object,
-                                                              to_execute_args=args, names=names, **kwargs)
+                return RemoteMethodProxy(self.daemon, names)
 
-                return remote_method_proxy
+            elif self.is_multi_object or isinstance(typ, TypeDescriptor) or value_unsendable:
+                # an object. If it or its type can not be sent (TypeDescriptor) we can still create a proxy
+                # create a new DaemonProxy for that object
+                return ObjectProxy(self.daemon, instance_type=typ, is_multi_object=False, child_names=names)
+
+            elif has_value:
+                # the attribute value was brought back over the pipe
+                return value
 
             else:
-                # an object
+                # bring back the attribute value over the pipe
                 try:
-                    typ = self.daemon.remote_call_using_pipe(EXEC_CMD, get_object, names=names + ['__class__'],
-                                                             log_errors=False)
-
-                    if self.is_multi_object:
-                        # create a new DaemonProxy for that object
-                        return ObjectProxy(self.daemon, instance_type=typ, is_multi_object=False, child_names=names)
-                    else:
-                        # bring back the attribute value over the pipe
-                        return self.daemon.remote_call_using_pipe(EXEC_CMD, get_object, names=names)
-
-                except DaemonCouldNotSendMsgError as pe:
-                    if isinstance(pe.exc, PicklingError):
-                        # the object type is not known or cant be decoded locally. Not important, we can still create a
-                        # proxy
-                        # TODO get the list of methods ?
-                        return ObjectProxy(self.daemon, instance_type=None, is_multi_object=False, child_names=names)
-                    else:
-                        raise
-
-    # TODO
-    # def __setattr__(self, key, value):
-    #     if not self.is_started():
-    #         return super(DaemonProxy, self).__setattr__(key, value)
-    #     else:
-    #         return setattr(self.obj_proxy, key, value)
+                    return self.daemon.remote_call_using_pipe(EXEC_CMD, get_object, names=names)
+                except DaemonCouldNotSendMsgError:
+                    # the object can not be sent (whatever the error raised by the serializer). Not important, we can
+                    # still create a proxy
+                    return ObjectProxy(self.daemon, instance_type=typ, is_multi_object=False, child_names=names)
+
+    def __setattr__(self, key, value):
+        if key in ObjectProxy.__myslots__ or (key.startswith('__') and key.endswith('__')):
+            # real local attributes, and dunder methods set by `replace_all_dundermethods_with_getattr`
+            super(ObjectProxy, self).__setattr__(key, value)
+        else:
+            names = (self.child_names or []) + [key]
+            self.daemon.set_remote_attribute(names, value)
 
     def __call__(self, *args, **kwargs):
-        return self.daemon.remote_call_using_pipe(EXEC_CMD, call_method_on_object, names=self.child_names,
-                                                  to_execute_args=args, **kwargs)
-
+        if self.daemon.results_by_ref:
+            return self.daemon.call_by_ref(self.child_names, *args, **kwargs)
+        return self.daemon.call_by_value(self.child_names, *args, **kwargs)
+
+    def batch(self,
+              stop_on_error=True  # type: bool
+              ):
+        # type: (...) -> RemoteBatch
+        """
+        Returns a `RemoteBatch` context manager to record calls and attribute reads on this object and send them to the
+        daemon in a single message. See `DaemonProxy.batch`.
 
-class CommChannel(object):
-    __slots__ = 'conn',
+        :param stop_on_error: see `DaemonProxy.batch`
+        :return:
+        """
+        return self.daemon.batch(names=self.child_names, stop_on_error=stop_on_error)
 
-    def __init__(self, conn):
-        self.conn = conn
+    def lazy(self):
+        # type: (...) -> LazyProxy
+        """
+        Returns a `LazyProxy` on this object: attribute reads, calls and item reads on it are recorded, and only
+        evaluated by the daemon, in a single round trip, when a value is needed. See `DaemonProxy.lazy`.
 
-    def __del__(self):
-        self.conn = None
+        :return:
+        """
+        return self.daemon.lazy(names=self.child_names)
 
 
-class DaemonProxy(object):
+class RemoteMethodProxy(object):
     """
-    A proxy that spawns (or TODO conects to)
-    a separate process and delegates the methods to it, through an `ObjectProxy`.
+    Represents a proxy to a remote function or method. Calling it executes the function remotely. It can also be applied
+    on many arguments with `map` or `imap`, in which case the loop is executed on the daemon side.
     """
+    __slots__ = 'daemon', 'names'
+
     def __init__(self,
-                 obj_instance_or_definition,  # type: Union[Any, Definition]
-                 python_exe=None,             # type: str
-                 logger=default_logger        # type: Logger
+                 daemon,  # type: DaemonProxy
+                 names    # type: List[str]
                  ):
-        # type: (...) -> DaemonProxy
-        """
-        Creates a daemon running the provided object instance, and inits this Proxy to be able to delegate the calls to
-        the daemon. Users may either provide the object instance, or a definition of instance to create. In that case
-        the instance will be created in the daemon.
-
-        :param obj_instance_or_definition: the object instance to use in the daemon, or the definition that the daemon
-            should follow to create the object instance
-        :param python_exe: the optional python executable to use to launch the daemon. By default the same executable
-            than this process will be used. Note that a non-None value is not supported on python 2 if the system is
-            not windows
-        :param logger: an optional custom logger. By default a logger that prints to stdout will be used.
-        """
-        self.started = False
-        self.logger = logger or default_logger
+        self.daemon = daemon
+        self.names = names
 
-        # --proxify all dunder methods from the instance type
-        # unfortunately this does not help much since for new-style classes, special methods are only looked up on the
-        # class not the instance. That's why we try to register as much special methods as possible in ProxifyDunderMeta
-        if isinstance(obj_instance_or_definition, Definition):
-            instance_type = obj_instance_or_definition.get_type()
-            is_multi_object = obj_instance_or_definition.is_multi_object()
-        else:
-            instance_type = obj_instance_or_definition.__class__
-            is_multi_object = False
+    def __repr__(self):
+        return 'RemoteMethodProxy<%s.%s>' % (self.daemon, '.'.join(str(n) for n in self.names))
 
-        self.obj_proxy = ObjectProxy(daemon=self, instance_type=instance_type, is_multi_object=is_multi_object)
+    def __reduce__(self):
+        return _reduce_as_reference(self.daemon, self.names)
 
-        # --set executable (actually there is no way to ensure that this is atomic with mp.Process(), too bad !
-        if python_exe is not None:
-            if sys.version_info < (3, 0) and not sys.platform.startswith('win'):
-                raise ValueError("`python_exe` can only be set on windows under python 2. See "
-                                 "https://docs.python.org/2/library/multiprocessing.html#multiprocessing.")
-            else:
-                mp.set_executable(python_exe)
+    def __call__(self, *args, **kwargs):
+        if self.daemon.results_by_ref:
+            return self.by_ref(*args, **kwargs)
+        return self.by_value(*args, **kwargs)
+
+    def by_value(self, *args, **kwargs):
+        """
+        Calls the remote function and returns its result, sent back by the daemon. This is what calling this proxy does,
+        unless `results_by_ref` was set on the `DaemonProxy`. See `DaemonProxy.call_by_value`.
+        """
+        return self.daemon.call_by_value(self.names, *args, **kwargs)
+
+    def by_ref(self, *args, **kwargs):
+        # type: (...) -> ObjectProxy
+        """
+        Calls the remote function, but keeps its result in the daemon instead of sending it back: an `ObjectProxy` to
+        the result is returned. This avoids copying results that are large, or that can not be pickled. See
+        `DaemonProxy.call_by_ref`.
+        """
+        return self.daemon.call_by_ref(self.names, *args, **kwargs)
+
+    def with_timeout(self,
+                     timeout  # type: float
+                     ):
+        # type: (...) -> Callable[..., Any]
+        """
+        Returns a function calling this remote function like this proxy does, that raises a `DaemonTimeoutError` if it
+        does not return within `timeout` seconds. See `DaemonProxy.deadline`.
+
+        >>> proxy.slow_method.with_timeout(2.0)(*args, **kwargs)
+
+        :param timeout:
+        :return:
+        """
+        def call_with_timeout(*args, **kwargs):
+            with self.daemon.deadline(timeout):
+                return self(*args, **kwargs)
+        return call_with_timeout
+
+    def imap(self,
+             iterable,        # type: Iterable[Any]
+             chunksize=1000,  # type: int
+             max_inflight=2   # type: int
+             ):
+        # type: (...) -> Iterable[Any]
+        """
+        Lazy version of `map`: returns an iterator on the results. Chunks are sent as the results are consumed, with at
+        most `max_inflight` chunks being sent in advance. Large chunks can not deadlock with the daemon: the sizes of
+        the chunks not processed yet are bounded by `DaemonProxy.max_unanswered_bytes`, see `remote_call_nowait`.
+
+        :param iterable:
+        :param chunksize:
+        :param max_inflight:
+        :return:
+        """
+        if chunksize < 1:
+            raise ValueError("chunksize should be strictly positive")
+        if max_inflight < 1:
+            raise ValueError("max_inflight should be strictly positive")
+
+        it = iter(iterable)
+        pending = deque()
+        try:
+            exhausted = False
+            while True:
+                # send chunks in advance, so that the daemon works while we consume the results
+                while not exhausted and len(pending) < max_inflight:
+                    chunk = list(islice(it, chunksize))
+                    if len(chunk) == 0:
+                        exhausted = True
+                    else:
+                        pending.append(self.daemon.remote_call_nowait(EXEC_CMD, call_method_on_chunk, chunk=chunk,
+                                                                      names=self.names))
+                if len(pending) == 0:
+                    break
+
+                for res in pending.popleft().result():
+                    yield res
+        finally:
+            # if the iteration stopped before the end, drop the remaining responses
+            for p in pending:
+                p.discard()
+
+    def map(self,
+            iterable,        # type: Iterable[Any]
+            chunksize=1000,  # type: int
+            max_inflight=2   # type: int
+            ):
+        # type: (...) -> List[Any]
+        """
+        Applies the remote function on all elements of `iterable` and returns the list of results. The elements are
+        sent to the daemon by chunks of size `chunksize`, and the loop over each chunk is executed on the daemon side,
+        so that only one round trip is needed per chunk. Up to `max_inflight` chunks are sent in advance so that the
+        daemon does not wait for the client between two chunks.
+
+        :param iterable:
+        :param chunksize:
+        :param max_inflight:
+        :return:
+        """
+        return list(self.imap(iterable, chunksize=chunksize, max_inflight=max_inflight))
+
+
+_sending = local()
+"""Holds the `DaemonProxy` whose command is being sent by the current thread, see `_reduce_as_reference`"""
+
+
+def _reduce_as_reference(daemon,  # type: DaemonProxy
+                         names    # type: List[Union[str, RemoteHandle]]
+                         ):
+    """
+    Reduces a proxy to the remote object at attribute path `names` so that it is unpickled as the remote object itself
+    by the daemon (see `resolve_reference`). Proxies can therefore be passed as arguments of remote calls without
+    copying the objects they represent. This is only possible when sending commands to their own daemon.
+
+    :param daemon:
+    :param names:
+    :return:
+    """
+    if getattr(_sending, 'daemon', None) is not daemon:
+        # note: do not use the proxy's repr here, it would be remote
+        raise PicklingError("The proxy to %s.%s can only be sent to its own daemon. Use `fetch` to get its value"
+                            % (daemon, '.'.join(str(n) for n in names)))
+    return resolve_reference, (names, )
+
+
+class RemoteIterator(object):
+    """
+    An iterator over a remote iterator (for example the generator returned by a remote function), kept in the daemon.
+    Items are fetched by chunks of `chunksize` items. While a chunk is being consumed, the next `prefetch` chunks are
+    requested in advance so that the daemon produces them in the meantime. At most `prefetch + 1` chunks are therefore
+    held by the client at a time.
+
+    `chunksize` and `prefetch` may be modified before the iteration starts. The remote iterator is released as soon as
+    it is exhausted, or when this object is garbage collected.
+    """
+    __slots__ = 'daemon', 'handle', 'chunksize', 'prefetch', '_pending', '_items', '_error'
+
+    def __init__(self,
+                 daemon,        # type: DaemonProxy
+                 handle,        # type: RemoteHandle
+                 chunksize=100,  # type: int
+                 prefetch=1     # type: int
+                 ):
+        self.daemon = daemon
+        self.handle = handle
+        self.chunksize = chunksize
+        self.prefetch = prefetch
+        self._pending = deque()
+        self._items = deque()
+        self._error = None
+
+    def __repr__(self):
+        return 'RemoteIterator<%s#%s>' % (self.daemon, self.handle.handle_id if self.handle is not None else 'done')
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self._items) == 0:
+            if self.handle is None:
+                # exhausted
+                if self._error is not None:
+                    error, self._error = self._error, None
+                    raise error
+                raise StopIteration()
+
+            # request the next chunks in advance
+            while len(self._pending) < self.prefetch + 1:
+                self._pending.append(self.daemon.remote_call_nowait(EXEC_CMD, next_chunk, names=[self.handle],
+                                                                    chunksize=self.chunksize))
+            items, done, error = self._pending.popleft().result()
+            self._items.extend(items)
+            if done:
+                self._close()
+                self._error = error
+        return self._items.popleft()
+
+    next = __next__  # python 2
+
+    def _close(self):
+        """Drops the chunks requested in advance and releases the remote iterator"""
+        for p in self._pending:
+            p.discard()
+        self._pending.clear()
+        self.handle = None
+
+    def __del__(self):
+        if self.handle is not None:
+            self._close()
+
+
+class RemoteHandle(object):
+    """
+    A reference to an object kept in the daemon on behalf of the client, for example a result returned by reference
+    (see `RemoteMethodProxy.by_ref`). It is used as the first element of the attribute paths of the proxies to this
+    object: it is sent to the daemon as its handle id, and the object is released in the daemon when the handle is
+    garbage collected, that is when no proxy uses it anymore.
+
+    Releases are sent to the daemon together with the next command, so that they do not cost a round trip. They are
+    dropped if the daemon was restarted since the handle was created: the id may then designate another object.
+    """
+    __slots__ = 'handle_id', 'generation', '_released'
+
+    def __init__(self,
+                 daemon,    # type: DaemonProxy
+                 handle_id  # type: int
+                 ):
+        self.handle_id = handle_id
+        # the generation of the daemon process that created the handle, see `DaemonProxy.restart`
+        self.generation = daemon.generation
+        # only keep the queue of released handles, so that handles do not prevent the daemon from being terminated
+        # when garbage collected. Note that a weak reference to the daemon would not do: the garbage collector clears
+        # the weak references held by the objects it collects before they are finalized
+        self._released = daemon._released_handles
+
+    def __repr__(self):
+        return 'RemoteHandle<%s>' % self.handle_id
+
+    def __reduce__(self):
+        # only the id is sent to the daemon
+        return int, (self.handle_id, )
+
+    def __del__(self):
+        self._released.append((self.generation, self.handle_id))
+
+
+class CommChannel(object):
+    __slots__ = 'conn',
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __del__(self):
+        self.conn = None
+
+
+_spawn_lock = Lock()
+"""A lock used to spawn daemons one at a time, see `DaemonProxy.__init__`"""
 
-        # --init the multiprocess communication queue/pipe
-        parent_conn, child_conn = mp.Pipe()
-        self.parent_conn = CommChannel(parent_conn)
-        # self.logger.info('Object proxy created an interprocess communication channel')
 
-        # --spawn an independent process
+class DaemonProxy(object):
+    """
+    A proxy that spawns (or TODO conects to)
+    a separate process and delegates the methods to it, through an `ObjectProxy`.
+    """
+    _with_heartbeat = False
+    """If True the daemon answers heartbeats on a side channel, see `ping`"""
+
+    max_unanswered_bytes = MAX_UNANSWERED_BYTES
+    """The maximum size in bytes of the requests sent and not answered yet, see `_make_room`. None disables the limit"""
+
+    def __init__(self,
+                 obj_instance_or_definition,  # type: Union[Any, Definition]
+                 python_exe=None,                # type: str
+                 logger=default_logger,          # type: Logger
+                 attr_cache_policy=CACHE_NEVER,  # type: Union[str, float]
+                 shm_threshold=None,             # type: int
+                 oob_threshold=None,             # type: int
+                 serializer=None,                # type: Union[str, Serializer]
+                 compression=None,               # type: Union[str, Compressor]
+                 compression_threshold=DEFAULT_COMPRESSION_THRESHOLD,  # type: int
+                 results_by_ref=False,           # type: bool
+                 iter_chunksize=100,             # type: int
+                 iter_prefetch=1,                # type: int
+                 coalesce_writes=False,          # type: bool
+                 threads=None,                   # type: int
+                 thread_safe=None,               # type: Union[bool, Iterable[str]]
+                 timeout=None,                   # type: float
+                 on_timeout=TIMEOUT_RAISE,       # type: str
+                 remote_type=False               # type: bool
+                 ):
+        # type: (...) -> DaemonProxy
+        """
+        Creates a daemon running the provided object instance, and inits this Proxy to be able to delegate the calls to
+        the daemon. Users may either provide the object instance, or a definition of instance to create. In that case
+        the instance will be created in the daemon.
+
+        :param obj_instance_or_definition: the object instance to use in the daemon, or the definition that the daemon
+            should follow to create the object instance
+        :param python_exe: the optional python executable to use to launch the daemon. By default the same executable
+            than this process will be used. Note that a non-None value is not supported on python 2 if the system is
+            not windows
+        :param logger: an optional custom logger. By default a logger that prints to stdout will be used.
+        :param attr_cache_policy: the policy of the client-side cache storing the kind (function or object) and type of
+            the remote attributes accessed through the object proxies. `'never'` (default) disables the cache,
+            `'always'` trusts the cache until `invalidate_attr_cache` is called, and a number sets a time-to-live in
+            seconds. Only use `'always'` or a time-to-live if the remote attributes are not replaced by objects of
+            another kind or type, or if you invalidate the cache when they are.
+        :param shm_threshold: an optional size in bytes. Buffers (`bytes`, `bytearray`, numpy arrays...) of at least
+            this size, in the arguments and results of remote calls, are transferred through shared memory segments
+            instead of being copied through the pipe. Requires python 3.8+ and a posix system. See `Transport`.
+        :param oob_threshold: an optional size in bytes. Buffers of at least this size (and smaller than
+            `shm_threshold`) are sent out-of-band through the pipe, as separate frames, instead of being copied into the
+            pickled messages. Requires python 3.8+. See `Transport`.
+        :param serializer: the `Serializer` used to encode the messages exchanged with the daemon, or its name:
+            `'pickle'` (default), `'cloudpickle'` to send lambda functions and closures, or `'marshal'`/`'msgpack'` to
+            encode the messages containing only builtin types faster (other messages are pickled). See
+            `spawny.utils_serializers`.
+        :param compression: an optional `Compressor`, or its name: `'zlib'`, `'lzma'` or `'lz4'` (requires the `lz4`
+            package). If set, the messages of at least `compression_threshold` bytes once serialized are compressed
+            before being sent, in both directions. The time spent and the ratio achieved on this side are available in
+            `self.transport.stats`. See `spawny.utils_compression`.
+        :param compression_threshold: the size in bytes from which messages are compressed, when `compression` is
+            set. Defaults to 64kB.
+        :param results_by_ref: if True, the results of the remote calls made through the object proxies are kept in
+            the daemon, and `ObjectProxy` instances pointing to them are returned (see `call_by_ref`). Use
+            `RemoteMethodProxy.by_value` or `fetch` to get values. By default (False), results are sent back by value;
+            `RemoteMethodProxy.by_ref` can then be used to get a single result by reference.
+        :param iter_chunksize: the number of items fetched at a time by the `RemoteIterator` returned when a remote call
+            returns an iterator (for example a generator).
+        :param iter_prefetch: the number of chunks requested in advance by these iterators.
+        :param coalesce_writes: if True, the assignments of remote attributes (`<proxy>.<name> = value`) are not sent
+            immediately: they are recorded and sent in a single message before the next remote call or attribute read,
+            or when `flush_writes` is called. Errors are therefore raised at that time. By default (False) each
+            assignment is sent immediately.
+        :param threads: an optional number of threads executing concurrently, in the daemon, the calls to the methods
+            declared thread-safe. This is typically useful for objects performing blocking I/O, called from several
+            threads in this process. Other commands are still executed one at a time, waiting for the calls in flight.
+            By default all commands are executed one at a time.
+        :param thread_safe: the methods that are thread-safe, in addition to the ones decorated with `thread_safe`:
+            True if all methods are, or their paths such as `'query'` or `'client.get'`.
+        :param timeout: an optional default maximum time to wait for the response to each remote call, in seconds.
+            A `DaemonTimeoutError` is raised when it expires, and the response is dropped if it is received later. It
+            may be changed for some calls with `deadline`, or `RemoteMethodProxy.with_timeout`. By default calls wait
+            for their response as long as needed.
+        :param on_timeout: what to do with the daemon when a call times out. `'raise'` (default) keeps it: it is still
+            executing the call, so the next calls are executed after it. `'restart'` kills it and spawns a new one
+            from `obj_instance_or_definition` (see `restart`), so that the next calls do not wait for it.
+        :param remote_type: if True and `obj_instance_or_definition` is a `Definition`, its type is not obtained with
+            `get_type()` in this process, which imports its module for an `InstanceDefinition`. Instead the daemon sends
+            a `TypeDescriptor` of the type once the object is created, and the object proxy is configured with it. This
+            avoids the import time and memory of heavy libraries in this process. The types of its attributes and of the
+            results kept by reference (see `results_by_ref`) are described the same way, except builtin types. The
+            object proxy is only available once the daemon is started.
+        """
+        # --proxify all dunder methods from the instance type
+        # unfortunately this does not help much since for new-style classes, special methods are only looked up on the
+        # class not the instance. That's why we try to register as much special methods as possible in ProxifyDunderMeta
+        if isinstance(obj_instance_or_definition, Definition):
+            # with `remote_type` the type is received from the daemon when it is started, see `_spawn`
+            instance_type = None if remote_type else obj_instance_or_definition.get_type()
+            is_multi_object = obj_instance_or_definition.is_multi_object()
+        else:
+            instance_type = obj_instance_or_definition.__class__
+            is_multi_object = False
+            remote_type = False
+
+        if threads is not None and threads < 1:
+            raise ValueError("threads should be strictly positive")
+        thread_safe = _get_thread_safe_paths(thread_safe)
+
+        self._init_client(instance_type, is_multi_object, logger=logger, attr_cache_policy=attr_cache_policy,
+                          results_by_ref=results_by_ref, iter_chunksize=iter_chunksize,
+                          iter_prefetch=iter_prefetch, coalesce_writes=coalesce_writes, timeout=timeout,
+                          on_timeout=on_timeout,
+                          transport=Transport(shm_threshold=shm_threshold, oob_threshold=oob_threshold,
+                                              serializer=serializer, compression=compression,
+                                              compression_threshold=compression_threshold))
+
+        if python_exe is not None and sys.version_info < (3, 0) and not sys.platform.startswith('win'):
+            raise ValueError("`python_exe` can only be set on windows under python 2. See "
+                             "https://docs.python.org/2/library/multiprocessing.html#multiprocessing.")
+        self._spawn_args = obj_instance_or_definition, python_exe, threads, thread_safe, remote_type
+        self._spawn()
+        self.started = True
+
+    def _spawn(self):
+        """
+        Spawns the daemon process from the arguments received by the constructor, and waits until it is started.
+
+        :return:
+        """
+        obj_instance_or_definition, python_exe, threads, thread_safe, remote_type = self._spawn_args
+
+        # --spawn an independent process. This is done under a lock so that processes spawned concurrently from other
+        # threads do not inherit the child end of the pipe (nor the process sentinel), which would prevent the daemon
+        # end-of-life to be detected
         self.logger.info('[DaemonProxy] spawning child process...')
-        self.p = mp.Process(target=daemon, args=(child_conn, obj_instance_or_definition),
-                            name=python_exe or 'python' + '-' + str(obj_instance_or_definition))
-        self.p.start()
-        # make sure that instantiation happened correctly, and report possible exception otherwise
-        self.wait_for_response()
+        with _spawn_lock:
+            # --set executable (actually there is no way to ensure that this is atomic with mp.Process(), too bad !
+            if python_exe is not None:
+                mp.set_executable(python_exe)
+
+            # --init the multiprocess communication queue/pipe
+            parent_conn, child_conn = mp.Pipe()
+            self.parent_conn = CommChannel(parent_conn)
+            # self.logger.info('Object proxy created an interprocess communication channel')
+
+            # --the side channel on which the daemon answers heartbeats, see `ping`
+            if self._with_heartbeat:
+                heartbeat_conn, child_heartbeat_conn = mp.Pipe()
+                self._heartbeat_conn = heartbeat_conn
+            else:
+                child_heartbeat_conn = None
+
+            self.p = mp.Process(target=daemon, args=(child_conn, obj_instance_or_definition, self.transport, threads,
+                                                     thread_safe, child_heartbeat_conn, remote_type),
+                                name=python_exe or 'python' + '-' + str(obj_instance_or_definition))
+            self.p.start()
+
+            # the child end of the pipe is now owned by the daemon
+            child_conn.close()
+            if child_heartbeat_conn is not None:
+                child_heartbeat_conn.close()
+
+        # make sure that instantiation happened correctly, and report possible exception otherwise. Startup is not
+        # subject to the calls timeout
+        started_msg = self._handle_response(self._recv_response(START_REQ_ID))
+        if remote_type and self.instance_type is None:
+            # the type of the object, reported by the daemon. When restarted, the existing object proxy is kept
+            self.instance_type = started_msg
+            self.obj_proxy = ObjectProxy(daemon=self, instance_type=started_msg, is_multi_object=self.is_multi_object)
         self.logger.info('[DaemonProxy] spawning child process... DONE. PID=%s' % (self.p.pid))
-        self.started = True
+
+    def _init_client(self,
+                     instance_type,                # type: Type[Any]
+                     is_multi_object,              # type: bool
+                     logger=default_logger,         # type: Logger
+                     attr_cache_policy=CACHE_NEVER,  # type: Union[str, float]
+                     results_by_ref=False,           # type: bool
+                     iter_chunksize=100,             # type: int
+                     iter_prefetch=1,                # type: int
+                     coalesce_writes=False,          # type: bool
+                     timeout=None,                   # type: float
+                     on_timeout=TIMEOUT_RAISE,       # type: str
+                     transport=None                 # type: Transport
+                     ):
+        """
+        Inits the client-side state of this proxy, before it is connected to its daemon.
+
+        :param instance_type: the type of the daemon's root object
+        :param is_multi_object: True if the daemon's root object is a module or script
+        :param logger:
+        :param attr_cache_policy:
+        :param results_by_ref:
+        :param iter_chunksize:
+        :param iter_prefetch:
+        :param coalesce_writes:
+        :param timeout:
+        :param on_timeout:
+        :param transport: the `Transport` used to exchange messages with the daemon
+        :return:
+        """
+        self.started = False
+        self.logger = logger or default_logger
+        self.attr_cache = AttrMetadataCache(attr_cache_policy)
+        self.results_by_ref = results_by_ref
+        if iter_chunksize < 1:
+            raise ValueError("iter_chunksize should be strictly positive")
+        if iter_prefetch < 0:
+            raise ValueError("iter_prefetch should be positive")
+        self.iter_chunksize = iter_chunksize
+        self.iter_prefetch = iter_prefetch
+        if timeout is not None and timeout <= 0:
+            raise ValueError("timeout should be strictly positive")
+        if on_timeout not in (TIMEOUT_RAISE, TIMEOUT_RESTART):
+            raise ValueError("on_timeout should be %r or %r, found: %r" % (TIMEOUT_RAISE, TIMEOUT_RESTART, on_timeout))
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        # the deadlines set with `deadline`, per thread
+        self._deadlines = local()
+
+        # --the assignments recorded when `coalesce_writes` is set, as batch operations
+        self.coalesce_writes = coalesce_writes
+        self._writes_lock = Lock()
+        self._pending_writes = []
+        self.transport = transport if transport is not None else Transport()
+
+        # --the generations and ids of the handles garbage collected, to release in the daemon with the next command. A
+        # deque since handles may be collected from any thread
+        self._released_handles = deque()
+
+        # --the heartbeats sent on the side channel, if any
+        self._heartbeat_lock = Lock()
+        self._heartbeat_id = 0
+
+        # --request ids and responses received for other requests than the one waited for
+        self._req_ids = count(START_REQ_ID + 1)
+        self._send_lock = Lock()
+        self._recv_lock = RLock()
+        # notified when a response is stored or the receiving lock is released, see `_recv_response`. Its lock guards
+        # the responses stored and discarded, and is reentrant since responses may be discarded by a garbage collected
+        # `RemoteIterator` while storing another one
+        self._recv_cond = Condition(RLock())
+        self._responses = dict()
+        self._discarded = set()
+        # the size of the requests whose response was not received yet, see `_make_room`. The total sizes of the
+        # requests sent and answered are only updated with the sending and receiving lock held respectively
+        self._unanswered = dict()
+        self._sent_bytes = self._answered_bytes = 0
+        # the names of the shared memory segments of the requests whose response was not received yet, that should be
+        # destroyed if the daemon ends without reading them, see `_destroy_segments`
+        self._sent_segments = dict()
+        # the requests sent before the last restart will never get a response
+        self._first_req_id = START_REQ_ID
+        # the number of times the daemon was restarted
+        self.generation = 0
+
+        self.instance_type = instance_type
+        self.is_multi_object = is_multi_object
+        self.obj_proxy = ObjectProxy(daemon=self, instance_type=instance_type, is_multi_object=is_multi_object)
 
     def is_started(self):
         return self.started
 
+    def invalidate_attr_cache(self,
+                              names=None  # type: List[str]
+                              ):
+        """
+        Invalidates the client-side cache of remote attributes metadata, so that the kind and type of these attributes
+        are fetched again from the daemon on next access.
+
+        :param names: an optional attribute path (for example `['foo', 'bar']` for `<proxy>.foo.bar`). If provided,
+            only this attribute and its sub-attributes are invalidated. By default the whole cache is cleared.
+        :return:
+        """
+        self.attr_cache.invalidate(names)
+
+    def batch(self,
+              names=None,         # type: List[str]
+              stop_on_error=True  # type: bool
+              ):
+        # type: (...) -> RemoteBatch
+        """
+        Returns a `RemoteBatch` context manager. The calls and attribute reads made on the recorder returned by
+        `__enter__` are not executed immediately: they are sent to the daemon in a single message when the `with` block
+        exits, and executed there in sequence.
+
+        >>> with daemon.batch() as b:
+        ...     b.set_a(1)
+        ...     b.child.set_b(2)
+
+        :param names: an optional attribute path to the object on which the operations should be recorded. By default
+            the daemon's root object
+        :param stop_on_error: if True (default) the daemon stops at the first error, and the error is raised when the
+            `with` block exits. Otherwise all operations are executed and errors are only stored in the results.
+        :return:
+        """
+        return RemoteBatch(self, names=names, stop_on_error=stop_on_error)
+
+    def set_remote_attribute(self,
+                             names,  # type: List[Union[str, RemoteHandle]]
+                             value   # type: Any
+                             ):
+        """
+        Sets the remote attribute at attribute path `names` to `value`. This is what `<proxy>.<name> = value` does.
+
+        If `coalesce_writes` was set in the constructor, the assignment is only recorded: all recorded assignments are
+        sent in a single message before the next command (or when `flush_writes` is called).
+
+        :param names:
+        :param value:
+        :return:
+        """
+        # the kind or type of the attribute may change
+        self.attr_cache.invalidate(names)
+        if self.coalesce_writes:
+            with self._writes_lock:
+                self._pending_writes.append((BATCH_SET, names, (value, ), dict()))
+        else:
+            self.remote_call_using_pipe(EXEC_CMD, set_attribute, names=names, value=value)
+
+    def flush_writes(self):
+        """
+        Sends the assignments recorded since the last command when `coalesce_writes` is set, in a single message, and
+        waits until they are executed. They are executed in order, and the first error is raised.
+
+        :return:
+        """
+        with self._writes_lock:
+            if len(self._pending_writes) == 0:
+                return
+            ops, self._pending_writes = self._pending_writes, []
+        outcomes = self._remote_call(EXEC_CMD, execute_batch, None, True, dict(ops=ops, stop_on_error=True))
+        if len(outcomes) > 0 and outcomes[-1][0] == ERR_FLAG:
+            raise outcomes[-1][1]
+
+    def lazy(self,
+             names=None  # type: List[Union[str, RemoteHandle]]
+             ):
+        # type: (...) -> LazyProxy
+        """
+        Returns a `LazyProxy`. The attribute reads, calls and item reads made on it do not perform any round trip: they
+        build an expression that is sent to the daemon and evaluated there in a single round trip only when a value is
+        needed, that is when `fetch()` is called, or when the expression is compared, converted (`str`, `int`, `bool`,
+        `len`...) or iterated.
+
+        >>> daemon.lazy().a.b.c(x).d.fetch()
+
+        :param names: an optional attribute path to the object from which the expression starts. By default the
+            daemon's root object
+        :return:
+        """
+        return LazyProxy(self, list(names) if names is not None else [])
+
+    def call_by_ref(self,
+                    names,  # type: List[Union[str, RemoteHandle]]
+                    *args,
+                    **kwargs
+                    ):
+        # type: (...) -> ObjectProxy
+        """
+        Calls the remote function at attribute path `names` and keeps its result in the daemon, in a table of handles.
+        Returns an `ObjectProxy` to the result, that can be used like any other proxy, for example passed back to another
+        remote call. The result is released from the daemon once the proxy (and the proxies obtained from it) are
+        garbage collected.
+
+        :param names: the attribute path of the function to call
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        handle_id, typ = self.remote_call_using_pipe(EXEC_CMD, call_method_by_ref, to_execute_args=args,
+                                                     names=names, **kwargs)
+        return ObjectProxy(self, instance_type=typ, is_multi_object=False,
+                           child_names=[RemoteHandle(self, handle_id)])
+
+    def call_by_value(self,
+                      names,  # type: List[Union[str, RemoteHandle]]
+                      *args,
+                      **kwargs
+                      ):
+        """
+        Calls the remote function at attribute path `names` and returns its result. If the result is an iterator (for
+        example a generator), it is not sent back at once: a `RemoteIterator` streaming its items by chunks is returned
+        instead (see `iter_chunksize` and `iter_prefetch` in the constructor).
+
+        :param names: the attribute path of the function to call
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        is_iterator, result = self.remote_call_using_pipe(EXEC_CMD, call_method_or_iterate, to_execute_args=args,
+                                                          names=names, **kwargs)
+        if is_iterator:
+            return RemoteIterator(self, RemoteHandle(self, result), chunksize=self.iter_chunksize,
+                                  prefetch=self.iter_prefetch)
+        return result
+
+    def fetch(self,
+              obj_proxy  # type: ObjectProxy
+              ):
+        # type: (...) -> Any
+        """
+        Returns the value of the remote object represented by `obj_proxy`, sent back by the daemon. This is typically
+        used to get the value of a result returned by reference.
+
+        :param obj_proxy:
+        :return:
+        """
+        return self.remote_call_using_pipe(EXEC_CMD, get_object, names=obj_proxy.child_names or [])
+
+    def fork(self,
+             logger=None,            # type: Logger
+             attr_cache_policy=None  # type: Union[str, float]
+             ):
+        # type: (...) -> ForkedDaemonProxy
+        """
+        Forks the daemon with `os.fork`, and returns a new proxy connected to the forked daemon through its own pipe.
+
+        The forked daemon starts with a copy-on-write copy of the memory of this daemon, so the object instance or
+        definition does not have to be created again: this is much faster than spawning a new daemon when creating the
+        object is expensive (for example when a `ModuleDefinition` imports large libraries). This daemon can therefore
+        be used as a "template" from which many daemons are forked. Note that the state of the object is copied at the
+        time of the fork, and that the forked daemons are then completely independent.
+
+        Only available on unix. Terminating this daemon does not terminate the forked daemons.
+
+        :param logger: an optional logger for the new proxy. By default the logger of this proxy is used.
+        :param attr_cache_policy: an optional attribute cache policy for the new proxy. By default the policy of this
+            proxy is used.
+        :return:
+        """
+        return ForkedDaemonProxy(self, logger=logger, attr_cache_policy=attr_cache_policy)
+
     def __str__(self):
         return repr(self)
 
@@ -377,10 +1655,76 @@ class DaemonProxy(object):
         - to execute should be defined at the module level here
         - and what will be executed remotely is to_execute(o, **to_execute_kwargs)
 
-        :param cmd_type: command type (EXIT_CMD, EXEC_CMD)
+        :param cmd_type: command type (EXIT_CMD, EXEC_CMD, FORK_CMD)
+        :param to_execute:
+        :return:
+        """
+        if cmd_type != EXIT_CMD and len(self._pending_writes) > 0:
+            self.flush_writes()
+        return self._remote_call(cmd_type, to_execute, to_execute_args, log_errors, to_execute_kwargs)
+
+    def _remote_call(self,
+                     cmd_type,           # type: int
+                     to_execute,         # type: Callable[[Any], Any]
+                     to_execute_args,    # type: Iterable[Any]
+                     log_errors,         # type: bool
+                     to_execute_kwargs   # type: Dict[str, Any]
+                     ):
+        """The implementation of `remote_call_using_pipe`, without flushing the recorded assignments"""
+        req_id = self._send_command(cmd_type, to_execute, to_execute_args, to_execute_kwargs)
+
+        if cmd_type == EXIT_CMD:
+            return
+        else:
+            # wait for the results of the python method called
+            return self.wait_for_response(req_id, log_errors=log_errors)
+
+    def remote_call_nowait(self,
+                           cmd_type,              # type: int
+                           to_execute=None,       # type: Callable[[Any], Any]
+                           to_execute_args=None,  # type: Iterable[Any]
+                           log_errors=True,       # type: bool
+                           **to_execute_kwargs    # type: Dict[str, Any]
+                           ):
+        # type: (...) -> PendingResponse
+        """
+        Same as `remote_call_using_pipe` but does not wait for the response. Instead, a `PendingResponse` is returned,
+        whose `result()` method waits for it. This can be used to pipeline several calls: the daemon executes them in
+        order while the client is still sending the next ones, and responses are matched to their calls by request id.
+
+        The requests not answered yet are bounded to `max_unanswered_bytes` bytes: when sending would exceed it, the
+        responses already available are received (and stored for their `PendingResponse`) first, so that the client
+        and the daemon can not both block writing into a full pipe.
+
+        :param cmd_type: command type (EXEC_CMD only)
         :param to_execute:
+        :param to_execute_args:
+        :param log_errors:
+        :param to_execute_kwargs:
         :return:
         """
+        if cmd_type != EXEC_CMD:
+            raise ValueError('[%s] Only EXEC_CMD commands can be sent without waiting for the response' % self)
+        if len(self._pending_writes) > 0:
+            self.flush_writes()
+        req_id = self._send_command(cmd_type, to_execute, to_execute_args, to_execute_kwargs)
+        return PendingResponse(self, req_id, log_errors)
+
+    def _send_command(self,
+                      cmd_type,           # type: int
+                      to_execute,         # type: Callable[[Any], Any]
+                      to_execute_args,    # type: Iterable[Any]
+                      to_execute_kwargs   # type: Dict[str, Any]
+                      ):
+        """
+        Sends a command to the daemon without waiting for the response.
+
+        :param cmd_type: command type (EXIT_CMD, EXEC_CMD, FORK_CMD)
+        :param to_execute:
+        :param to_execute_args:
+        :param to_execute_kwargs:
+        :return: the request id of the command
+        """
         if not self.is_started():
             raise Exception('[%s] Cannot perform remote calls - daemon is not started' % self)
 
@@ -388,30 +1732,450 @@ class DaemonProxy(object):
             log_str = 'execute method'
         elif cmd_type == EXIT_CMD:
             log_str = 'exit'
+        elif cmd_type == FORK_CMD:
+            log_str = 'fork'
         else:
             raise ValueError('[%s] Invalid command : %s' % (self, cmd_type))
 
-        query_str = log_str + ((': %s(o, *%s, **%s)' % (to_execute.__name__, to_execute_args, to_execute_kwargs))
-                               if to_execute is not None else '')
-        self.logger.debug('[%s] asking daemon to %s' % (self, query_str))
-        self.parent_conn.conn.send((cmd_type, to_execute, to_execute_args, to_execute_kwargs))
+        # do not format the arguments if not needed: they may be large
+        if self.logger.isEnabledFor(DEBUG):
+            query_str = log_str + ((': %s(o, *%s, **%s)' % (to_execute.__name__, to_execute_args, to_execute_kwargs))
+                                   if to_execute is not None else '')
+            self.logger.debug('[%s] asking daemon to %s' % (self, query_str))
 
-        if cmd_type == EXIT_CMD:
+        with self._send_lock:
+            req_id, msg = self._encode_command(cmd_type, to_execute, to_execute_args, to_execute_kwargs)
+            try:
+                if cmd_type != EXIT_CMD and self.max_unanswered_bytes is not None and len(self._unanswered) > 0:
+                    self._make_room(msg.nbytes)
+            except BaseException:
+                msg.discard()
+                raise
+            self._write_command(req_id, msg, answered=cmd_type != EXIT_CMD)
+        return req_id
+
+    def _encode_command(self,
+                        cmd_type,           # type: int
+                        to_execute,         # type: Callable[[Any], Any]
+                        to_execute_args,    # type: Iterable[Any]
+                        to_execute_kwargs   # type: Dict[str, Any]
+                        ):
+        """
+        Assigns a request id to a command and encodes it, see `_send_command`. The handles garbage collected since the
+        last command are released first. Should be called with the send lock held.
+
+        :return: a tuple (req_id, msg)
+        """
+        if to_execute is not None and COMMANDS.get(getattr(to_execute, '__name__', None)) is to_execute:
+            # one of our commands: send it by name
+            to_execute = to_execute.__name__
+        if len(self._released_handles) > 0:
+            self._send_released_handles()
+        req_id = next(self._req_ids)
+        # the proxies to this daemon contained in the message are sent as references
+        _sending.daemon = self
+        try:
+            msg = self.transport.encode((req_id, cmd_type, to_execute, to_execute_args, to_execute_kwargs))
+        finally:
+            _sending.daemon = None
+        return req_id, msg
+
+    def _write_command(self,
+                       req_id,   # type: int
+                       msg,      # type: EncodedMessage
+                       answered  # type: bool
+                       ):
+        """
+        Writes an encoded command into the pipe, see `_send_command`. Should be called with the send lock held.
+
+        :param req_id:
+        :param msg:
+        :param answered: if False the daemon will not respond (EXIT_CMD), so the request is not counted as unanswered
+        :return:
+        """
+        if answered and self.max_unanswered_bytes is not None:
+            self._unanswered[req_id] = msg.nbytes
+            self._sent_bytes += msg.nbytes
+        if len(msg.segments) > 0:
+            self._sent_segments[req_id] = [shm.name for shm in msg.segments]
+        try:
+            self.transport.write(self.parent_conn.conn, msg)
+        except (EOFError, OSError) as e:
+            if isinstance(e, EOFError) or getattr(e, 'errno', None) in (errno.EPIPE, errno.ECONNRESET):
+                raise_from(self._died_error(), e)
+            raise
+
+    def _make_room(self,
+                   nbytes  # type: int
+                   ):
+        """
+        Receives responses until a request of `nbytes` bytes can be sent without exceeding `max_unanswered_bytes` (the
+        responses to other requests are stored). Should be called with the send lock held.
+
+        Since the daemon writes its responses before reading the next requests, a client sending requests without
+        reading the responses would otherwise deadlock with the daemon as soon as the pipe is full in both directions:
+        both would wait for the other to read. The pipe contains at most the requests that were not answered yet.
+
+        :param nbytes: the size of the request to send
+        :return:
+        """
+        deadline = None
+        while len(self._unanswered) > 0 and self._unanswered_bytes() + nbytes > self.max_unanswered_bytes:
+            if deadline is None:
+                deadline = self._get_deadline()
+            if deadline is None:
+                self._recv_lock.acquire()
+            elif not _acquire(self._recv_lock, deadline - _now()):
+                raise DaemonTimeoutError('[%s] The responses to the previous requests were not received in time'
+                                         % self)
+            try:
+                # another thread may have received responses in the meantime
+                if len(self._unanswered) > 0 and self._unanswered_bytes() + nbytes > self.max_unanswered_bytes:
+                    self._store_response(*self._recv_message(None, deadline))
+            finally:
+                self._release_recv_lock()
+
+    def _unanswered_bytes(self):
+        # type: (...) -> int
+        """Returns the size in bytes of the requests sent and not answered yet"""
+        return self._sent_bytes - self._answered_bytes
+
+    def _send_released_handles(self):
+        """
+        Sends the ids of the handles garbage collected since the last command, so that the daemon releases the objects.
+        The handles created by a previous daemon process are ignored (see `restart`). The daemon does not respond to
+        this command. Should be called with the send lock held.
+
+        :return:
+        """
+        handle_ids = []
+        try:
+            while True:
+                generation, handle_id = self._released_handles.popleft()
+                if generation == self.generation:
+                    handle_ids.append(handle_id)
+        except IndexError:
+            pass
+        if len(handle_ids) > 0:
+            self.transport.send(self.parent_conn.conn, (None, RELEASE_CMD, None, handle_ids, None))
+
+    @contextmanager
+    def deadline(self,
+                 timeout  # type: float
+                 ):
+        """
+        Returns a context manager in which the remote calls made by the current thread should all be completed within
+        `timeout` seconds, or raise a `DaemonTimeoutError`. The `timeout` of this proxy still applies to each call.
+
+        >>> with daemon.deadline(2.0):
+        >>>     a = daemon.obj_proxy.get_a()
+        >>>     b = daemon.obj_proxy.get_b(a)
+
+        :param timeout:
+        :return:
+        """
+        previous = getattr(self._deadlines, 'deadline', None)
+        deadline = _now() + timeout
+        self._deadlines.deadline = deadline if previous is None else min(previous, deadline)
+        try:
+            yield
+        finally:
+            self._deadlines.deadline = previous
+
+    def wait_for_response(self,
+                          req_id,           # type: int
+                          log_errors=True,  # type: bool
+                          timeout=None      # type: float
+                          ):
+        """
+        Waits for the response to request `req_id` from child process. Responses to other requests received in the
+        meantime are stored so that they can be retrieved later, possibly from another thread.
+
+        If the response is not received before the `timeout` of this proxy, the current `deadline`, or `timeout`, a
+        `DaemonTimeoutError` is raised and the response is dropped when received. The daemon is restarted first if
+        `on_timeout` is `'restart'`.
+
+        :param req_id: the request id of the command
+        :param log_errors:
+        :param timeout: an optional maximum time to wait, in seconds
+        :return:
+        """
+        deadline = self._get_deadline(timeout)
+        try:
+            res = self._recv_response(req_id, deadline)
+        except DaemonTimeoutError:
+            self.discard_response(req_id)
+            if self.on_timeout == TIMEOUT_RESTART:
+                self.logger.warning('[%s] Restarting the daemon since a call timed out' % self)
+                self.restart()
+            raise
+
+        return self._handle_response(res, log_errors=log_errors)
+
+    def _get_deadline(self,
+                      timeout=None  # type: float
+                      ):
+        # type: (...) -> Optional[float]
+        """
+        Returns the time (see `_now`) after which a call made now by the current thread times out, according to the
+        `timeout` of this proxy, the current `deadline`, and `timeout`. None if there is no limit.
+
+        :param timeout: an optional maximum time to wait, in seconds
+        :return:
+        """
+        deadline = getattr(self._deadlines, 'deadline', None)
+        for t in (timeout, self.timeout):
+            if t is not None:
+                deadline = _now() + t if deadline is None else min(deadline, _now() + t)
+        return deadline
+
+    def _recv_response(self,
+                       req_id,        # type: int
+                       deadline=None  # type: float
+                       ):
+        # type: (...) -> Tuple[bool, Any]
+        """
+        Receives responses until the one to request `req_id` is received, and returns its flag and contents.
+
+        Only one thread at a time receives from the pipe. The other threads wait until either their response is stored
+        by the receiving thread, or they can receive themselves: they do not wait for the response the receiving thread
+        is waiting for, that may take much longer than theirs.
+
+        :param req_id:
+        :param deadline: the optional time (see `_now`) after which a `DaemonTimeoutError` is raised
+        :return:
+        """
+        with self._recv_cond:
+            while True:
+                try:
+                    return self._responses.pop(req_id)
+                except KeyError:
+                    pass
+                if START_REQ_ID < req_id < self._first_req_id:
+                    raise DaemonRestartedError('[%s] The daemon was restarted before responding to request %s'
+                                               % (self, req_id))
+                if self._recv_lock.acquire(False):
+                    break
+                if deadline is None:
+                    self._recv_cond.wait()
+                else:
+                    remaining = deadline - _now()
+                    if remaining <= 0:
+                        raise DaemonTimeoutError('[%s] No response received in time for request %s' % (self, req_id))
+                    self._recv_cond.wait(remaining)
+        try:
+            while True:
+                res_id, flag, contents = self._recv_message(req_id, deadline)
+                if res_id == req_id:
+                    return flag, contents
+                self._store_response(res_id, flag, contents)
+        finally:
+            self._release_recv_lock()
+
+    def _release_recv_lock(self):
+        """Releases the receiving lock, and wakes up the threads waiting to receive in `_recv_response`"""
+        self._recv_lock.release()
+        with self._recv_cond:
+            self._recv_cond.notify_all()
+
+    def _recv_message(self,
+                      req_id,   # type: Optional[int]
+                      deadline  # type: Optional[float]
+                      ):
+        # type: (...) -> Tuple[int, bool, Any]
+        """
+        Receives the next response sent by the daemon, and returns its request id, flag and contents. Should be called
+        with the receiving lock held.
+
+        :param req_id: the request whose response is waited for, if any. Only used in the errors raised.
+        :param deadline: the optional time (see `_now`) after which a `DaemonTimeoutError` is raised
+        :return:
+        """
+        conn = self.parent_conn.conn
+        # the end of a spawned daemon is detected immediately with its sentinel, even if the pipe is still open
+        sentinel = getattr(self.p, 'sentinel', None) if _wait is not None else None
+        if sentinel is not None:
+            ready = _wait([conn, sentinel], None if deadline is None else max(deadline - _now(), 0))
+            if len(ready) == 0:
+                raise DaemonTimeoutError('[%s] No response received in time for request %s' % (self, req_id))
+            elif conn not in ready:
+                raise self._died_error(req_id)
+        elif deadline is not None and not conn.poll(max(deadline - _now(), 0)):
+            raise DaemonTimeoutError('[%s] No response received in time for request %s' % (self, req_id))
+        try:
+            res_id, flag, contents = self.transport.recv(conn)
+        except (EOFError, OSError) as e:
+            raise_from(self._died_error(req_id), e)
+        self._mark_answered(res_id)
+        return res_id, flag, contents
+
+    def _mark_answered(self,
+                       res_id  # type: int
+                       ):
+        """
+        Updates the requests not answered yet when the response to request `res_id` is received: the daemon has read
+        the request, and its shared memory segments if any. Should be called with the receiving lock held.
+
+        :param res_id:
+        :return:
+        """
+        self._answered_bytes += self._unanswered.pop(res_id, 0)
+        if len(self._sent_segments) > 0:
+            self._sent_segments.pop(res_id, None)
+
+    def _store_response(self,
+                        res_id,   # type: int
+                        flag,     # type: bool
+                        contents  # type: Any
+                        ):
+        """Stores a response received while waiting for another one, unless it was discarded"""
+        with self._recv_cond:
+            if res_id in self._discarded:
+                self._discarded.remove(res_id)
+            else:
+                self._responses[res_id] = flag, contents
+                self._recv_cond.notify_all()
+
+    def ping(self,
+             timeout=None  # type: float
+             ):
+        # type: (...) -> bool
+        """
+        Sends a heartbeat to the daemon on a side channel, answered by a dedicated thread: it is answered even if the
+        daemon is executing a long command, unless its process is dead or stuck (for example in C code holding the GIL).
+        Only available for daemons spawned with heartbeats, see `spawny.SupervisedDaemonProxy`.
+
+        :param timeout: the maximum time to wait for the answer, in seconds
+        :return: True if the daemon answered in time
+        """
+        if not self._with_heartbeat:
+            raise ValueError('[%s] This daemon was not spawned with heartbeats' % self)
+        if timeout is not None:
+            deadline = _now() + timeout
+        with self._heartbeat_lock:
+            conn = self._heartbeat_conn
+            self._heartbeat_id += 1
+            try:
+                conn.send(self._heartbeat_id)
+                while True:
+                    if timeout is not None and not conn.poll(max(deadline - _now(), 0)):
+                        return False
+                    # answers to previous heartbeats that timed out may be received first
+                    if conn.recv() == self._heartbeat_id:
+                        return True
+            except (EOFError, OSError):
+                return False
+
+    def _died_error(self,
+                    req_id=None  # type: int
+                    ):
+        # type: (...) -> Exception
+        """
+        Returns the error to raise when the pipe is closed or the daemon process ended while waiting for request
+        `req_id`: a `DaemonRestartedError` if it was restarted since the request was sent, a `DaemonDiedError`
+        otherwise.
+
+        :param req_id:
+        :return:
+        """
+        if req_id is not None and START_REQ_ID < req_id < self._first_req_id:
+            return DaemonRestartedError('[%s] The daemon was restarted before responding to request %s'
+                                        % (self, req_id))
+        if isinstance(self.p, mp.Process):
+            # the process may not have been reaped yet
+            self.p.join(1)
+        return DaemonDiedError(repr(self), getattr(self.p, 'exitcode', None))
+
+    def restart(self,
+                generation=None  # type: int
+                ):
+        """
+        Kills the daemon and spawns a new one from the object instance or definition received by the constructor. The
+        calls in flight raise a `DaemonRestartedError`, and the handles to objects of the previous daemon (see
+        `RemoteHandle`) become invalid.
+
+        :param generation: if provided, the daemon is only restarted if `generation` is still its current generation,
+            that is, if it was not restarted since `generation` was read. This prevents several threads detecting the
+            same failure to restart the daemon several times.
+        :return:
+        """
+        if not hasattr(self, '_spawn_args'):
+            raise ValueError('[%s] Only the daemons spawned by this proxy can be restarted' % self)
+
+        with self._send_lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.generation += 1
+            self._first_req_id = next(self._req_ids)
+            # kill it before taking the receiving lock, so that the threads waiting for responses are woken up
+            getattr(self.p, 'kill', self.p.terminate)()
+            self.p.join()
+            self._recv_lock.acquire()
+            try:
+                self._destroy_segments()
+                with self._recv_cond:
+                    self._responses.clear()
+                    self._discarded.clear()
+                self._unanswered.clear()
+                self._sent_bytes = self._answered_bytes = 0
+                self._released_handles.clear()
+                with self._writes_lock:
+                    del self._pending_writes[:]
+                self.attr_cache.invalidate()
+                self._spawn()
+            finally:
+                self._release_recv_lock()
+
+    def _destroy_segments(self):
+        """
+        Destroys the shared memory segments that will never be read, once the daemon has exited: the ones of the
+        requests it did not answer, and the ones of the responses remaining in the pipe. Since the receiver of a message
+        is responsible for destroying its segments, they would leak otherwise.
+
+        :return:
+        """
+        if self.transport.shm_threshold is None:
             return
-        else:
-            # wait for the results of the python method called
-            return self.wait_for_response(log_errors=log_errors)
+        for names in self._sent_segments.values():
+            self.transport.destroy_segments(names)
+        self._sent_segments.clear()
 
-    def wait_for_response(self,
-                          log_errors=True):
+        conn = self.parent_conn.conn
+        try:
+            while conn.poll(0):
+                self.transport.discard(conn)
+        except (EOFError, OSError):
+            pass
+
+    def discard_response(self,
+                         req_id  # type: int
+                         ):
+        """
+        Declares that nobody will wait for the response to request `req_id`, so that it is dropped when received. This
+        does not wait for the receiving lock, that may be held by a thread waiting for another response: the response
+        is dropped atomically with respect to `_store_response`.
+
+        :param req_id:
+        :return:
+        """
+        with self._recv_cond:
+            if self._responses.pop(req_id, None) is None:
+                self._discarded.add(req_id)
+
+    def _handle_response(self,
+                         res,             # type: Tuple[bool, Any]
+                         log_errors=True  # type: bool
+                         ):
         """
-        Waits for a response from child process
+        Returns the contents of a response received from the child process, or raises the error it contains.
 
+        :param res:
+        :param log_errors:
         :return:
         """
-        res = self.parent_conn.conn.recv()
         if res[0] == OK_FLAG:
-            self.logger.debug('[%s] Received response from daemon: %s' % (self, res[1]))
+            if self.logger.isEnabledFor(DEBUG):
+                self.logger.debug('[%s] Received response from daemon: %s' % (self, res[1]))
             return res[1]
         elif res[0] == ERR_FLAG:
             if log_errors:
@@ -426,35 +2190,567 @@ class DaemonProxy(object):
         object has pointers to it).
         :return:
         """
-        # only do this if init was entirely completed.
-        if self.is_started():
+        # only do this if init was entirely completed (init may even have failed before `started` was set)
+        if getattr(self, 'started', False):
             self.terminate_daemon()
 
-    def terminate_daemon(self):
+    def terminate_daemon(self,
+                         grace=DEFAULT_TERMINATION_GRACE  # type: float
+                         ):
         """
-        terminates the daemon subprocess
+        terminates the daemon subprocess. See `terminate_all`.
+
+        :param grace: the time given to the daemon to exit, in seconds. It is then terminated with SIGTERM, and killed
+            with SIGKILL if it is still alive after `grace` more seconds.
         :return:
         """
-        self_repr = repr(self)
+        terminate_all([self], grace=grace)
+
+    def _request_exit(self,
+                      deadline=None  # type: float
+                      ):
+        """
+        Asks the daemon to exit without waiting for it, and prevents future calls. Called by `terminate_all`.
 
-        # call exit
-        self.remote_call_using_pipe(EXIT_CMD)
+        :param deadline: the optional time (see `_now`) before which the subclasses should have stopped their own
+            background work, if any, so that terminating stays bounded by the grace period
+        :return:
+        """
+        try:
+            self.remote_call_using_pipe(EXIT_CMD)
+        except DaemonDiedError:
+            pass
 
         # set started to false to prevent future calls
         self.started = False
 
         # no need to close self.parent_conn - it is done automatically when garbage collected (see multiprocessing doc)
 
-        # wait for child process termination
-        self.p.join(timeout=10000)
-        self.p.terminate()
-        self.logger.info('[%s] Terminated successfully' % self_repr)
+
+def terminate_all(proxies,                         # type: Iterable[DaemonProxy]
+                  grace=DEFAULT_TERMINATION_GRACE  # type: float
+                  ):
+    """
+    Terminates several daemons at once. The exit command is sent to all of them first, and then their ends are waited
+    for together. The daemons still alive after `grace` seconds are terminated with SIGTERM, and the ones still alive
+    `grace` seconds later are killed with SIGKILL. The time taken is therefore bounded (by about `2 * grace`), and does
+    not depend on the number of daemons.
+
+    Daemons connected to a `DaemonServer` are not terminated: only their connection is closed.
+
+    :param proxies: the daemon proxies to terminate. The ones that are not started are ignored.
+    :param grace: the time given to the daemons to exit at each step, in seconds
+    :return:
+    """
+    proxies = [d for d in proxies if d.is_started()]
+    processes = []
+    deadline = _now() + grace
+    for d in proxies:
+        d._request_exit(deadline)
+        processes.append(d.p)
+
+    alive = _join_all(processes, grace)
+    if len(alive) > 0:
+        for p in alive:
+            p.terminate()
+        alive = _join_all(alive, grace)
+        for p in alive:
+            _kill(p)
+        _join_all(alive, grace)
+
+    for d in proxies:
+        if not d.p.is_alive():
+            d._destroy_segments()
+        d.logger.info('[%s] Terminated successfully' % d)
+
+
+def _join_all(processes,  # type: List[Union[mp.Process, ForkedProcess]]
+              timeout     # type: float
+              ):
+    # type: (...) -> List[Union[mp.Process, ForkedProcess]]
+    """
+    Waits until all `processes` have exited, or `timeout` seconds have elapsed. The processes are waited for together
+    when possible (using their sentinel, or their pipe for forked daemons).
+
+    :param processes:
+    :param timeout:
+    :return: the processes still alive
+    """
+    deadline = _now() + timeout
+    alive = list(processes)
+    while len(alive) > 0:
+        remaining = max(deadline - _now(), 0)
+        if _wait is None:
+            # python 2: wait for each process in turn
+            for p in alive:
+                p.join(max(deadline - _now(), 0))
+        else:
+            waitables = [p._conn if isinstance(p, ForkedProcess) else p.sentinel for p in alive]
+            _wait(waitables, remaining)
+            for p in alive:
+                if isinstance(p, ForkedProcess):
+                    # consume what the daemon sent and detect the end of the pipe
+                    p.join(0)
+        alive = [p for p in alive if p.is_alive()]
+        if remaining == 0:
+            break
+    return alive
+
+
+def _kill(p  # type: Union[mp.Process, ForkedProcess]
+          ):
+    """Sends SIGKILL to the process `p`, or terminates it on platforms without SIGKILL"""
+    if isinstance(p, ForkedProcess):
+        p.kill()
+    elif hasattr(p, 'kill'):  # python 3.7+
+        p.kill()
+    elif hasattr(signal, 'SIGKILL'):
+        try:
+            os.kill(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    else:
+        p.terminate()
 
 
 ObjectDaemonProxy = DaemonProxy
 """Old alias"""
 
 
+def _acquire(lock,
+             timeout  # type: float
+             ):
+    # type: (...) -> bool
+    """Acquires `lock` within `timeout` seconds if possible. On python 2 locks are acquired without timeout"""
+    if PY2:
+        return lock.acquire()
+    return lock.acquire(True, max(timeout, 0))
+
+
+class ForkedProcess(object):
+    """
+    A minimal process handle for a daemon forked from a template daemon, exposing the subset of the `mp.Process` API
+    used by `DaemonProxy`. Since the forked daemon is not a child of this process, its end is detected when its pipe is
+    closed.
+    """
+    __slots__ = 'pid', '_conn', '_transport', '_exited'
+
+    def __init__(self,
+                 pid,       # type: int
+                 conn,
+                 transport  # type: Transport
+                 ):
+        self.pid = pid
+        self._conn = conn
+        self._transport = transport
+        self._exited = False
+
+    def join(self,
+             timeout=None  # type: float
+             ):
+        """
+        Waits until the forked daemon closes its end of the pipe, which it does when it exits. The messages received in
+        the meantime are dropped (see `Transport.discard`).
+
+        :param timeout:
+        :return:
+        """
+        if not self._exited:
+            try:
+                # poll returns as soon as there is something to read, or the other end is closed
+                while self._conn.poll(timeout):
+                    self._transport.discard(self._conn)
+            except (EOFError, OSError):
+                self._exited = True
+
+    def is_alive(self):
+        # type: (...) -> bool
+        """Returns False once the forked daemon is known to have exited"""
+        return not self._exited
+
+    def terminate(self):
+        """Sends SIGTERM to the forked daemon if it did not exit yet"""
+        self._signal(signal.SIGTERM)
+
+    def kill(self):
+        """Sends SIGKILL to the forked daemon if it did not exit yet"""
+        self._signal(getattr(signal, 'SIGKILL', signal.SIGTERM))
+
+    def _signal(self, signum):
+        if not self._exited:
+            try:
+                os.kill(self.pid, signum)
+            except OSError:
+                pass
+
+
+class ForkedDaemonProxy(DaemonProxy):
+    """
+    A `DaemonProxy` connected to a daemon forked from another daemon. See `DaemonProxy.fork`.
+    """
+    def __init__(self,
+                 template,               # type: DaemonProxy
+                 logger=None,            # type: Logger
+                 attr_cache_policy=None  # type: Union[str, float]
+                 ):
+        """
+        Forks the daemon of `template` and connects to the forked daemon. It uses the `timeout` of `template`, but
+        forked daemons are never restarted when a call times out.
+
+        :param template: the proxy of the daemon to fork
+        :param logger: an optional logger. By default the logger of `template` is used.
+        :param attr_cache_policy: an optional attribute cache policy. By default the policy of `template` is used.
+        """
+        if not hasattr(os, 'fork'):
+            raise ValueError("Daemons can only be forked on platforms supporting `os.fork`")
+
+        self._init_client(template.instance_type, template.is_multi_object, logger=logger or template.logger,
+                          attr_cache_policy=attr_cache_policy if attr_cache_policy is not None
+                          else template.attr_cache.policy, results_by_ref=template.results_by_ref,
+                          iter_chunksize=template.iter_chunksize, iter_prefetch=template.iter_prefetch,
+                          coalesce_writes=template.coalesce_writes, timeout=template.timeout,
+                          transport=template.transport)
+
+        self.logger.info('[%s] forking daemon...' % template)
+        # create the pipe under the spawn lock so that it is not inherited by processes spawned concurrently
+        with _spawn_lock:
+            parent_conn, child_conn = mp.Pipe()
+            try:
+                # the child end of the pipe is sent to the template daemon, who passes it to the forked daemon
+                pid = template.remote_call_using_pipe(FORK_CMD, to_execute_args=(child_conn, ))
+            finally:
+                child_conn.close()
+
+        self.parent_conn = CommChannel(parent_conn)
+        self.p = ForkedProcess(pid, parent_conn, self.transport)
+
+        # make sure that the forked daemon is ready
+        self._handle_response(self._recv_response(START_REQ_ID))
+        self.logger.info('[%s] forking daemon... DONE. PID=%s' % (template, pid))
+        self.started = True
+
+
+class PendingResponse(object):
+    """
+    Represents the response to a command sent with `DaemonProxy.remote_call_nowait`, that has not been received yet.
+    """
+    __slots__ = 'daemon', 'req_id', 'log_errors', '_done', '_result', '_error'
+
+    def __init__(self,
+                 daemon,     # type: DaemonProxy
+                 req_id,     # type: int
+                 log_errors  # type: bool
+                 ):
+        self.daemon = daemon
+        self.req_id = req_id
+        self.log_errors = log_errors
+        self._done = False
+        self._result = None
+        self._error = None
+
+    def __repr__(self):
+        return 'PendingResponse<%s#%s>' % (self.daemon, self.req_id)
+
+    def result(self,
+               timeout=None  # type: float
+               ):
+        """
+        Waits for the response and returns its contents, or raises the error received from the daemon.
+
+        :param timeout: an optional maximum time to wait, in seconds. See `DaemonProxy.wait_for_response`
+        :return:
+        """
+        if not self._done:
+            try:
+                self._result = self.daemon.wait_for_response(self.req_id, log_errors=self.log_errors, timeout=timeout)
+            except Exception as e:
+                self._error = e
+            self._done = True
+
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def discard(self):
+        """
+        Declares that the response will not be waited for, so that it is dropped when received.
+
+        :return:
+        """
+        if not self._done:
+            self.daemon.discard_response(self.req_id)
+            self._done = True
+
+
+class BatchOperation(object):
+    """
+    An operation recorded in a `RemoteBatch`. Once the batch has been executed, its result is available through
+    `result()`.
+    """
+    __slots__ = 'kind', 'names', 'args', 'kwargs', 'dropped', '_recorder', '_outcome'
+
+    def __init__(self,
+                 kind,        # type: int
+                 names,       # type: List[str]
+                 args=(),     # type: Tuple[Any]
+                 kwargs=None  # type: Dict[str, Any]
+                 ):
+        self.kind = kind
+        self.names = names
+        self.args = args
+        self.kwargs = kwargs if kwargs is not None else dict()
+        self.dropped = False
+        self._recorder = None  # a weak reference to the recorder of an attribute read
+        self._outcome = None
+
+    def __repr__(self):
+        return 'BatchOperation<%s %s>' % ({BATCH_GET: 'get', BATCH_CALL: 'call', BATCH_SET: 'set'}[self.kind],
+                                          '.'.join(str(n) for n in self.names))
+
+    def to_msg(self):
+        return self.kind, self.names, self.args, self.kwargs
+
+    def is_needed(self):
+        # type: (...) -> bool
+        """
+        Returns False if this operation is an attribute read that was only recorded to get to its own attributes. It is
+        still needed if its recorder has been kept by user code (`x = b.a; x.b`), since its result is then expected.
+
+        :return:
+        """
+        return not self.dropped or (self._recorder is not None and self._recorder() is not None)
+
+    def result(self):
+        """
+        Returns the result of this operation, or raises the error that happened on the daemon side.
+
+        :return:
+        """
+        if self._outcome is None:
+            raise ValueError("%r has not been executed" % self)
+        flag, contents = self._outcome
+        if flag == ERR_FLAG:
+            raise contents
+        return contents
+
+
+class BatchRecorder(object):
+    """
+    Records the attribute reads, assignments and calls made on it in a `RemoteBatch`. Attribute reads return new
+    recorders, and calls return the corresponding `BatchOperation`.
+
+    An attribute read that is only used to get to its own attributes (`b.a.b`) is not executed, unless its recorder is
+    kept (`x = b.a; y = x.b`): its result is then in the batch results too.
+    """
+    __slots__ = '_batch', '_names', '_op', '__weakref__'
+
+    def __init__(self,
+                 batch,   # type: RemoteBatch
+                 names,   # type: List[str]
+                 op=None  # type: BatchOperation
+                 ):
+        self._batch = batch
+        self._names = names
+        self._op = op
+
+    def __getattr__(self, item):
+        if self._op is not None and self._op.kind == BATCH_GET:
+            # this attribute was only read to get to its own attribute
+            self._op.dropped = True
+        op = self._batch._record(BatchOperation(BATCH_GET, self._names + [item]))
+        recorder = BatchRecorder(self._batch, self._names + [item], op)
+        op._recorder = ref(recorder)
+        return recorder
+
+    def __setattr__(self, key, value):
+        if key in BatchRecorder.__slots__:
+            super(BatchRecorder, self).__setattr__(key, value)
+            return
+        if self._op is not None:
+            if self._op.kind != BATCH_GET:
+                raise ValueError("Only attributes of the recorded object can be set in a batch")
+            # this attribute was only read to get to its own attribute
+            self._op.dropped = True
+        self._batch._record(BatchOperation(BATCH_SET, self._names + [key], (value, )))
+
+    def __call__(self, *args, **kwargs):
+        if self._op is not None:
+            if self._op.kind != BATCH_GET or self._op.dropped:
+                raise ValueError("Only attributes of the recorded object can be called in a batch")
+            # this attribute was only read to be called
+            self._op.dropped = True
+        return self._batch._record(BatchOperation(BATCH_CALL, self._names, args, kwargs))
+
+    def __repr__(self):
+        return 'BatchRecorder<%s>' % '.'.join(self._names)
+
+
+class RemoteBatch(object):
+    """
+    A context manager recording calls and attribute reads, and sending them to the daemon in a single message on exit.
+    See `DaemonProxy.batch`.
+    """
+    __slots__ = 'daemon', 'names', 'stop_on_error', '_ops', 'results'
+
+    def __init__(self,
+                 daemon,             # type: DaemonProxy
+                 names=None,         # type: List[str]
+                 stop_on_error=True  # type: bool
+                 ):
+        self.daemon = daemon
+        self.names = list(names) if names is not None else []
+        self.stop_on_error = stop_on_error
+        self._ops = []
+        self.results = None
+
+    def _record(self,
+                op  # type: BatchOperation
+                ):
+        # type: (...) -> BatchOperation
+        self._ops.append(op)
+        return op
+
+    def __enter__(self):
+        # type: (...) -> BatchRecorder
+        return BatchRecorder(self, self.names)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.execute()
+
+    def execute(self):
+        # type: (...) -> List[Any]
+        """
+        Sends all recorded operations to the daemon in a single message. The `results` attribute is then the list of
+        the results of all operations (errors for the ones that failed), in the order in which they were recorded. If
+        `stop_on_error` is True, the first error is raised.
+
+        :return: the list of results
+        """
+        ops = [op for op in self._ops if op.is_needed()]
+        self._ops = []
+        if len(ops) == 0:
+            self.results = []
+            return self.results
+
+        outcomes = self.daemon.remote_call_using_pipe(EXEC_CMD, execute_batch, ops=[op.to_msg() for op in ops],
+                                                      stop_on_error=self.stop_on_error)
+        for op, outcome in zip(ops, outcomes):
+            op._outcome = outcome
+        self.results = [contents for _, contents in outcomes]
+
+        if self.stop_on_error and len(outcomes) > 0 and outcomes[-1][0] == ERR_FLAG:
+            raise outcomes[-1][1]
+        return self.results
+
+
+class LazyProxy(object):
+    """
+    Records an expression made of attribute reads, calls and item reads, to evaluate it in the daemon in a single round
+    trip when a value is needed. See `DaemonProxy.lazy`.
+
+    Each operation returns a new `LazyProxy`, so expressions may be shared and extended. Dunder attributes are not
+    recorded, and remote attributes named `fetch` can not be read through a `LazyProxy`.
+    """
+    __slots__ = '_daemon', '_names', '_ops'
+
+    def __init__(self,
+                 daemon,  # type: DaemonProxy
+                 names,   # type: List[Union[str, RemoteHandle]]
+                 ops=()   # type: Tuple[Tuple[Any, ...], ...]
+                 ):
+        self._daemon = daemon
+        self._names = names
+        self._ops = ops
+
+    def __repr__(self):
+        expr = ''.join('.' + str(n) for n in self._names)
+        for op in self._ops:
+            if op[0] == LAZY_GETATTR:
+                expr += '.' + op[1]
+            elif op[0] == LAZY_CALL:
+                expr += '(...)'
+            else:
+                expr += '[%r]' % (op[1], )
+        return 'LazyProxy<%s%s>' % (self._daemon, expr)
+
+    def _then(self, *op):
+        # type: (...) -> LazyProxy
+        return LazyProxy(self._daemon, self._names, self._ops + (op, ))
+
+    def __getattr__(self, item):
+        if item.startswith('__') and item.endswith('__'):
+            # do not record protocol lookups (copy, pickle...)
+            raise AttributeError(item)
+        return self._then(LAZY_GETATTR, item)
+
+    def __call__(self, *args, **kwargs):
+        return self._then(LAZY_CALL, args, kwargs)
+
+    def __getitem__(self, key):
+        return self._then(LAZY_GETITEM, key)
+
+    def fetch(self):
+        """
+        Evaluates the expression in the daemon, and returns its value.
+
+        :return:
+        """
+        return self._daemon.remote_call_using_pipe(EXEC_CMD, evaluate_expression, names=self._names,
+                                                   ops=list(self._ops))
+
+    def _apply(self, func, *args):
+        """Evaluates the expression in the daemon, and returns `func(value, *args)`"""
+        return self._daemon.remote_call_using_pipe(EXEC_CMD, evaluate_expression, names=self._names,
+                                                   ops=list(self._ops) + [(LAZY_APPLY, func, args)])
+
+    def __iter__(self):
+        handle_id = self._daemon.remote_call_using_pipe(EXEC_CMD, evaluate_expression, names=self._names,
+                                                        ops=list(self._ops), iterate=True)
+        return RemoteIterator(self._daemon, RemoteHandle(self._daemon, handle_id),
+                              chunksize=self._daemon.iter_chunksize, prefetch=self._daemon.iter_prefetch)
+
+    __hash__ = None
+
+    def __eq__(self, other):
+        return self._apply(operator.eq, other)
+
+    def __ne__(self, other):
+        return self._apply(operator.ne, other)
+
+    def __lt__(self, other):
+        return self._apply(operator.lt, other)
+
+    def __le__(self, other):
+        return self._apply(operator.le, other)
+
+    def __gt__(self, other):
+        return self._apply(operator.gt, other)
+
+    def __ge__(self, other):
+        return self._apply(operator.ge, other)
+
+    def __contains__(self, item):
+        return self._apply(operator.contains, item)
+
+    def __str__(self):
+        return self._apply(str)
+
+    def __len__(self):
+        return self._apply(len)
+
+    def __bool__(self):
+        return self._apply(bool)
+
+    __nonzero__ = __bool__  # python 2
+
+    def __int__(self):
+        return self._apply(int)
+
+    def __float__(self):
+        return self._apply(float)
+
+
 class UnknownException(Exception):
     __slots__ = 'info',
 
@@ -468,6 +2764,44 @@ class UnknownException(Exception):
         return "Unknown exception happened on the daemon side: %s" % self.info
 
 
+class DaemonTimeoutError(TimeoutError):
+    """
+    Raised when the response to a remote call is not received in time (see the `timeout` argument of `DaemonProxy`).
+    The response is dropped if it is received later.
+    """
+
+
+class DaemonRestartedError(Exception):
+    """
+    Raised when waiting for the response to a remote call sent to a daemon that was restarted since then (see
+    `DaemonProxy.restart`).
+    """
+
+
+class DaemonDiedError(Exception):
+    """
+    Raised when the daemon process died (for example killed by the system when out of memory, or after a crash in a
+    C extension) while or before a remote call was waited for. `exitcode` is the exit code of the process, and
+    `signal` the number of the signal that killed it, if known.
+    """
+    def __init__(self,
+                 daemon_repr,  # type: str
+                 exitcode      # type: int
+                 ):
+        self.exitcode = exitcode
+        self.signal = -exitcode if exitcode is not None and exitcode < 0 else None
+        if self.signal is not None:
+            try:
+                cause = 'killed by signal %s' % signal.Signals(self.signal).name
+            except (AttributeError, ValueError):
+                cause = 'killed by signal %s' % self.signal
+        elif exitcode is not None:
+            cause = 'exit code %s' % exitcode
+        else:
+            cause = 'connection closed'
+        super(DaemonDiedError, self).__init__('[%s] The daemon died (%s)' % (daemon_repr, cause))
+
+
 class DaemonCouldNotSendMsgError(Exception):
     __slots__ = 'flag', 'exc'
 
@@ -505,6 +2839,11 @@ class DaemonCouldNotSendMsgError(Exception):
 
 def daemon(conn,
            obj_instance_or_definition,  # type: Union[Any, InstanceDefinition, ScriptDefinition]
+           transport=None,              # type: Transport
+           threads=None,                # type: int
+           thread_safe=None,            # type: Union[bool, Set[str]]
+           heartbeat_conn=None,
+           remote_type=False            # type: bool
            ):
     """
     Implements a daemon connected to the multiprocessing Pipe provided as first argument.
@@ -519,8 +2858,36 @@ def daemon(conn,
     :param conn: the pipe connection (on windows a PipeConnection instance, but behaviour is different on linux)
     :param obj_instance_or_definition: either an object instance to be used to execute the commands, or an
     InstanceDefinition to be used to instantiate the object locally.
+    :param transport: the `Transport` used to exchange messages with the client. It should be the same than the one
+        used by the client.
+    :param threads: an optional number of threads executing the calls to thread-safe methods (see
+        `is_thread_safe_call`) concurrently. Other commands are executed by the main thread once the thread-safe calls
+        received before them are done, and before the next ones start. By default all commands are executed by the
+        main thread, one at a time.
+    :param thread_safe: see `is_thread_safe_call`
+    :param heartbeat_conn: an optional connection on which the heartbeats are answered by a dedicated thread, see
+        `DaemonProxy.ping`
+    :param remote_type: if True, a `TypeDescriptor` of the object's type is sent to the client once started, instead
+        of a message, so that the client does not need to import it. The types of its attributes and of the results
+        kept by reference are described too, see `get_sendable_type`. See `DaemonProxy`.
     :return:
     """
+    if transport is None:
+        transport = Transport()
+    send_lock = Lock()
+
+    def reply(req_id, flag, contents):
+        # responses may be sent concurrently by the threads of the pool
+        with send_lock:
+            safe_conn_send(conn, req_id, flag, contents, transport=transport)
+
+    def execute_and_reply(req_id, to_execute, to_execute_args, to_execute_kwargs):
+        try:
+            flag, contents = execute_command(impl, to_execute, to_execute_args, to_execute_kwargs)
+            reply(req_id, flag, contents)
+        finally:
+            exec_lock.release_shared()
+
     try:
         # default logger
         # TODO (even local import) does not work
@@ -535,86 +2902,316 @@ def daemon(conn,
         print_prefix = '[' + pid + '] Daemon'
         print(print_prefix + ' started using python interpreter: ' + exe)
 
+        # the pipes and sockets open before the implementation is created were inherited from the parent process
+        start_fds = _list_ipc_fds()
+
+        if heartbeat_conn is not None:
+            heartbeat_thread = Thread(target=_answer_heartbeats, args=(heartbeat_conn, ), name='spawny-heartbeat')
+            heartbeat_thread.daemon = True
+            heartbeat_thread.start()
+
         # --init implementation
-        if isinstance(obj_instance_or_definition, InstanceDefinition):
-            impl = obj_instance_or_definition.instantiate()
-        elif isinstance(obj_instance_or_definition, ScriptDefinition):
-            impl = obj_instance_or_definition.execute()
-        elif isinstance(obj_instance_or_definition, ModuleDefinition):
-            impl = obj_instance_or_definition.execute()
-        else:
-            # the object was entirely transfered on the wire by the client.
-            impl = obj_instance_or_definition
+        impl = create_impl(obj_instance_or_definition, remote_type=remote_type)
 
     except Exception as e:
         # normal exception
-        safe_conn_send(conn, ERR_FLAG, e)
+        safe_conn_send(conn, START_REQ_ID, ERR_FLAG, e, transport=transport)
 
     except:
         # system exit exception - lets alert the client, still
-        safe_conn_send(conn, ERR_FLAG, UnknownException())
+        safe_conn_send(conn, START_REQ_ID, ERR_FLAG, UnknownException(), transport=transport)
 
     else:
         # declare that we are correctly started
-        safe_conn_send(conn, OK_FLAG, "%s started" % print_prefix)
+        started_msg = TypeDescriptor.create_from(impl.__class__) if remote_type else "%s started" % print_prefix
+        safe_conn_send(conn, START_REQ_ID, OK_FLAG, started_msg, transport=transport)
+
+        # the daemons forked from this one, that should be reaped when they exit
+        forked_pids = set()
+        # the pipes and sockets inherited from the parent process (for example the write end of the process sentinel),
+        # that should not be kept open by the forked daemons, otherwise the end of this daemon could not be detected
+        inherited_fds = None
+        # the thread-safe calls are executed by the pool while holding the lock in shared mode, other commands hold it
+        # in exclusive mode
+        if threads is not None:
+            pool = _ThreadPool(threads)
+            exec_lock = SharedExclusiveLock()
+        else:
+            pool = exec_lock = None
 
         # --while there are incoming messages in the pipe, handle them
         while True:
             # retrieve next message (blocks until there is one)
-            cmd_type, to_execute, to_execute_args, to_execute_kwargs = conn.recv()
+            req_id, cmd_type, to_execute, to_execute_args, to_execute_kwargs = transport.recv(conn)
+            if forked_pids:
+                _reap_forked(forked_pids)
+
+            if pool is not None and cmd_type in (EXIT_CMD, FORK_CMD):
+                # wait for the calls in flight
+                exec_lock.acquire_exclusive()
+                exec_lock.release_exclusive()
+
             if cmd_type == EXIT_CMD:
                 print(print_prefix + '  was asked to exit - closing communication connection')
                 conn.close()
                 break
-            else:
+            elif cmd_type == RELEASE_CMD:
+                for handle_id in to_execute_args:
+                    _handles.pop(handle_id, None)
+            elif cmd_type == FORK_CMD:
+                forked_conn = to_execute_args[0]
+                if inherited_fds is None:
+                    inherited_fds = start_fds - {conn.fileno(), forked_conn.fileno()}
+                sys.stdout.flush()
                 try:
-                    # var args defaults
-                    if to_execute_args is None:
-                        to_execute_args = ()
-                    if to_execute_kwargs is None:
-                        to_execute_kwargs = dict()
-
-                    # Execute the desired command
-                    results = to_execute(impl, *to_execute_args, **to_execute_kwargs)
-
+                    forked_pid = os.fork()
                 except Exception as e:
-                    # Normal exception: return error in communication pipe
-                    safe_conn_send(conn, ERR_FLAG, e)
-
-                except:
-                    # system exit exception - lets alert the client, still
-                    safe_conn_send(conn, ERR_FLAG, UnknownException())
-
+                    forked_conn.close()
+                    reply(req_id, ERR_FLAG, e)
+                    continue
+
+                if forked_pid == 0:
+                    # forked daemon: serve the new connection with the same implementation
+                    conn.close()
+                    conn = forked_conn
+                    _close_fds(inherited_fds)
+                    forked_pids = set()
+                    inherited_fds = set()
+                    # the handles belong to the clients of the template daemon
+                    _handles.clear()
+                    # the threads were not forked
+                    send_lock = Lock()
+                    if pool is not None:
+                        pool = _ThreadPool(threads)
+                        exec_lock = SharedExclusiveLock()
+                    pid = str(os.getpid())
+                    print_prefix = '[' + pid + '] Daemon'
+                    print(print_prefix + ' forked')
+                    safe_conn_send(conn, START_REQ_ID, OK_FLAG, "%s started" % print_prefix, transport=transport)
+                else:
+                    # template daemon: the new connection is now owned by the forked daemon
+                    forked_conn.close()
+                    forked_pids.add(forked_pid)
+                    reply(req_id, OK_FLAG, forked_pid)
+            elif pool is None:
+                flag, contents = execute_command(impl, to_execute, to_execute_args, to_execute_kwargs)
+                reply(req_id, flag, contents)
+            else:
+                # the references contained in the message were resolved by this thread
+                error = pop_reference_error()
+                if error is not None:
+                    reply(req_id, ERR_FLAG, error)
+                elif is_thread_safe_call(impl, to_execute, to_execute_kwargs, thread_safe):
+                    exec_lock.acquire_shared()
+                    pool.submit(execute_and_reply, req_id, to_execute, to_execute_args, to_execute_kwargs)
                 else:
-                    # success: return results in communication pipe
-                    safe_conn_send(conn, OK_FLAG, results)
+                    exec_lock.acquire_exclusive()
+                    try:
+                        flag, contents = execute_command(impl, to_execute, to_execute_args, to_execute_kwargs)
+                    finally:
+                        exec_lock.release_exclusive()
+                    reply(req_id, flag, contents)
 
     finally:
         # out of the while loop
         print(print_prefix + '  terminating')
 
 
-def safe_conn_send(conn, flag, contents):
+def _answer_heartbeats(conn):
+    """Sends back the heartbeats received on `conn` until it is closed"""
+    try:
+        while True:
+            conn.send(conn.recv())
+    except (EOFError, OSError):
+        pass
+
+
+def create_impl(obj_instance_or_definition,  # type: Union[Any, Definition]
+                remote_type=False            # type: bool
+                ):
+    """
+    Creates the object served by a daemon from the object instance or definition provided by the client, and registers
+    it as the object against which the references received are resolved (see `resolve_reference`).
+
+    :param obj_instance_or_definition:
+    :param remote_type: if True, the types sent to the client are described with a `TypeDescriptor` (see
+        `get_sendable_type`)
+    :return:
+    """
+    global _daemon_impl, _remote_types
+    if isinstance(obj_instance_or_definition, InstanceDefinition):
+        impl = obj_instance_or_definition.instantiate()
+    elif isinstance(obj_instance_or_definition, ScriptDefinition):
+        impl = obj_instance_or_definition.execute()
+    elif isinstance(obj_instance_or_definition, ModuleDefinition):
+        impl = obj_instance_or_definition.execute()
+    else:
+        # the object was entirely transfered on the wire by the client.
+        impl = obj_instance_or_definition
+    _daemon_impl = impl
+    _remote_types = remote_type
+    return impl
+
+
+def pop_reference_error():
+    # type: (...) -> Exception
+    """
+    Returns the first error raised when resolving the references contained in the last message received by the current
+    thread (see `resolve_reference`), or None, and forgets them.
+
+    :return:
+    """
+    errors = getattr(_receiving, 'reference_errors', None)
+    if errors:
+        _receiving.reference_errors = []
+        return errors[0]
+    return None
+
+
+def execute_command(impl,
+                    to_execute,         # type: Union[str, Callable[[Any], Any]]
+                    to_execute_args,    # type: Iterable[Any]
+                    to_execute_kwargs   # type: Dict[str, Any]
+                    ):
+    # type: (...) -> Tuple[bool, Any]
+    """
+    Executes an EXEC_CMD command received by a daemon, and returns the flag and contents of the response to send back:
+    the results, or the exception raised.
+
+    :param impl: the object served by the daemon
+    :param to_execute: the function to execute, or the name of one of the `COMMANDS`
+    :param to_execute_args:
+    :param to_execute_kwargs:
+    :return:
+    """
+    try:
+        # the references contained in the message could not be resolved
+        error = pop_reference_error()
+        if error is not None:
+            raise error
+
+        # commands may be sent by name
+        if isinstance(to_execute, string_types):
+            to_execute = COMMANDS[to_execute]
+
+        # var args defaults
+        if to_execute_args is None:
+            to_execute_args = ()
+        if to_execute_kwargs is None:
+            to_execute_kwargs = dict()
+
+        # Execute the desired command
+        return OK_FLAG, to_execute(impl, *to_execute_args, **to_execute_kwargs)
+
+    except Exception as e:
+        # Normal exception: return it to the client
+        return ERR_FLAG, e
+
+    except:
+        # system exit exception - lets alert the client, still
+        return ERR_FLAG, UnknownException()
+
+
+def _list_ipc_fds():
+    # type: (...) -> Set[int]
+    """
+    Returns the file descriptors of the pipes and sockets currently open in this process, except the ones used by the
+    standard streams and by multiprocessing's resource tracker. Returns an empty set if they can not be listed on this
+    platform.
+
+    :return:
+    """
+    for fd_dir in ('/proc/self/fd', '/dev/fd'):
+        try:
+            fds = set(int(fd) for fd in os.listdir(fd_dir))
+        except (OSError, ValueError):
+            continue
+        else:
+            break
+    else:
+        return set()
+
+    fds.difference_update((0, 1, 2))
+    for stream in (sys.stdin, sys.stdout, sys.stderr):
+        try:
+            fds.discard(stream.fileno())
+        except Exception:
+            pass
+    try:
+        from multiprocessing.resource_tracker import _resource_tracker
+        fds.discard(_resource_tracker._fd)
+    except (ImportError, AttributeError):
+        pass
+
+    ipc_fds = set()
+    for fd in fds:
+        try:
+            mode = os.fstat(fd).st_mode
+        except OSError:
+            continue
+        if stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode):
+            ipc_fds.add(fd)
+    return ipc_fds
+
+
+def _close_fds(fds  # type: Set[int]
+               ):
+    """
+    Closes all file descriptors in `fds` that are still open.
+
+    :param fds:
+    :return:
+    """
+    for fd in fds:
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+
+def _reap_forked(forked_pids  # type: Set[int]
+                 ):
+    """
+    Collects the exit status of the forked daemons that have exited, so that they do not remain as zombies.
+
+    :param forked_pids: the pids of the forked daemons. The ones that have exited are removed.
+    :return:
+    """
+    for forked_pid in list(forked_pids):
+        try:
+            done_pid, _ = os.waitpid(forked_pid, os.WNOHANG)
+        except OSError:
+            # not our child anymore
+            done_pid = forked_pid
+        if done_pid != 0:
+            forked_pids.remove(forked_pid)
+
+
+def safe_conn_send(conn, req_id, flag, contents, transport=None):
     """
     Sends a message to the connection, and if sending failed, sends a `DaemonCouldNotSendMsgError` over the pipe.
 
     :param conn:
+    :param req_id: the id of the request that this message responds to
     :param flag:
     :param contents:
+    :param transport: the `Transport` to use. By default messages are sent with `conn.send`
     :return:
     """
+    send = conn.send if transport is None else (lambda msg: transport.send(conn, msg))
     try:
         try:
-            conn.send((flag, contents))
+            send((req_id, flag, contents))
         except Exception as e1:
             # there was an error sending the contents, try to send that error
-            conn.send((ERR_FLAG, DaemonCouldNotSendMsgError.create_from(flag, contents, e1)))
+            send((req_id, ERR_FLAG, DaemonCouldNotSendMsgError.create_from(flag, contents, e1)))
         except:
             # there was an error sending the contents, try to send that error
-            conn.send((ERR_FLAG, DaemonCouldNotSendMsgError.create_from(flag, contents, UnknownException())))
+            send((req_id, ERR_FLAG, DaemonCouldNotSendMsgError.create_from(flag, contents, UnknownException())))
     except:
         # last resort
-        conn.send((ERR_FLAG, DaemonCouldNotSendMsgError.create_from(flag, contents, UnknownException(use_sys=False))))
+        send((req_id, ERR_FLAG, DaemonCouldNotSendMsgError.create_from(flag, contents,
+                                                                       UnknownException(use_sys=False))))
 
 # def exec_cmd_and_send_results(conn,
 #                               impl,           # type: Any
@@ -0,0 +1,346 @@
+import asyncio
+import sys
+from collections import deque
+from functools import partial
+
+try:  # python 3.5+
+    from typing import Union, Any, List, Dict, Iterable, Callable, Optional, Tuple
+except ImportError:
+    pass
+
+from spawny.main import DaemonProxy, DaemonDiedError, EXEC_CMD, MAX_UNANSWERED_BYTES, get_object, \
+    call_method_on_object
+from spawny.main_remotes_and_defs import Definition
+
+
+def _get_running_loop():
+    # type: (...) -> asyncio.AbstractEventLoop
+    """Returns the running event loop. Before python 3.7, returns the current event loop"""
+    if sys.version_info >= (3, 7):
+        return asyncio.get_running_loop()
+    else:
+        return asyncio.get_event_loop()
+
+
+class AsyncObjectProxy(object):
+    """
+    Represents a proxy to an object, where all remote interactions return awaitables. It relies on an
+    `AsyncDaemonProxy` to communicate.
+
+    Contrary to `ObjectProxy`, attribute access does not perform any round trip with the daemon: `proxy.a.b` is a
+    new `AsyncObjectProxy` for path `['a', 'b']`. You may then
+
+     - `await proxy.a.b` to fetch the value of the remote attribute
+     - `await proxy.a.b(*args, **kwargs)` to call it remotely
+    """
+    __slots__ = '_daemon', '_names'
+
+    def __init__(self,
+                 daemon,           # type: AsyncDaemonProxy
+                 child_names=None  # type: List[str]
+                 ):
+        self._daemon = daemon
+        self._names = child_names if child_names is not None else []
+
+    def __getattr__(self, item):
+        return AsyncObjectProxy(self._daemon, self._names + [item])
+
+    def __call__(self, *args, **kwargs):
+        return self._daemon.remote_call_async(EXEC_CMD, call_method_on_object, names=self._names,
+                                              to_execute_args=args, **kwargs)
+
+    def __await__(self):
+        return self._daemon.remote_call_async(EXEC_CMD, get_object, names=self._names).__await__()
+
+    def __repr__(self):
+        return 'AsyncObjectProxy<%s%s>' % (self._daemon, ''.join('.' + n for n in self._names))
+
+
+class AsyncDaemonProxy(DaemonProxy):
+    """
+    A `DaemonProxy` whose remote calls return asyncio futures instead of blocking the calling thread. When the pipe's
+    file descriptor becomes readable (`loop.add_reader`), the responses are received in the default executor so that
+    large messages do not block the event loop, and their futures are completed by the event loop. Many calls to many
+    daemons may therefore be awaited concurrently from a single thread.
+
+    All remote calls must be made from the event loop thread. Use `obj_proxy` (an `AsyncObjectProxy`) to interact
+    with the remote object. Since the responses are only read by the event loop, sending a request can not wait for
+    them to make room in the pipe (see `DaemonProxy.max_unanswered_bytes`): the requests that would exceed it are kept
+    in a local queue instead, and written by the event loop once enough responses are received.
+    """
+    def __init__(self,
+                 obj_instance_or_definition,  # type: Union[Any, Definition]
+                 loop=None,                   # type: asyncio.AbstractEventLoop
+                 max_unanswered_bytes=MAX_UNANSWERED_BYTES,  # type: Optional[int]
+                 **kwargs                     # type: Any
+                 ):
+        """
+        Spawns the daemon exactly as `DaemonProxy` does. Note that this blocks until the daemon is started: from within
+        a coroutine you may prefer `await AsyncDaemonProxy.create(...)`, that runs this constructor in an executor.
+
+        :param obj_instance_or_definition: see `DaemonProxy`
+        :param loop: the event loop that will be used to read the responses. By default the event loop running when the
+            first call is made.
+        :param max_unanswered_bytes: the maximum size in bytes of the requests written and not answered yet, see
+            `DaemonProxy.max_unanswered_bytes`. None disables the limit.
+        :param kwargs: other arguments for `DaemonProxy`, for example `timeout` or `results_by_ref`
+        """
+        self.loop = loop
+        self.max_unanswered_bytes = max_unanswered_bytes
+        self._pending = dict()
+        # the encoded requests waiting for responses to make room in the pipe, in order
+        self._queued = deque()
+        self._reader_registered = False
+        self._sentinel = None
+        self._sentinel_registered = False
+        # True while responses are received in the default executor, see `_start_read`
+        self._reading = False
+        # True once the process sentinel signaled the end of the daemon
+        self._exited = False
+        super(AsyncDaemonProxy, self).__init__(obj_instance_or_definition, **kwargs)
+        self.obj_proxy = AsyncObjectProxy(self)
+
+    @classmethod
+    def create(cls,
+               obj_instance_or_definition,  # type: Union[Any, Definition]
+               loop=None,                   # type: asyncio.AbstractEventLoop
+               **kwargs
+               ):
+        # type: (...) -> asyncio.Future
+        """
+        Returns an awaitable creating an `AsyncDaemonProxy` in the default executor, so as not to block the event loop
+        while the daemon starts.
+
+        :param obj_instance_or_definition:
+        :param loop:
+        :param kwargs: other arguments for the constructor
+        :return:
+        """
+        loop = loop or _get_running_loop()
+        return loop.run_in_executor(None, partial(cls, obj_instance_or_definition, loop=loop, **kwargs))
+
+    def __repr__(self):
+        if not self.is_started():
+            return 'AsyncDaemonProxy<not started>'
+        else:
+            return 'AsyncDaemonProxy<%s>' % self.p.pid
+
+    def remote_call_async(self,
+                          cmd_type,              # type: int
+                          to_execute=None,       # type: Callable[[Any], Any]
+                          to_execute_args=None,  # type: Iterable[Any]
+                          log_errors=True,       # type: bool
+                          **to_execute_kwargs    # type: Dict[str, Any]
+                          ):
+        # type: (...) -> asyncio.Future
+        """
+        Same as `remote_call_using_pipe` but returns a future instead of waiting for the response. Must be called from
+        the event loop thread.
+
+        :param cmd_type: command type (EXEC_CMD only)
+        :param to_execute:
+        :param to_execute_args:
+        :param log_errors:
+        :param to_execute_kwargs:
+        :return:
+        """
+        if cmd_type != EXEC_CMD:
+            raise ValueError('[%s] Only EXEC_CMD commands can be sent asynchronously' % self)
+
+        if not self.is_started():
+            raise Exception('[%s] Cannot perform remote calls - daemon is not started' % self)
+
+        self._ensure_reader()
+        fut = self.loop.create_future()
+        with self._send_lock:
+            req_id, msg = self._encode_command(cmd_type, to_execute, to_execute_args, to_execute_kwargs)
+            if len(self._queued) > 0 or not self._has_room(msg.nbytes):
+                # writing now could block the event loop, that has to read the responses: write it later
+                self._queued.append((req_id, msg))
+            else:
+                self._write_command(req_id, msg, answered=True)
+
+        # the response will be matched by request id
+        self._pending[req_id] = fut, log_errors
+        return fut
+
+    def _has_room(self,
+                  nbytes  # type: int
+                  ):
+        # type: (...) -> bool
+        """Returns True if a request of `nbytes` bytes can be written without exceeding `max_unanswered_bytes`"""
+        return self.max_unanswered_bytes is None or len(self._unanswered) == 0 \
+            or self._unanswered_bytes() + nbytes <= self.max_unanswered_bytes
+
+    def _write_queued(self):
+        """Writes the queued requests that fit in `max_unanswered_bytes`, in order"""
+        with self._send_lock:
+            while len(self._queued) > 0 and self._has_room(self._queued[0][1].nbytes):
+                req_id, msg = self._queued.popleft()
+                self._write_command(req_id, msg, answered=True)
+
+    def _discard_queued(self):
+        """Drops the requests that were not written, destroying their shared memory segments if any"""
+        for _, msg in self._queued:
+            msg.discard()
+        self._queued.clear()
+
+    def remote_call_using_pipe(self,
+                               cmd_type,              # type: int
+                               to_execute=None,       # type: Callable[[Any], Any]
+                               to_execute_args=None,  # type: Iterable[Any]
+                               log_errors=True,       # type: bool
+                               **to_execute_kwargs    # type: Dict[str, Any]
+                               ):
+        if self._pending or self._reading:
+            raise ValueError('[%s] Blocking remote calls are not possible while asynchronous calls are pending'
+                             % self)
+        return super(AsyncDaemonProxy, self).remote_call_using_pipe(cmd_type, to_execute,
+                                                                    to_execute_args=to_execute_args,
+                                                                    log_errors=log_errors, **to_execute_kwargs)
+
+    def _ensure_reader(self):
+        """
+        Registers the pipe's file descriptor on the event loop, if not already done and if no read is in progress. The
+        process sentinel is registered too when it is a file descriptor (unix), so that the end of the daemon is
+        detected even if the pipe stays open.
+        """
+        if self.loop is None:
+            self.loop = _get_running_loop()
+        if not self._reader_registered and not self._reading:
+            self.loop.add_reader(self.parent_conn.conn.fileno(), self._on_readable)
+            self._reader_registered = True
+        if not self._sentinel_registered and not self._exited:
+            self._sentinel = getattr(self.p, 'sentinel', None) if sys.platform != 'win32' else None
+            if self._sentinel is not None:
+                self.loop.add_reader(self._sentinel, self._on_exit)
+                self._sentinel_registered = True
+
+    def _remove_reader(self,
+                       sentinel=True  # type: bool
+                       ):
+        """Stops watching the pipe, and the process sentinel if `sentinel` is True"""
+        if self._reader_registered:
+            self.loop.remove_reader(self.parent_conn.conn.fileno())
+            self._reader_registered = False
+        if sentinel and self._sentinel_registered:
+            self.loop.remove_reader(self._sentinel)
+            self._sentinel_registered = False
+
+    def _on_readable(self):
+        """Callback used by the event loop when responses are available in the pipe"""
+        if not self._pending:
+            # nothing is expected anymore (for example the daemon exited): stop watching the pipe
+            self._remove_reader()
+            return
+        self._start_read()
+
+    def _start_read(self):
+        """
+        Receives the responses available in the pipe in the default executor: receiving a message blocks until it is
+        entirely received, which may take long for large messages. The pipe is not watched until the read is over.
+        """
+        self._remove_reader(sentinel=False)
+        self._reading = True
+        self.loop.run_in_executor(None, self._recv_available).add_done_callback(self._on_received)
+
+    def _recv_available(self):
+        # type: (...) -> Tuple[List[Tuple[int, bool, Any]], Optional[Exception]]
+        """
+        Receives the messages available in the pipe. Executed in the default executor, see `_start_read`.
+
+        :return: a tuple (responses, error) where error is the error raised when the pipe was closed, if any
+        """
+        conn = self.parent_conn.conn
+        responses = []
+        try:
+            while conn.poll():
+                responses.append(self.transport.recv(conn))
+        except (EOFError, OSError) as e:
+            return responses, e
+        return responses, None
+
+    def _on_received(self,
+                     read  # type: asyncio.Future
+                     ):
+        """Callback used by the event loop when the responses were received by `_recv_available`"""
+        self._reading = False
+        try:
+            responses, error = read.result()
+        except Exception as e:
+            # for example a message that could not be decoded
+            self._fail_pending(e)
+            return
+        for res_id, flag, contents in responses:
+            self._mark_answered(res_id)
+            try:
+                fut, log_errors = self._pending.pop(res_id)
+            except KeyError:
+                # not a call that we are waiting for
+                continue
+            if fut.cancelled():
+                continue
+            try:
+                fut.set_result(self._handle_response((flag, contents), log_errors=log_errors))
+            except Exception as e:
+                fut.set_exception(e)
+
+        if not self.is_started() or not self._pending:
+            # terminated, or nothing is expected anymore
+            if error is not None or self._exited:
+                self._remove_reader()
+            return
+        if error is not None:
+            # the daemon is gone
+            died_error = self._died_error()
+            died_error.__cause__ = error
+            self._fail_pending(died_error)
+        elif self._exited:
+            # the daemon ended: read the responses it sent before exiting, if any
+            if self.parent_conn.conn.poll(0):
+                self._start_read()
+            else:
+                self._fail_pending(self._died_error())
+        else:
+            try:
+                if len(self._queued) > 0:
+                    self._write_queued()
+            except DaemonDiedError as e:
+                self._fail_pending(e)
+            else:
+                self._ensure_reader()
+
+    def _on_exit(self):
+        """Callback used by the event loop when the daemon process ended"""
+        self._exited = True
+        self._remove_reader(sentinel=True)
+        if not self._pending:
+            return
+        if not self._reading:
+            # first read the responses it sent before exiting, see `_on_received`
+            self._start_read()
+
+    def _fail_pending(self,
+                      error  # type: DaemonDiedError
+                      ):
+        """Fails all pending calls with `error`, for example since the daemon is gone"""
+        self._remove_reader()
+        self._discard_queued()
+        for fut, _ in self._pending.values():
+            if not fut.cancelled():
+                fut.set_exception(error)
+        self._pending.clear()
+
+    def _request_exit(self,
+                      deadline=None  # type: float
+                      ):
+        """
+        Pending asynchronous calls are cancelled before asking the daemon to exit.
+        :return:
+        """
+        self._remove_reader()
+        self._discard_queued()
+        for fut, _ in self._pending.values():
+            fut.cancel()
+        self._pending.clear()
+        super(AsyncDaemonProxy, self)._request_exit(deadline)
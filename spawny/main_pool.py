@@ -0,0 +1,410 @@
+import multiprocessing as mp
+from collections import deque
+from itertools import islice
+from logging import Logger
+from threading import Condition, Lock, Thread
+
+try:  # python 3.3+
+    from time import monotonic as _now
+except ImportError:
+    from time import time as _now
+
+try:  # python 3.5+
+    from typing import Union, Any, List, Iterable, Callable
+except ImportError:
+    pass
+
+from spawny.main import DaemonProxy, EXEC_CMD, TimeoutError, DEFAULT_TERMINATION_GRACE, call_method_on_object, \
+    call_method_on_chunk, terminate_all
+from spawny.main_remotes_and_defs import Definition
+from spawny.utils_attr_cache import CACHE_NEVER
+from spawny.utils_logging import default_logger
+
+
+SPAWN_RETRY_DELAY = 0.1
+"""The delay before trying to spawn a spare daemon again after a failure, in seconds, see `WarmSpares`"""
+
+MAX_SPAWN_RETRY_DELAY = 10
+"""The maximum delay between two attempts to spawn a spare daemon, in seconds"""
+
+
+class PoolObjectProxy(object):
+    """
+    Represents a proxy to the object hosted by all workers of a `DaemonPool`. Attribute access does not perform any
+    round trip: `proxy.a.b` is a new `PoolObjectProxy` for path `['a', 'b']`. Calling it executes the call on the
+    least busy worker. `map` and `imap` distribute chunks of items across all workers.
+    """
+    __slots__ = '_pool', '_names'
+
+    def __init__(self,
+                 pool,             # type: DaemonPool
+                 child_names=None  # type: List[str]
+                 ):
+        self._pool = pool
+        self._names = child_names if child_names is not None else []
+
+    def __getattr__(self, item):
+        return PoolObjectProxy(self._pool, self._names + [item])
+
+    def __repr__(self):
+        return 'PoolObjectProxy<%s%s>' % (self._pool, ''.join('.' + n for n in self._names))
+
+    def __call__(self, *args, **kwargs):
+        worker_idx = self._pool._acquire_worker()
+        try:
+            return self._pool.workers[worker_idx].remote_call_using_pipe(EXEC_CMD, call_method_on_object,
+                                                                         to_execute_args=args, names=self._names,
+                                                                         **kwargs)
+        finally:
+            self._pool._release_worker(worker_idx)
+
+    def imap(self,
+             iterable,        # type: Iterable[Any]
+             chunksize=1000,  # type: int
+             max_inflight=2   # type: int
+             ):
+        # type: (...) -> Iterable[Any]
+        """
+        Lazy version of `map`: returns an iterator on the results, in order.
+
+        :param iterable:
+        :param chunksize:
+        :param max_inflight: the maximum number of chunks sent in advance, per worker
+        :return:
+        """
+        if chunksize < 1:
+            raise ValueError("chunksize should be strictly positive")
+        if max_inflight < 1:
+            raise ValueError("max_inflight should be strictly positive")
+
+        pool = self._pool
+        it = iter(iterable)
+        pending = deque()
+        try:
+            exhausted = False
+            while True:
+                while not exhausted and len(pending) < max_inflight * len(pool.workers):
+                    chunk = list(islice(it, chunksize))
+                    if len(chunk) == 0:
+                        exhausted = True
+                    else:
+                        worker_idx = pool._acquire_worker()
+                        try:
+                            p = pool.workers[worker_idx].remote_call_nowait(EXEC_CMD, call_method_on_chunk,
+                                                                            chunk=chunk, names=self._names)
+                        except Exception:
+                            pool._release_worker(worker_idx)
+                            raise
+                        pending.append((worker_idx, p))
+                if len(pending) == 0:
+                    break
+
+                worker_idx, p = pending.popleft()
+                try:
+                    results = p.result()
+                finally:
+                    pool._release_worker(worker_idx)
+                for res in results:
+                    yield res
+        finally:
+            for worker_idx, p in pending:
+                p.discard()
+                pool._release_worker(worker_idx)
+
+    def map(self,
+            iterable,        # type: Iterable[Any]
+            chunksize=1000,  # type: int
+            max_inflight=2   # type: int
+            ):
+        # type: (...) -> List[Any]
+        """
+        Applies the remote function on all elements of `iterable` and returns the list of results. Chunks of
+        `chunksize` items are sent to the least busy workers, so that they are processed in parallel.
+
+        :param iterable:
+        :param chunksize:
+        :param max_inflight: the maximum number of chunks sent in advance, per worker
+        :return:
+        """
+        return list(self.imap(iterable, chunksize=chunksize, max_inflight=max_inflight))
+
+
+class DaemonPool(object):
+    """
+    A pool of identical daemons, all created from the same object instance or definition. Calls made through its
+    `obj_proxy` (a `PoolObjectProxy`) are routed to the worker having the fewest calls in flight, so that several
+    threads can use all workers in parallel. This is typically useful for stateless CPU-bound objects.
+    """
+    def __init__(self,
+                 obj_instance_or_definition,    # type: Union[Any, Definition]
+                 size=None,                     # type: int
+                 python_exe=None,               # type: str
+                 logger=default_logger,         # type: Logger
+                 attr_cache_policy=CACHE_NEVER,  # type: Union[str, float]
+                 remote_type=False,             # type: bool
+                 **daemon_kwargs                # type: Any
+                 ):
+        """
+        Creates `size` daemons in parallel, using the same arguments as `DaemonProxy`.
+
+        :param obj_instance_or_definition: see `DaemonProxy`
+        :param size: the number of workers. By default the number of CPUs.
+        :param python_exe: see `DaemonProxy`
+        :param logger: see `DaemonProxy`
+        :param attr_cache_policy: see `DaemonProxy`
+        :param remote_type: see `DaemonProxy`
+        :param daemon_kwargs: other arguments for `DaemonProxy`, for example `shm_threshold` or `timeout`
+        """
+        self._init_pool(lambda: DaemonProxy(obj_instance_or_definition, python_exe=python_exe, logger=logger,
+                                            attr_cache_policy=attr_cache_policy, remote_type=remote_type,
+                                            **daemon_kwargs),
+                        size=size, logger=logger)
+
+    def _init_pool(self,
+                   create_worker,         # type: Callable[[], DaemonProxy]
+                   size=None,             # type: int
+                   logger=default_logger  # type: Logger
+                   ):
+        """
+        Creates the `size` workers of this pool in parallel, by calling `create_worker`.
+
+        :param create_worker: a function returning a new started worker
+        :param size: the number of workers. By default the number of CPUs.
+        :param logger:
+        :return:
+        """
+        if size is None:
+            size = mp.cpu_count()
+        if size < 1:
+            raise ValueError("size should be strictly positive")
+
+        self.logger = logger or default_logger
+        self._lock = Lock()
+        self._inflight = [0] * size
+
+        # --create all workers in parallel
+        workers = [None] * size
+        errors = []
+
+        def _create_worker(i):
+            try:
+                workers[i] = create_worker()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=_create_worker, args=(i, )) for i in range(size)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if len(errors) > 0:
+            terminate_all([w for w in workers if w is not None])
+            raise errors[0]
+
+        self.workers = workers  # type: List[DaemonProxy]
+        self.obj_proxy = PoolObjectProxy(self)
+
+    def __repr__(self):
+        return 'DaemonPool<%s>' % ','.join(str(w.p.pid) for w in self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.terminate()
+
+    def inflight(self):
+        # type: (...) -> List[int]
+        """Returns the number of calls currently in flight for each worker"""
+        with self._lock:
+            return list(self._inflight)
+
+    def _acquire_worker(self):
+        # type: (...) -> int
+        """Returns the index of the worker with the fewest calls in flight, and increments its counter"""
+        with self._lock:
+            worker_idx = min(range(len(self._inflight)), key=self._inflight.__getitem__)
+            self._inflight[worker_idx] += 1
+        return worker_idx
+
+    def _release_worker(self,
+                        worker_idx  # type: int
+                        ):
+        with self._lock:
+            self._inflight[worker_idx] -= 1
+
+    def terminate(self,
+                  grace=DEFAULT_TERMINATION_GRACE  # type: float
+                  ):
+        """
+        Terminates all workers at once, see `terminate_all`.
+
+        :param grace: the time given to the workers to exit before they are terminated with signals, in seconds
+        :return:
+        """
+        terminate_all(self.workers, grace=grace)
+
+
+class WarmSpares(object):
+    """
+    Keeps `spares` daemons started from the same object instance or definition, ready to be handed out with `acquire`.
+    A background thread spawns new daemons as spares are consumed, so that acquiring a daemon does not pay the spawn
+    and initialization cost as long as the spares are not exhausted.
+
+    Acquired daemons belong to the caller, who is responsible for terminating them.
+    """
+    def __init__(self,
+                 obj_instance_or_definition,    # type: Union[Any, Definition]
+                 spares=1,                      # type: int
+                 python_exe=None,               # type: str
+                 logger=default_logger,         # type: Logger
+                 attr_cache_policy=CACHE_NEVER,  # type: Union[str, float]
+                 remote_type=False,             # type: bool
+                 **daemon_kwargs                # type: Any
+                 ):
+        """
+
+        :param obj_instance_or_definition: see `DaemonProxy`
+        :param spares: the number of started daemons to keep ready
+        :param python_exe: see `DaemonProxy`
+        :param logger: see `DaemonProxy`
+        :param attr_cache_policy: see `DaemonProxy`
+        :param remote_type: see `DaemonProxy`
+        :param daemon_kwargs: other arguments for `DaemonProxy`, for example `shm_threshold` or `timeout`
+        """
+        if spares < 1:
+            raise ValueError("spares should be strictly positive")
+
+        self.obj_instance_or_definition = obj_instance_or_definition
+        self.spares = spares
+        self.python_exe = python_exe
+        self.logger = logger or default_logger
+        self.attr_cache_policy = attr_cache_policy
+        self.remote_type = remote_type
+        self.daemon_kwargs = daemon_kwargs
+
+        self._ready = deque()
+        self._creating = 0
+        self._error = None
+        self._closed = False
+        self._cond = Condition()
+        self._refill_thread = Thread(target=self._refill, name='spawny-warm-spares')
+        self._refill_thread.daemon = True
+        self._refill_thread.start()
+
+    def __repr__(self):
+        return 'WarmSpares<%s>' % self.obj_instance_or_definition
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def ready_count(self):
+        # type: (...) -> int
+        """Returns the number of daemons ready to be acquired"""
+        with self._cond:
+            return len(self._ready)
+
+    def _refill(self):
+        """
+        Background loop spawning daemons whenever there are less than `spares` ready or being created. When a daemon
+        can not be spawned, the error is reported to the next `acquire` and the spawn is retried after a delay,
+        doubled after each consecutive failure up to `MAX_SPAWN_RETRY_DELAY`.
+        """
+        retry_delay = SPAWN_RETRY_DELAY
+        while True:
+            with self._cond:
+                while not self._closed and len(self._ready) + self._creating >= self.spares:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                self._creating += 1
+
+            try:
+                d = DaemonProxy(self.obj_instance_or_definition, python_exe=self.python_exe, logger=self.logger,
+                                attr_cache_policy=self.attr_cache_policy, remote_type=self.remote_type,
+                                **self.daemon_kwargs)
+            except Exception as e:
+                self.logger.warning('[%s] Could not spawn a spare daemon, retrying in %ss: %r' % (self, retry_delay, e))
+                with self._cond:
+                    self._creating -= 1
+                    self._error = e
+                    self._cond.notify_all()
+
+                    # back off before retrying, unless closed in the meantime
+                    deadline = _now() + retry_delay
+                    while not self._closed:
+                        remaining = deadline - _now()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                retry_delay = min(retry_delay * 2, MAX_SPAWN_RETRY_DELAY)
+                continue
+
+            retry_delay = SPAWN_RETRY_DELAY
+            with self._cond:
+                self._creating -= 1
+                closed = self._closed
+                if not closed:
+                    # the previous error, if any, is not relevant anymore
+                    self._error = None
+                    self._ready.append(d)
+                    self._cond.notify_all()
+            if closed:
+                # outside of the lock: terminating may take up to the grace period
+                d.terminate_daemon()
+                return
+
+    def acquire(self,
+                timeout=None  # type: float
+                ):
+        # type: (...) -> DaemonProxy
+        """
+        Returns a started daemon. If no spare is ready, waits for the next one to be started. If the last attempt to
+        spawn a spare failed, its error is raised (once: the spawn is retried in the background).
+
+        :param timeout: an optional maximum time to wait for a daemon, in seconds
+        :return:
+        """
+        with self._cond:
+            if timeout is not None:
+                deadline = _now() + timeout
+            while len(self._ready) == 0:
+                if self._error is not None:
+                    error, self._error = self._error, None
+                    raise error
+                if self._closed:
+                    raise ValueError('[%s] Can not acquire a daemon: closed' % self)
+                if timeout is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - _now()
+                    if remaining <= 0:
+                        raise TimeoutError('[%s] No daemon could be acquired in %ss' % (self, timeout))
+                    self._cond.wait(remaining)
+
+            d = self._ready.popleft()
+            # wake the refill thread up
+            self._cond.notify_all()
+            return d
+
+    def close(self,
+              grace=DEFAULT_TERMINATION_GRACE  # type: float
+              ):
+        """
+        Stops spawning new daemons and terminates the spares that were not acquired, at once (see `terminate_all`).
+
+        :param grace: the time given to the spares to exit before they are terminated with signals, in seconds
+        :return:
+        """
+        with self._cond:
+            self._closed = True
+            to_terminate = list(self._ready)
+            self._ready.clear()
+            self._cond.notify_all()
+
+        terminate_all(to_terminate, grace=grace)
+        self._refill_thread.join()
@@ -0,0 +1,375 @@
+import argparse
+import os
+import sys
+from logging import Logger
+from multiprocessing.connection import Listener, Client, AuthenticationError
+from threading import Thread
+
+try:  # python 3.5+
+    from typing import Union, Any, List, Tuple, Iterable
+except ImportError:
+    pass
+
+from spawny.main import DaemonProxy, ForkedProcess, CommChannel, SharedExclusiveLock, create_impl, execute_command, \
+    is_thread_safe_call, safe_conn_send, _get_thread_safe_paths, _handles, _handle_owner, START_REQ_ID, OK_FLAG, \
+    ERR_FLAG, EXIT_CMD, FORK_CMD, RELEASE_CMD
+from spawny.main_pool import DaemonPool
+from spawny.main_remotes_and_defs import Definition, InstanceDefinition, ModuleDefinition, ScriptDefinition
+from spawny.utils_attr_cache import CACHE_NEVER
+from spawny.utils_logging import default_logger
+from spawny.utils_object_proxy import TypeDescriptor
+from spawny.utils_transport import Transport, DEFAULT_COMPRESSION_THRESHOLD
+
+
+PROTOCOL_VERSION = 1
+"""The version of the protocol spoken by `DaemonServer`, sent to the clients when they connect"""
+
+AUTHKEY_ENV_VAR = 'SPAWNY_AUTHKEY'
+"""The environment variable read by the `spawny-server` command when `--authkey` is not provided"""
+
+
+class DaemonServer(object):
+    """
+    A long-lived daemon hosting an object instance or definition, that clients connect to over a unix socket or a TCP
+    port with `ConnectedDaemonProxy` (or `DaemonConnectionPool`), instead of spawning their own daemon. Several client
+    processes can therefore share a single copy of an expensive object.
+
+    Each connection is served by its own thread, and receives its messages independently. Commands are executed one at
+    a time on the shared object, so the object does not have to be thread-safe, except the calls to thread-safe methods
+    (see `thread_safe`) that are executed concurrently with each other. Handles created for a connection (see
+    `RemoteHandle`) are released when it is closed. Exiting a connected proxy only closes its connection.
+
+    Messages are pickled: anybody able to connect can execute arbitrary code in the server process. Use an `authkey`,
+    and only listen on a unix socket with restricted permissions or on a local TCP port.
+    """
+    def __init__(self,
+                 obj_instance_or_definition,  # type: Union[Any, Definition]
+                 address,                     # type: Union[str, Tuple[str, int]]
+                 authkey=None,                # type: bytes
+                 transport=None,              # type: Transport
+                 thread_safe=None             # type: Union[bool, Iterable[str]]
+                 ):
+        """
+        Creates the object instance and starts listening on `address`. Call `serve_forever` to accept connections.
+
+        :param obj_instance_or_definition: the object instance to serve, or the definition to create it from
+        :param address: the path of a unix socket, or a `(host, port)` tuple. Use port 0 to pick a free port, and
+            `address` to know which.
+        :param authkey: an optional secret shared with the clients, used to authenticate the connections (see
+            `multiprocessing.connection.Listener`). By default connections are not authenticated.
+        :param transport: the `Transport` used to exchange messages with the clients. It is sent to them when they
+            connect. By default messages are pickled.
+        :param thread_safe: the methods that are thread-safe, in addition to the ones decorated with `thread_safe`:
+            True if all methods are, or their paths such as `'query'` or `'client.get'`. The calls to thread-safe
+            methods received on different connections are executed concurrently.
+        """
+        self.transport = transport if transport is not None else Transport()
+        self.thread_safe = _get_thread_safe_paths(thread_safe)
+        self.authkey = authkey
+        self.pid = os.getpid()
+        self.print_prefix = '[%s] DaemonServer' % self.pid
+
+        self.impl = create_impl(obj_instance_or_definition)
+        if isinstance(obj_instance_or_definition, Definition):
+            is_multi_object = obj_instance_or_definition.is_multi_object()
+        else:
+            is_multi_object = False
+        # the type is described rather than sent, so that clients do not need to import it
+        self._info = dict(protocol=PROTOCOL_VERSION, pid=self.pid, transport=self.transport,
+                          instance_type=TypeDescriptor.create_from(self.impl.__class__),
+                          is_multi_object=is_multi_object)
+
+        # thread-safe calls hold the lock in shared mode, other commands in exclusive mode
+        self._exec_lock = SharedExclusiveLock()
+        self._closed = False
+        self._serving = False
+        self._listener = Listener(address, authkey=authkey)
+
+    @property
+    def address(self):
+        # type: (...) -> Union[str, Tuple[str, int]]
+        """The address on which this server listens"""
+        return self._listener.address
+
+    def __repr__(self):
+        return 'DaemonServer<%s>' % (self.address, )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def serve_forever(self):
+        """
+        Accepts connections until `close` is called, serving each of them in a new thread.
+
+        :return:
+        """
+        self._serving = True
+        print(self.print_prefix + ' listening on %s' % (self.address, ))
+        try:
+            while not self._closed:
+                try:
+                    conn = self._listener.accept()
+                except (AuthenticationError, EOFError, OSError) as e:
+                    if not self._closed:
+                        print(self.print_prefix + ' refused a connection: %r' % e)
+                    continue
+                if self._closed:
+                    conn.close()
+                    break
+                t = Thread(target=self._serve_connection, args=(conn, ), name='spawny-server-connection')
+                t.daemon = True
+                t.start()
+        finally:
+            self._listener.close()
+            print(self.print_prefix + ' stopped listening')
+
+    def close(self):
+        """
+        Stops accepting connections. The connections already established are served until their client disconnects.
+
+        :return:
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._serving:
+            # wake the accepting thread up
+            try:
+                Client(self.address, authkey=self.authkey).close()
+            except Exception:
+                pass
+        else:
+            self._listener.close()
+
+    def _serve_connection(self, conn):
+        """
+        Serves the commands received on `conn` until the client exits or disconnects.
+
+        :param conn:
+        :return:
+        """
+        transport = self.transport
+        owned_handles = _handle_owner.handle_ids = set()
+        try:
+            conn.send((START_REQ_ID, OK_FLAG, self._info))
+            while True:
+                try:
+                    req_id, cmd_type, to_execute, to_execute_args, to_execute_kwargs = transport.recv(conn)
+                except (EOFError, OSError):
+                    # the client disconnected
+                    break
+
+                if cmd_type == EXIT_CMD:
+                    break
+                elif cmd_type == RELEASE_CMD:
+                    for handle_id in to_execute_args:
+                        _handles.pop(handle_id, None)
+                        owned_handles.discard(handle_id)
+                elif cmd_type == FORK_CMD:
+                    safe_conn_send(conn, req_id, ERR_FLAG, ValueError("A daemon server can not be forked"),
+                                   transport=transport)
+                else:
+                    flag, contents = self._execute(to_execute, to_execute_args, to_execute_kwargs)
+                    safe_conn_send(conn, req_id, flag, contents, transport=transport)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+            for handle_id in owned_handles:
+                _handles.pop(handle_id, None)
+
+    def _execute(self, to_execute, to_execute_args, to_execute_kwargs):
+        """Executes a command received by the current thread, concurrently with others if it is thread-safe"""
+        if is_thread_safe_call(self.impl, to_execute, to_execute_kwargs, self.thread_safe):
+            self._exec_lock.acquire_shared()
+            try:
+                return execute_command(self.impl, to_execute, to_execute_args, to_execute_kwargs)
+            finally:
+                self._exec_lock.release_shared()
+        else:
+            self._exec_lock.acquire_exclusive()
+            try:
+                return execute_command(self.impl, to_execute, to_execute_args, to_execute_kwargs)
+            finally:
+                self._exec_lock.release_exclusive()
+
+
+class _ServerProcess(ForkedProcess):
+    """
+    The process handle of a `ConnectedDaemonProxy`. The server is shared with other clients: it is never terminated,
+    joining it waits for the connection to be closed.
+    """
+    __slots__ = ()
+
+    def _signal(self, signum):
+        pass
+
+
+class ConnectedDaemonProxy(DaemonProxy):
+    """
+    A `DaemonProxy` connected to a `DaemonServer`, instead of spawning its own daemon. The transport (serializer,
+    thresholds, compression) is the one of the server. Terminating this proxy only closes its connection.
+    """
+    def __init__(self,
+                 address,                        # type: Union[str, Tuple[str, int]]
+                 authkey=None,                   # type: bytes
+                 logger=default_logger,          # type: Logger
+                 attr_cache_policy=CACHE_NEVER,  # type: Union[str, float]
+                 results_by_ref=False,           # type: bool
+                 iter_chunksize=100,             # type: int
+                 iter_prefetch=1,                # type: int
+                 coalesce_writes=False,          # type: bool
+                 timeout=None                    # type: float
+                 ):
+        """
+        Connects to the `DaemonServer` listening on `address`.
+
+        :param address: the path of the unix socket, or the `(host, port)` tuple, on which the server listens
+        :param authkey: the secret of the server, if any
+        :param logger: see `DaemonProxy`
+        :param attr_cache_policy: see `DaemonProxy`
+        :param results_by_ref: see `DaemonProxy`
+        :param iter_chunksize: see `DaemonProxy`
+        :param iter_prefetch: see `DaemonProxy`
+        :param coalesce_writes: see `DaemonProxy`
+        :param timeout: see `DaemonProxy`. The server is shared: calls that time out never restart it.
+        """
+        self.started = False
+        conn = Client(address, authkey=authkey)
+        try:
+            req_id, flag, info = conn.recv()
+            if flag != OK_FLAG:
+                raise info
+            if info['protocol'] != PROTOCOL_VERSION:
+                raise ValueError("The daemon server at %s speaks protocol version %s, expected %s"
+                                 % (address, info['protocol'], PROTOCOL_VERSION))
+        except:
+            conn.close()
+            raise
+
+        self._init_client(info['instance_type'], info['is_multi_object'], logger=logger,
+                          attr_cache_policy=attr_cache_policy, results_by_ref=results_by_ref,
+                          iter_chunksize=iter_chunksize, iter_prefetch=iter_prefetch,
+                          coalesce_writes=coalesce_writes, timeout=timeout, transport=info['transport'])
+        self.address = address
+        self.parent_conn = CommChannel(conn)
+        self.p = _ServerProcess(info['pid'], conn, self.transport)
+        self.started = True
+        self.logger.info('[%s] connected to daemon server at %s' % (self, address))
+
+    def fork(self, logger=None, attr_cache_policy=None):
+        raise ValueError("[%s] A daemon server can not be forked" % self)
+
+
+class DaemonConnectionPool(DaemonPool):
+    """
+    A `DaemonPool` whose workers are `size` connections to the same `DaemonServer`. Calls made from several threads
+    through its `obj_proxy` are spread over the connections instead of being queued on a single one.
+    """
+    def __init__(self,
+                 address,                       # type: Union[str, Tuple[str, int]]
+                 size=4,                        # type: int
+                 authkey=None,                  # type: bytes
+                 logger=default_logger,         # type: Logger
+                 attr_cache_policy=CACHE_NEVER  # type: Union[str, float]
+                 ):
+        """
+        Opens `size` connections to the `DaemonServer` listening on `address`.
+
+        :param address: see `ConnectedDaemonProxy`
+        :param size: the number of connections
+        :param authkey: see `ConnectedDaemonProxy`
+        :param logger: see `DaemonProxy`
+        :param attr_cache_policy: see `DaemonProxy`
+        """
+        self.address = address
+        self._init_pool(lambda: ConnectedDaemonProxy(address, authkey=authkey, logger=logger,
+                                                     attr_cache_policy=attr_cache_policy), size=size, logger=logger)
+
+    def __repr__(self):
+        return 'DaemonConnectionPool<%s, size=%s>' % (self.address, len(self.workers))
+
+
+def parse_address(address  # type: str
+                  ):
+    # type: (...) -> Union[str, Tuple[str, int]]
+    """
+    Parses an address given on the command line: `host:port` or `:port` (localhost) for a TCP port, anything else is
+    the path of a unix socket.
+
+    :param address:
+    :return:
+    """
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return host or '127.0.0.1', int(port)
+    return address
+
+
+def main(argv=None  # type: List[str]
+         ):
+    """
+    The `spawny-server` command: serves a module, script or class instance until interrupted. For example
+
+        spawny-server --module numpy --address /tmp/numpy.sock
+        spawny-server --instance collections:OrderedDict --address :5000
+
+    :param argv: the command line arguments. By default `sys.argv[1:]`
+    :return:
+    """
+    parser = argparse.ArgumentParser(prog='spawny-server', description="Serves an object to spawny clients, which "
+                                                                       "connect with `ConnectedDaemonProxy`.")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--module', help="the name of the module to serve")
+    target.add_argument('--instance', metavar='MODULE:CLASS', help="the class to instantiate (without arguments)")
+    target.add_argument('--script', metavar='PATH', help="the path of a python script to execute and serve")
+    parser.add_argument('--module-path', help="the path of the source file of --module, if it is not importable")
+    parser.add_argument('--address', required=True,
+                        help="HOST:PORT or :PORT to listen on a TCP port, or the path of a unix socket")
+    parser.add_argument('--authkey', help="the secret that clients should provide. By default the %s environment "
+                                          "variable is used if set" % AUTHKEY_ENV_VAR)
+    parser.add_argument('--serializer', help="see `DaemonProxy`")
+    parser.add_argument('--compression', help="see `DaemonProxy`")
+    parser.add_argument('--compression-threshold', type=int, default=DEFAULT_COMPRESSION_THRESHOLD,
+                        help="see `DaemonProxy`")
+    parser.add_argument('--oob-threshold', type=int, help="see `DaemonProxy`")
+    parser.add_argument('--shm-threshold', type=int, help="see `DaemonProxy`")
+    parser.add_argument('--thread-safe', metavar='PATH', action='append',
+                        help="the path of a thread-safe method, whose calls from different connections are executed "
+                             "concurrently. May be repeated")
+    args = parser.parse_args(argv)
+
+    if args.module is not None:
+        definition = ModuleDefinition(args.module, module_path=args.module_path)
+    elif args.instance is not None:
+        module_name, _, clazz_name = args.instance.rpartition(':')
+        definition = InstanceDefinition(module_name, clazz_name)
+    else:
+        with open(args.script) as f:
+            definition = ScriptDefinition(f.read())
+
+    authkey = args.authkey if args.authkey is not None else os.environ.get(AUTHKEY_ENV_VAR)
+    if authkey is not None:
+        authkey = authkey.encode('utf-8')
+    address = parse_address(args.address)
+    if authkey is None and isinstance(address, tuple):
+        sys.stderr.write("WARNING: listening on a TCP port without authkey: any local user can execute code in this "
+                         "process\n")
+
+    transport = Transport(shm_threshold=args.shm_threshold, oob_threshold=args.oob_threshold,
+                          serializer=args.serializer, compression=args.compression,
+                          compression_threshold=args.compression_threshold)
+    server = DaemonServer(definition, address, authkey=authkey, transport=transport, thread_safe=args.thread_safe)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import weakref
+from threading import Event, Thread, current_thread
+
+try:  # python 3.5+
+    from typing import Union, Any
+except ImportError:
+    pass
+
+from spawny.main import DaemonProxy, DaemonDiedError, DaemonRestartedError, EXEC_CMD, _now
+from spawny.main_remotes_and_defs import Definition
+
+
+# what to do with the calls in flight when the daemon dies or is restarted, see `SupervisedDaemonProxy`
+FAILOVER_RAISE = 'raise'
+FAILOVER_RETRY = 'retry'
+
+HEARTBEAT_STEP = 0.1
+"""The maximum time waited for the answer to a single heartbeat, in seconds, see `SupervisedDaemonProxy.check`"""
+
+
+class SupervisedDaemonProxy(DaemonProxy):
+    """
+    A `DaemonProxy` whose daemon is watched by a background thread, and respawned from the same object instance or
+    definition when it dies or stops answering heartbeats. The proxy and its object proxies can still be used after
+    that, since they now point to the new daemon. Note that the state of the object is lost when it is respawned, and
+    that the handles to objects of the previous daemon become invalid.
+
+    Heartbeats are sent on a side channel and answered by a dedicated thread in the daemon, so a daemon executing a long
+    command is not considered unresponsive: only a dead process, or one stuck without releasing the GIL, is.
+    """
+    _with_heartbeat = True
+
+    def __init__(self,
+                 obj_instance_or_definition,  # type: Union[Any, Definition]
+                 heartbeat_interval=1.0,      # type: float
+                 heartbeat_timeout=5.0,       # type: float
+                 failover=FAILOVER_RAISE,     # type: str
+                 **kwargs
+                 ):
+        """
+        Spawns the daemon exactly as `DaemonProxy` does, and starts watching it.
+
+        :param obj_instance_or_definition: see `DaemonProxy`
+        :param heartbeat_interval: the time between two checks of the daemon, in seconds
+        :param heartbeat_timeout: the time after which a daemon that did not answer a heartbeat is considered stuck and
+            respawned, in seconds
+        :param failover: what happens to the remote calls waiting for a response when the daemon dies or is respawned.
+            `'raise'` (default): they raise a `DaemonDiedError` or `DaemonRestartedError`. `'retry'`: the blocking calls
+            are sent again, once, to the new daemon. Only use it if the remote methods are idempotent. In both cases the
+            daemon is respawned immediately when a call detects its death.
+        :param kwargs: other arguments for `DaemonProxy`
+        """
+        if heartbeat_interval <= 0 or heartbeat_timeout <= 0:
+            raise ValueError("heartbeat_interval and heartbeat_timeout should be strictly positive")
+        if failover not in (FAILOVER_RAISE, FAILOVER_RETRY):
+            raise ValueError("failover should be %r or %r, found: %r" % (FAILOVER_RAISE, FAILOVER_RETRY, failover))
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.failover = failover
+
+        super(SupervisedDaemonProxy, self).__init__(obj_instance_or_definition, **kwargs)
+
+        # the watching thread only holds a weak reference, so that this proxy can still be garbage collected
+        self._stop = Event()
+        self._check_now = Event()
+        self._watcher = Thread(target=_watch, args=(weakref.ref(self), self._stop, self._check_now),
+                               name='spawny-supervisor')
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def __repr__(self):
+        if not self.is_started():
+            return 'SupervisedDaemonProxy<not started>'
+        else:
+            return 'SupervisedDaemonProxy<%s>' % self.p.pid
+
+    def check(self):
+        # type: (...) -> bool
+        """
+        Checks that the daemon is alive and answers heartbeats, and respawns it otherwise. This is done periodically
+        by the watching thread.
+
+        :return: True if the daemon was respawned
+        """
+        generation = self.generation
+        if self.p.is_alive() and self._answers_heartbeat():
+            return False
+        if not self.is_started() or self._stop.is_set():
+            return False
+        self.logger.warning('[%s] The daemon is %s: respawning it'
+                            % (self, 'stuck' if self.p.is_alive() else 'dead'))
+        self.restart(generation)
+        return True
+
+    def _answers_heartbeat(self):
+        # type: (...) -> bool
+        """
+        Returns True if the daemon answers a heartbeat within `heartbeat_timeout`. The heartbeats are sent every
+        `HEARTBEAT_STEP` seconds at most, so that the watching thread stops quickly when the proxy is terminated.
+
+        :return:
+        """
+        deadline = _now() + self.heartbeat_timeout
+        while not self._stop.is_set():
+            remaining = deadline - _now()
+            if remaining <= 0:
+                return False
+            if self.ping(min(remaining, HEARTBEAT_STEP)):
+                return True
+        # terminated: the daemon should not be respawned
+        return True
+
+    def _remote_call(self, cmd_type, to_execute, to_execute_args, log_errors, to_execute_kwargs):
+        generation = self.generation
+        try:
+            return super(SupervisedDaemonProxy, self)._remote_call(cmd_type, to_execute, to_execute_args,
+                                                                   log_errors, to_execute_kwargs)
+        except (DaemonDiedError, DaemonRestartedError):
+            if cmd_type != EXEC_CMD or not self.is_started():
+                raise
+            if self.failover == FAILOVER_RAISE:
+                # let the watching thread respawn it now
+                self._check_now.set()
+                raise
+
+        # respawn the daemon if nobody did it yet, and send the call again
+        self.restart(generation)
+        return super(SupervisedDaemonProxy, self)._remote_call(cmd_type, to_execute, to_execute_args, log_errors,
+                                                               to_execute_kwargs)
+
+    def _request_exit(self,
+                      deadline=None  # type: float
+                      ):
+        """
+        Stops watching the daemon before asking it to exit, so that it is not respawned. The watching thread is waited
+        for until `deadline` at most.
+
+        :param deadline: see `DaemonProxy._request_exit`
+        :return:
+        """
+        self._stop.set()
+        self._check_now.set()
+        if self._watcher is not current_thread():
+            self._watcher.join(None if deadline is None else max(deadline - _now(), 0))
+        super(SupervisedDaemonProxy, self)._request_exit(deadline)
+
+
+def _watch(proxy_ref,   # type: weakref.ref
+           stop,        # type: Event
+           check_now    # type: Event
+           ):
+    """
+    The loop of the thread watching a `SupervisedDaemonProxy`.
+
+    :param proxy_ref: a weak reference to the proxy
+    :param stop: set when the proxy is terminated
+    :param check_now: set to check the daemon without waiting for the next heartbeat
+    :return:
+    """
+    while not stop.is_set():
+        proxy = proxy_ref()
+        if proxy is None:
+            return
+        interval = proxy.heartbeat_interval
+        try:
+            proxy.check()
+        except Exception as e:
+            # for example the daemon could not be respawned: try again later
+            proxy.logger.warning('[%s] Could not check or respawn the daemon: %r' % (proxy, e))
+        del proxy
+        check_now.wait(interval)
+        check_now.clear()
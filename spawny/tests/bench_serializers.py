@@ -0,0 +1,66 @@
+"""
+Benchmark of the serializers: number of round trips (one command and its response) per second for each of them.
+
+    python -m spawny.tests.bench_serializers
+
+The daemon runs the `dummy` test module. Serializers whose optional dependency is not installed are skipped.
+"""
+from os.path import join, dirname
+from timeit import default_timer
+
+from spawny import DaemonProxy, ModuleDefinition
+from spawny.utils_serializers import SERIALIZERS
+
+
+RESOURCES_DIR = join(dirname(__file__), 'resources')
+
+PAYLOADS = {
+    'small': (1, 'a', None),
+    'primitives': dict(('key%s' % i, [i, float(i), 'value %s' % i, (i, True)]) for i in range(100)),
+}
+
+
+def bench(serializer,      # type: str
+          payload,         # type: object
+          duration=1.0     # type: float
+          ):
+    # type: (...) -> float
+    """
+    Returns the number of round trips per second achieved when sending `payload` back and forth with `serializer`.
+
+    :param serializer:
+    :param payload:
+    :param duration: the approximate duration of the measure, in seconds
+    :return:
+    """
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')), serializer=serializer,
+                         logger=None)
+    try:
+        identity = daemon.obj_proxy.identity
+        identity(payload)  # warm up
+        n = 0
+        start = default_timer()
+        while True:
+            for _ in range(100):
+                identity(payload)
+            n += 100
+            elapsed = default_timer() - start
+            if elapsed >= duration:
+                return n / elapsed
+    finally:
+        daemon.terminate_daemon()
+
+
+def main():
+    print('%-12s %s' % ('serializer', ' '.join('%14s' % p for p in PAYLOADS)))
+    for name in sorted(SERIALIZERS):
+        try:
+            results = [bench(name, payload) for payload in PAYLOADS.values()]
+        except ImportError as e:
+            print('%-12s skipped: %s' % (name, e))
+        else:
+            print('%-12s %s' % (name, ' '.join('%10.0f msg/s' % r for r in results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,14 @@
+import sys
+
 from py.xml import html
 import pytest
 from setuptools_scm.git import GitWorkdir
 
 
+# the asyncio tests use the `async def` syntax, that can not even be parsed before python 3.5
+collect_ignore = ['test_async.py'] if sys.version_info < (3, 5) else []
+
+
 @pytest.mark.hookwrapper
 def pytest_runtest_makereport(item, call):
     """ adds the description field in the report, so that it may be used by the other two functions """
@@ -1,4 +1,5 @@
 from collections import OrderedDict
+from threading import Lock
 
 i = 1
 
@@ -27,5 +28,45 @@ def say_hello(who):
     return "hello, %s!" % who
 
 
+def identity(x):
+    return x
+
+
+def apply(f, *args):
+    return f(*args)
+
+
+class Accumulator(object):
+    """ An object that can not be pickled since it holds a lock """
+    def __init__(self):
+        self.lock = Lock()
+        self.values = []
+
+    def add(self, x):
+        with self.lock:
+            self.values.append(x)
+            return len(self.values)
+
+
+def make_accumulator():
+    return Accumulator()
+
+
+def total(*accumulators):
+    return sum(sum(acc.values) for acc in accumulators)
+
+
+def read_rows(n, fail=False):
+    for i in range(n):
+        yield {'i': i}
+    if fail:
+        raise ValueError("no more rows")
+
+
+def handle_count():
+    from spawny.main import _handles
+    return len(_handles)
+
+
 print(foo.say_hello("process"))
 print(say_hello("process"))
@@ -0,0 +1,133 @@
+import sys
+from os.path import join, dirname
+
+import pytest
+
+RESOURCES_DIR = join(dirname(__file__), 'resources')
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 7), reason="requires asyncio.run")
+
+
+def test_async_daemon():
+    """ Tests that calls to several asynchronous daemons can be awaited concurrently """
+    import asyncio
+    from spawny import AsyncDaemonProxy, ModuleDefinition
+
+    async def main():
+        daemons = await asyncio.gather(*[AsyncDaemonProxy.create(ModuleDefinition('dummy',
+                                                                                    join(RESOURCES_DIR, 'dummy.py')))
+                                         for _ in range(3)])
+        try:
+            calls = [d.obj_proxy.say_hello("earthling %s" % i) for d in daemons for i in range(10)]
+            results = await asyncio.gather(*calls)
+            assert results == ["hello, earthling %s!" % i for _ in daemons for i in range(10)]
+
+            # attributes values and nested calls
+            assert await daemons[0].obj_proxy.foo.i == 1
+            assert await daemons[0].obj_proxy.foo.say_hello('mister') == '[Foo-1] hello, mister!'
+
+            # errors are received in the right future
+            with pytest.raises(TypeError):
+                await daemons[1].obj_proxy.say_hello()
+            assert await daemons[1].obj_proxy.odct.__len__() == 1
+        finally:
+            for d in daemons:
+                d.terminate_daemon()
+
+    asyncio.run(main())
+
+
+def test_async_many_large_calls():
+    """ Tests that many concurrent calls with large arguments do not deadlock the event loop """
+    import asyncio
+    from spawny import AsyncDaemonProxy, ScriptDefinition
+
+    async def main():
+        # the other arguments are forwarded to `DaemonProxy`
+        daemon = await AsyncDaemonProxy.create(ScriptDefinition("def identity(x):\n    return x\n"), timeout=60,
+                                               max_unanswered_bytes=100000)
+        try:
+            assert daemon.timeout == 60
+            assert daemon.max_unanswered_bytes == 100000
+            items = [bytes(bytearray([i % 256])) * 20000 for i in range(300)]
+            results = await asyncio.wait_for(asyncio.gather(*[daemon.obj_proxy.identity(x) for x in items]), 60)
+            assert results == items
+            assert len(daemon._queued) == 0
+            assert daemon._unanswered_bytes() == 0
+        finally:
+            daemon.terminate_daemon()
+
+    asyncio.run(main())
+
+
+def test_async_daemon_died():
+    """ Tests that the pending calls fail with a `DaemonDiedError` when the daemon dies """
+    import asyncio
+    from spawny import AsyncDaemonProxy, DaemonDiedError, ScriptDefinition
+
+    script = """
+import os
+import signal
+from time import sleep
+
+def crash(delay):
+    sleep(delay)
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def slow(duration):
+    sleep(duration)
+"""
+
+    async def main():
+        daemon = await AsyncDaemonProxy.create(ScriptDefinition(script))
+        try:
+            # the call sent after the crash will never be answered
+            crash, pending = daemon.obj_proxy.crash(0.2), daemon.obj_proxy.slow(0.1)
+            with pytest.raises(DaemonDiedError) as exc_info:
+                await asyncio.wait_for(crash, 10)
+            assert exc_info.value.signal == 9
+            with pytest.raises(DaemonDiedError):
+                await asyncio.wait_for(pending, 10)
+        finally:
+            daemon.terminate_daemon()
+
+    asyncio.run(main())
+
+
+def test_async_slow_receive():
+    """ Tests that receiving a response does not block the event loop """
+    import asyncio
+    from time import sleep
+    from spawny import AsyncDaemonProxy, ScriptDefinition
+
+    class SlowTransport(object):
+        """ A transport receiving messages slowly, as if they were large """
+        def __init__(self, transport):
+            self.transport = transport
+
+        def __getattr__(self, item):
+            return getattr(self.transport, item)
+
+        def recv(self, conn):
+            sleep(0.5)
+            return self.transport.recv(conn)
+
+    async def main():
+        daemon = await AsyncDaemonProxy.create(ScriptDefinition("def identity(x):\n    return x\n"))
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.05)
+
+        ticker = asyncio.ensure_future(tick())
+        try:
+            daemon.transport = SlowTransport(daemon.transport)
+            assert await daemon.obj_proxy.identity(1) == 1
+            assert len(ticks) >= 5
+        finally:
+            ticker.cancel()
+            daemon.terminate_daemon()
+
+    asyncio.run(main())
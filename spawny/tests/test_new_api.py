@@ -1,15 +1,48 @@
+import gc
+import multiprocessing as mp
+import os
 import sys
 from collections import OrderedDict
+from itertools import islice
 from os.path import join, dirname
 from pickle import PicklingError
+from threading import Thread
+from time import sleep, time
 
 import pytest
 
-from spawny import run_script, run_module, ObjectProxy, DaemonCouldNotSendMsgError
+try:  # python 3.3+
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from spawny import run_script, run_module, ObjectProxy, DaemonCouldNotSendMsgError, DaemonProxy, ScriptDefinition, \
+    ModuleDefinition, InstanceDefinition, DaemonTimeoutError, DaemonRestartedError, DaemonDiedError, terminate_all
+from spawny.main import EXEC_CMD, resolve_attribute, call_method_on_object, RemoteIterator, is_plain_attribute_path, \
+    is_thread_safe_call
+from spawny.utils_object_proxy import TypeDescriptor
+from spawny.utils_attr_cache import AttrMetadataCache
+from spawny.utils_transport import Transport, SHM_AVAILABLE, OOB_AVAILABLE
 
 PY2 = sys.version_info < (3, 0)
 
 
+@pytest.fixture
+def default_executable():
+    """ Restores the default multiprocessing executable, that `test_main` replaces with the python of a temporary venv:
+    the resource tracker handling the shared memory segments is spawned with it """
+    if PY2:
+        yield
+        return
+    from multiprocessing.spawn import get_executable
+    previous = get_executable()
+    mp.set_executable(sys.executable)
+    try:
+        yield
+    finally:
+        mp.set_executable(previous)
+
+
 def test_remote_script():
     """ Simple test with a script provided as string """
 
@@ -124,3 +157,945 @@ def test_remote_module_from_name(module_in_syspath):
         if module_in_syspath:
             sys.path.pop(0)
         remote_script.terminate_daemon()
+
+
+def test_remote_type(tmpdir):
+    """ Tests that with `remote_type` the module of an InstanceDefinition is only imported in the daemon """
+
+    # a module that can only be imported in the daemon
+    tmpdir.mkdir('daemon_only').join('spawny_remote_type_child.py').write("""
+class Item(object):
+    def __init__(self, name):
+        self.name = name
+""")
+    tmpdir.join('spawny_remote_type_mod.py').write("""
+import sys
+sys.path.insert(0, %r)
+from spawny_remote_type_child import Item
+
+class Bag(object):
+    def __init__(self, *items):
+        self.items = list(items)
+        self.child = Item('child')
+
+    def make_child(self, name):
+        return Item(name)
+
+    def __len__(self):
+        return len(self.items)
+
+    def first(self):
+        return self.items[0]
+""" % str(tmpdir.join('daemon_only')))
+    sys.path.insert(0, str(tmpdir))
+    try:
+        daemon = DaemonProxy(InstanceDefinition('spawny_remote_type_mod', 'Bag', 'a', 'b'), remote_type=True)
+        try:
+            assert 'spawny_remote_type_mod' not in sys.modules
+            assert isinstance(daemon.instance_type, TypeDescriptor)
+            assert daemon.instance_type.name == 'Bag'
+            assert '__len__' in daemon.instance_type.dunder_names
+
+            assert daemon.obj_proxy.first() == 'a'
+            assert daemon.obj_proxy.__len__() == 2
+
+            # the types of the attributes and of the results kept by reference are described too
+            child = daemon.obj_proxy.child
+            assert isinstance(child, ObjectProxy)
+            assert child.name == 'child'
+            assert daemon.call_by_ref(['make_child'], 'other').name == 'other'
+            assert daemon.obj_proxy.items == ['a', 'b']
+            assert 'spawny_remote_type_child' not in sys.modules
+
+            # the type is kept when the daemon is restarted
+            obj_proxy = daemon.obj_proxy
+            daemon.restart()
+            assert daemon.obj_proxy is obj_proxy
+            assert obj_proxy.first() == 'a'
+            assert 'spawny_remote_type_mod' not in sys.modules
+        finally:
+            daemon.terminate_daemon()
+    finally:
+        sys.path.pop(0)
+
+
+@pytest.mark.parametrize("policy", ['always', 'never', 60])
+def test_attr_cache(policy):
+    """ Tests the client-side cache of remote attributes metadata and its invalidation """
+
+    script = """
+x = 1
+
+def change():
+    global x
+    def x():
+        return 'func'
+"""
+    daemon = DaemonProxy(ScriptDefinition(script), attr_cache_policy=policy)
+    remote_script = daemon.obj_proxy
+    try:
+        assert remote_script.x == 1
+        if policy == 'never':
+            assert daemon.attr_cache.get(['x']) is None
+        else:
+            assert daemon.attr_cache.get(['x']) == (False, int)
+
+        # the remote attribute is replaced with a function
+        remote_script.change()
+        if policy != 'never':
+            # the cache still says it is an int: invalidate it
+            remote_script.invalidate_attr_cache(['x'])
+            assert daemon.attr_cache.get(['x']) is None
+            assert daemon.attr_cache.get(['change']) == (True, None)
+
+        assert remote_script.x() == 'func'
+    finally:
+        remote_script.terminate_daemon()
+
+
+def test_attr_cache_ttl_expiry():
+    """ Tests that entries of a time-to-live attribute cache expire """
+    with patch('spawny.utils_attr_cache._now', return_value=100.0) as now:
+        cache = AttrMetadataCache(10)
+        cache.put(['a', 'b'], False, int)
+        now.return_value = 110.0
+        assert cache.get(['a', 'b']) == (False, int)
+        now.return_value = 110.5
+        assert cache.get(['a', 'b']) is None
+
+
+@pytest.mark.parametrize("policy", ['sometimes', 0, -1, True, None])
+def test_attr_cache_invalid_policy(policy):
+    """ Tests that invalid attribute cache policies are rejected """
+    with pytest.raises(ValueError):
+        AttrMetadataCache(policy)
+
+
+def test_resolve_single_round_trip():
+    """ Tests that accessing a remote attribute costs a single round trip, and none for cached functions """
+
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')),
+                         attr_cache_policy='always')
+    remote_module = daemon.obj_proxy
+    try:
+        with patch.object(daemon, 'remote_call_using_pipe', wraps=daemon.remote_call_using_pipe) as remote_call:
+            def exec_calls():
+                return [c[0][1].__name__ for c in remote_call.call_args_list if c[0][0] == EXEC_CMD]
+
+            # object in a multi-object proxy: one round trip, no value
+            foo = remote_module.foo
+            assert exec_calls() == ['resolve_attribute']
+
+            # object in a single-object proxy: one round trip brings the value
+            assert foo.i == 1
+            assert exec_calls() == ['resolve_attribute'] * 2
+
+            # cached function: only the call
+            assert remote_module.say_hello("earthling") == "hello, earthling!"
+            assert remote_module.say_hello("martian") == "hello, martian!"
+            assert exec_calls() == ['resolve_attribute'] * 3 + ['call_method_or_iterate'] * 2
+    finally:
+        remote_module.terminate_daemon()
+
+
+def test_resolve_unpicklable_value():
+    """ Tests that an attribute whose value can not be pickled but whose type can is proxied, and its metadata cached """
+
+    script = """
+class Holder(object):
+    pass
+
+holder = Holder()
+holder.funcs = [lambda: 1]
+"""
+    daemon = DaemonProxy(ScriptDefinition(script), attr_cache_policy='always')
+    remote_script = daemon.obj_proxy
+    try:
+        funcs = remote_script.holder.funcs
+        assert isinstance(funcs, ObjectProxy)
+        assert daemon.attr_cache.get(['holder', 'funcs']) == (False, list)
+        assert len(funcs) == 1
+    finally:
+        remote_script.terminate_daemon()
+
+
+def test_resolve_cached_unpicklable_value():
+    """ Tests that an attribute whose value can not be pickled is proxied when its metadata comes from the cache """
+
+    script = """
+try:
+    from queue import Queue
+except ImportError:  # python 2
+    from Queue import Queue
+
+class Holder(object):
+    pass
+
+holder = Holder()
+holder.inner = Queue()
+"""
+    daemon = DaemonProxy(ScriptDefinition(script), attr_cache_policy='always')
+    remote_script = daemon.obj_proxy
+    try:
+        holder = remote_script.holder
+        assert isinstance(holder.inner, ObjectProxy)
+        assert daemon.attr_cache.get(['holder', 'inner']) is not None
+
+        # the second access is served from the cache: the value still can not be sent (TypeError, not PicklingError)
+        inner = holder.inner
+        assert isinstance(inner, ObjectProxy)
+        assert inner.qsize() == 0
+    finally:
+        remote_script.terminate_daemon()
+
+
+class _Pickled(object):
+    count = 0
+
+    def __reduce__(self):
+        _Pickled.count += 1
+        return _Pickled, ()
+
+
+def test_resolve_attribute_does_not_serialize():
+    """ Tests that values are not serialized by `resolve_attribute` to check that they can be sent """
+
+    class Holder(object):
+        value = _Pickled()
+
+    assert resolve_attribute(Holder, ['value'], with_value=True) == (False, _Pickled, True, Holder.value)
+    assert _Pickled.count == 0
+
+
+def test_resolve_type_descriptor():
+    """ Tests that a type that can not be pickled is described with a TypeDescriptor """
+    remote_module = run_module(module_name='dummy', module_path=join(RESOURCES_DIR, 'dummy.py'))
+    try:
+        is_func, typ, has_value, _ = remote_module.daemon.remote_call_using_pipe(EXEC_CMD, resolve_attribute,
+                                                                                names=['foo'], with_value=True)
+        assert not is_func
+        assert not has_value
+        assert isinstance(typ, TypeDescriptor)
+        assert typ.name == 'Foo'
+        assert '__eq__' in typ.dunder_names
+        assert remote_module.foo.say_hello('mister') == '[Foo-1] hello, mister!'
+    finally:
+        remote_module.terminate_daemon()
+
+
+def test_pipelined_calls():
+    """ Tests that several calls can be in flight at the same time, and that responses are matched by request id """
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')))
+    try:
+        pending = [daemon.remote_call_nowait(EXEC_CMD, call_method_on_object, names=['say_hello'],
+                                             to_execute_args=("earthling %s" % i,)) for i in range(20)]
+        failing = daemon.remote_call_nowait(EXEC_CMD, call_method_on_object, names=['say_hello'], log_errors=False)
+
+        # read the responses in reverse order
+        for i, p in reversed(list(enumerate(pending))):
+            assert p.result() == "hello, earthling %s!" % i
+        with pytest.raises(TypeError):
+            failing.result()
+
+        # blocking calls still work
+        assert daemon.obj_proxy.say_hello("martian") == "hello, martian!"
+    finally:
+        daemon.terminate_daemon()
+
+
+def test_pipelined_large_requests():
+    """ Tests that pipelined requests and responses larger than the pipe do not deadlock with the daemon """
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')))
+    try:
+        payloads = [bytes(bytearray([i])) * 1000000 for i in range(5)]
+        pending = [daemon.remote_call_nowait(EXEC_CMD, call_method_on_object, names=['identity'],
+                                             to_execute_args=(payload, )) for payload in payloads]
+        # the responses were received to make room for the next requests
+        assert daemon._unanswered_bytes() <= daemon.max_unanswered_bytes or len(daemon._unanswered) == 1
+        assert [p.result() for p in pending] == payloads
+        assert daemon._unanswered_bytes() == 0
+    finally:
+        daemon.terminate_daemon()
+
+
+def test_batch():
+    """ Tests that calls and attribute reads recorded in a batch are executed in a single round trip """
+
+    script = """
+class Config(object):
+    def __init__(self):
+        self.values = dict()
+
+    def set(self, name, value):
+        self.values[name] = value
+        return len(self.values)
+
+config = Config()
+"""
+    daemon = DaemonProxy(ScriptDefinition(script))
+    remote_script = daemon.obj_proxy
+    try:
+        config = remote_script.config
+        with patch.object(daemon, 'remote_call_using_pipe', wraps=daemon.remote_call_using_pipe) as remote_call:
+            batch = config.batch()
+            with batch as b:
+                ops = [b.set('v%s' % i, i) for i in range(50)]
+                b.values
+            assert remote_call.call_count == 1
+
+        assert ops[-1].result() == 50
+        assert batch.results[:-1] == list(range(1, 51))
+        assert batch.results[-1] == dict(('v%s' % i, i) for i in range(50))
+
+        # intermediate attribute reads are only executed if their recorder is kept
+        batch = config.batch()
+        with batch as b:
+            b.values.get('v1')
+            values = b.values
+            values.get('v2')
+        assert batch.results == [1, dict(('v%s' % i, i) for i in range(50)), 2]
+
+        # errors
+        with pytest.raises(TypeError):
+            with remote_script.config.batch() as b:
+                b.set('a', 1)
+                b.set('b')
+                b.set('c', 3)
+        assert 'c' not in remote_script.config.values
+
+        batch = remote_script.config.batch(stop_on_error=False)
+        with batch as b:
+            b.set('b')
+            b.set('c', 3)
+        assert isinstance(batch.results[0], TypeError)
+        assert batch.results[1] == 52
+    finally:
+        remote_script.terminate_daemon()
+
+
+def test_remote_map():
+    """ Tests that a remote function can be applied on many items with a few messages only """
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')))
+    remote_module = daemon.obj_proxy
+    try:
+        say_hello = remote_module.say_hello
+        items = ["earthling %s" % i for i in range(2500)]
+        with patch.object(daemon, 'remote_call_nowait', wraps=daemon.remote_call_nowait) as remote_call:
+            assert say_hello.map(items, chunksize=1000) == ["hello, %s!" % i for i in items]
+            assert remote_call.call_count == 3
+
+        # partial consumption of the lazy version
+        it = say_hello.imap(iter(items), chunksize=10)
+        assert next(it) == "hello, earthling 0!"
+        it.close()
+        assert say_hello("martian") == "hello, martian!"
+
+        assert remote_module.odct.get.map(['a', 'b']) == [1, None]
+        with pytest.raises(KeyError):
+            remote_module.odct.__getitem__.map(['a', 'b'], chunksize=1)
+    finally:
+        remote_module.terminate_daemon()
+
+
+def test_remote_map_large_chunks():
+    """ Tests that mapping with chunks larger than the pipe buffer does not deadlock """
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')))
+    try:
+        items = [bytes(bytearray([i % 256])) * 2000 for i in range(3000)]
+        with daemon.deadline(30):
+            assert daemon.obj_proxy.identity.map(items, chunksize=1000) == items
+    finally:
+        daemon.terminate_daemon()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="os.fork is not available")
+def test_fork_daemon():
+    """ Tests that daemons forked from a template get a copy of its state and are independent """
+    template = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')))
+    try:
+        template.obj_proxy.odct['c'] = 3
+
+        forked = template.fork()
+        try:
+            assert forked.p.pid != template.p.pid
+            assert forked.obj_proxy.say_hello("earthling") == "hello, earthling!"
+            assert forked.obj_proxy.odct['c'] == 3
+
+            # the states are independent
+            forked.obj_proxy.odct['d'] = 4
+            assert 'd' not in template.obj_proxy.odct
+
+            # the template can still be used, and forked again
+            forked2 = template.fork()
+            assert 'd' not in forked2.obj_proxy.odct
+        finally:
+            forked.terminate_daemon()
+
+        # forked daemons survive the template
+        template.terminate_daemon()
+        assert forked2.obj_proxy.odct['c'] == 3
+        forked2.terminate_daemon()
+    finally:
+        if template.is_started():
+            template.terminate_daemon()
+
+
+@pytest.mark.skipif(not SHM_AVAILABLE, reason="shared memory transport is not available")
+@pytest.mark.parametrize('shm_threshold, oob_threshold', [(1024, None), (None, 1024), (50000, 1024)],
+                         ids=['shm', 'oob', 'shm+oob'])
+def test_large_buffers_transport(shm_threshold, oob_threshold, default_executable):
+    """ Tests that large buffers are transferred out-of-band (shared memory segments, that are then destroyed, or
+    separate frames) """
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')),
+                         shm_threshold=shm_threshold, oob_threshold=oob_threshold)
+    remote_module = daemon.obj_proxy
+    try:
+        segments_before = set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else None
+
+        big = b'x' * 100000
+        medium = b'y' * 10000
+        assert remote_module.identity(big) == big
+        assert remote_module.identity(bytearray(big)) == bytearray(big)
+        res = remote_module.identity([b'small', big, {'a': bytearray(big)}, medium, bytearray(medium)])
+        assert res == [b'small', big, {'a': bytearray(big)}, medium, bytearray(medium)]
+        assert type(res[1]) is bytes and type(res[2]['a']) is bytearray and type(res[4]) is bytearray
+
+        # shared objects are still shared
+        ba = bytearray(big)
+        res = remote_module.identity([ba, ba])
+        assert res[0] is res[1]
+
+        # the other messages still work
+        assert remote_module.say_hello("earthling") == "hello, earthling!"
+
+        if segments_before is not None:
+            assert set(os.listdir('/dev/shm')) == segments_before
+    finally:
+        remote_module.terminate_daemon()
+
+    with pytest.raises(ValueError):
+        Transport(shm_threshold=0)
+    with pytest.raises(ValueError):
+        Transport(oob_threshold=0)
+
+
+@pytest.mark.skipif(not SHM_AVAILABLE or not os.path.isdir('/dev/shm'),
+                    reason="requires posix shared memory listed in /dev/shm")
+def test_shm_segments_not_leaked(default_executable):
+    """ Tests that the shared memory segments of messages that are never read are destroyed """
+    segments_before = set(os.listdir('/dev/shm'))
+    big = b'x' * 100000
+
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')), shm_threshold=1024)
+    try:
+        # a request that is not read since the daemon is busy when restarted
+        daemon.remote_call_nowait(EXEC_CMD, call_method_on_object, to_execute_args=(sleep, 1),
+                                   names=['apply']).discard()
+        daemon.remote_call_nowait(EXEC_CMD, call_method_on_object, to_execute_args=(big, ),
+                                   names=['identity']).discard()
+        daemon.restart()
+        assert set(os.listdir('/dev/shm')) == segments_before
+        assert daemon.obj_proxy.say_hello("earthling") == "hello, earthling!"
+
+        # a response that is not read before the daemon is terminated
+        daemon.remote_call_nowait(EXEC_CMD, call_method_on_object, to_execute_args=(big, ),
+                                   names=['identity']).discard()
+    finally:
+        daemon.terminate_daemon()
+    assert set(os.listdir('/dev/shm')) == segments_before
+
+
+@pytest.mark.skipif(not SHM_AVAILABLE, reason="shared memory transport is not available")
+def test_shm_pickle_buffers_not_copied():
+    """ Tests that the pickle protocol 5 buffers received through shared memory are used in place """
+    from pickle import PickleBuffer
+    from mmap import mmap
+
+    transport = Transport(shm_threshold=1024)
+    a, b = mp.Pipe()
+    try:
+        transport.send(a, (PickleBuffer(bytearray(b'x' * 100000)), b'y' * 100000))
+        buf, data = transport.recv(b)
+    finally:
+        a.close()
+        b.close()
+    # the buffer is a view on the mapped segment, the bytes are a copy
+    assert type(buf) is memoryview and type(buf.obj) is mmap
+    assert buf == b'x' * 100000 and data == b'y' * 100000
+
+
+@pytest.mark.parametrize('serializer', ['pickle', 'cloudpickle', 'marshal', 'msgpack'])
+def test_serializers(serializer):
+    """ Tests that all serializers can be used, including for messages that they can not encode """
+    pytest.importorskip(serializer)
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')), serializer=serializer)
+    remote_module = daemon.obj_proxy
+    try:
+        assert remote_module.say_hello("earthling") == "hello, earthling!"
+        values = [None, True, 1, 2.5, "a", b"b", (1, (2, )), [3, [4]], {'a': 1, 2: 'b'}]
+        assert remote_module.identity(values) == values
+        assert remote_module.identity(OrderedDict(a=1)) == OrderedDict(a=1)
+        with pytest.raises(KeyError):
+            remote_module.odct['unknown']
+        if serializer == 'cloudpickle':
+            assert remote_module.apply(lambda x: x + 1, 1) == 2
+    finally:
+        remote_module.terminate_daemon()
+
+    with pytest.raises(ValueError):
+        DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')), serializer='unknown')
+
+
+@pytest.mark.parametrize('compression', ['zlib', 'lzma', 'lz4'])
+@pytest.mark.parametrize('oob', [False, True], ids=['pipe', 'oob'])
+def test_compression(compression, oob):
+    """ Tests that large messages are compressed in both directions, and that small ones are not """
+    if compression == 'lz4':
+        pytest.importorskip('lz4.frame')
+    if oob and not OOB_AVAILABLE:
+        pytest.skip("out-of-band buffers require python 3.8+")
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')),
+                         compression=compression, compression_threshold=1000,
+                         oob_threshold=10 ** 6 if oob else None)
+    remote_module = daemon.obj_proxy
+    try:
+        assert remote_module.say_hello("earthling") == "hello, earthling!"
+        assert daemon.transport.stats.compressed_count == 0
+
+        report = dict(('key %s' % i, ['value %s' % i] * 10) for i in range(1000))
+        assert remote_module.identity(report) == report
+        stats = daemon.transport.stats.as_dict()
+        assert stats['compressed_count'] == 1
+        assert stats['decompressed_count'] == 1
+        assert stats['ratio'] < 0.5
+
+        # incompressible data is sent as is
+        data = os.urandom(10000)
+        assert remote_module.identity(data) == data
+        assert daemon.transport.stats.uncompressed_count == 1
+    finally:
+        remote_module.terminate_daemon()
+
+    with pytest.raises(ValueError):
+        DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')), compression='unknown')
+
+
+def test_results_by_ref():
+    """ Tests that results can be kept in the daemon, and are released when their proxies are garbage collected """
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')))
+    remote_module = daemon.obj_proxy
+    try:
+        with pytest.raises(DaemonCouldNotSendMsgError):
+            remote_module.make_accumulator()
+
+        acc = remote_module.make_accumulator.by_ref()
+        assert isinstance(acc, ObjectProxy)
+        assert acc.add(1) == 1
+        assert acc.add(2) == 2
+        assert acc.values == [1, 2]
+        assert remote_module.handle_count() == 1
+        assert daemon.fetch(remote_module.identity.by_ref("a")) == "a"
+        # the handle of the temporary result was released with this command
+        assert remote_module.handle_count() == 1
+
+        del acc
+        gc.collect()
+        assert remote_module.handle_count() == 0
+    finally:
+        remote_module.terminate_daemon()
+
+    # the same, with all results returned by reference
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')), results_by_ref=True)
+    remote_module = daemon.obj_proxy
+    try:
+        hello = remote_module.say_hello("earthling")
+        assert isinstance(hello, ObjectProxy)
+        assert daemon.fetch(hello) == "hello, earthling!"
+        assert remote_module.handle_count.by_value() == 1
+    finally:
+        remote_module.terminate_daemon()
+
+
+def test_results_by_ref_restart():
+    """ Tests that the handles created before a restart do not release the objects of the new daemon """
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')))
+    remote_module = daemon.obj_proxy
+    try:
+        old = remote_module.make_accumulator.by_ref()
+        daemon.restart()
+        new = remote_module.make_accumulator.by_ref()
+        # handle ids restart with the new daemon process
+        assert new.child_names[0].handle_id == old.child_names[0].handle_id
+
+        del old
+        gc.collect()
+        assert new.add(6) == 1
+        assert new.values == [6]
+        assert remote_module.handle_count() == 1
+    finally:
+        remote_module.terminate_daemon()
+
+def test_proxy_arguments_by_ref():
+    """ Tests that proxies passed as arguments of remote calls are sent as references to the remote objects """
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')))
+    remote_module = daemon.obj_proxy
+    other = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')))
+    try:
+        # accumulators can not be pickled
+        acc = remote_module.make_accumulator.by_ref()
+        acc.add(1)
+        acc.add(2)
+        assert remote_module.total(acc) == 3
+        # nested in other arguments, and in remote method proxies
+        assert remote_module.apply(remote_module.total, acc, acc) == 6
+        assert remote_module.total.map([acc, acc], chunksize=1) == [3, 3]
+
+        # the root object
+        assert remote_module.apply(remote_module.identity, remote_module.foo_str) == "hello world"
+
+        # references that can not be resolved
+        with pytest.raises(AttributeError):
+            remote_module.identity(ObjectProxy(daemon, is_multi_object=False, child_names=['unknown']))
+        assert remote_module.say_hello("earthling") == "hello, earthling!"
+
+        # proxies can not be sent to another daemon
+        with pytest.raises(PicklingError):
+            other.obj_proxy.total(acc)
+    finally:
+        other.terminate_daemon()
+        remote_module.terminate_daemon()
+
+
+def test_remote_iterators():
+    """ Tests that iterators returned by remote calls are streamed by chunks """
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')), iter_chunksize=7,
+                         iter_prefetch=2)
+    remote_module = daemon.obj_proxy
+    try:
+        rows = remote_module.read_rows(100)
+        assert isinstance(rows, RemoteIterator)
+        assert [r['i'] for r in rows] == list(range(100))
+        assert remote_module.handle_count() == 0
+
+        # remote containers
+        assert list(remote_module.odct) == ['a']
+
+        # errors are raised after the items produced before them
+        rows = remote_module.read_rows(10, fail=True)
+        rows.chunksize = 1000
+        assert next(rows) == {'i': 0}
+        assert len(list(islice(rows, 9))) == 9
+        with pytest.raises(ValueError):
+            next(rows)
+
+        # partially consumed iterators are released when garbage collected
+        rows = remote_module.read_rows(100)
+        assert next(rows) == {'i': 0}
+        del rows
+        gc.collect()
+        assert remote_module.handle_count() == 0
+        assert remote_module.say_hello("earthling") == "hello, earthling!"
+    finally:
+        remote_module.terminate_daemon()
+
+
+def test_lazy_expressions():
+    """ Tests that lazy expressions are evaluated by the daemon in a single round trip """
+    daemon = DaemonProxy(ModuleDefinition('dummy', module_path=join(RESOURCES_DIR, 'dummy.py')))
+    remote_module = daemon.obj_proxy
+    try:
+        with patch.object(daemon, 'remote_call_using_pipe', wraps=daemon.remote_call_using_pipe) as remote_call:
+            hello = daemon.lazy().foo.say_hello
+            assert hello("you").upper().fetch() == "[FOO-1] HELLO, YOU!"
+            assert daemon.lazy().odct['a'] == 1
+            assert remote_call.call_count == 2
+
+        lazy_odct = remote_module.lazy().odct
+        assert str(lazy_odct) == str(OrderedDict(a=1))
+        assert len(lazy_odct) == 1
+        assert 'a' in lazy_odct
+        assert list(lazy_odct) == ['a']
+        assert lazy_odct.get('b', 2) != 1
+        with pytest.raises(AttributeError):
+            daemon.lazy().unknown.fetch()
+    finally:
+        remote_module.terminate_daemon()
+
+
+@pytest.mark.parametrize("coalesce", [False, True], ids="coalesce={}".format)
+def test_set_remote_attributes(coalesce):
+    """ Tests that remote attributes can be set, possibly with write coalescing, and in batches """
+
+    script = """
+class Config(object):
+    def __init__(self):
+        self.values = dict()
+
+config = Config()
+frozen = (1, 2)
+"""
+    daemon = DaemonProxy(ScriptDefinition(script), coalesce_writes=coalesce)
+    remote_script = daemon.obj_proxy
+    try:
+        config = remote_script.config
+        with patch.object(daemon, 'remote_call_using_pipe', wraps=daemon.remote_call_using_pipe) as remote_call:
+            for i in range(10):
+                setattr(config, 'a%s' % i, i)
+            remote_script.threshold = 0.5
+            assert remote_call.call_count == (0 if coalesce else 11)
+        assert config.a9 == 9
+        assert remote_script.threshold == 0.5
+        assert remote_script.config.values == dict()
+
+        # errors
+        with pytest.raises(AttributeError):
+            remote_script.frozen.real = 1
+            daemon.flush_writes()
+
+        # batches
+        batch = remote_script.batch()
+        with batch as b:
+            b.config.b = 2
+            b.config.values
+        assert batch.results == [None, {}]
+        assert config.b == 2
+    finally:
+        remote_script.terminate_daemon()
+
+
+@pytest.mark.parametrize('threads', [None, 4], ids="threads={}".format)
+def test_threaded_daemon(threads):
+    """ Tests that the calls to thread-safe methods are executed concurrently when the daemon has threads """
+
+    script = """
+from threading import Lock
+from time import sleep
+from spawny import thread_safe
+
+lock = Lock()
+running = [0, 0]
+
+def _track(duration):
+    with lock:
+        running[0] += 1
+        running[1] = max(running)
+    sleep(duration)
+    with lock:
+        running[0] -= 1
+
+@thread_safe
+def fetch(duration):
+    _track(duration)
+    return 'fetched'
+
+def query(duration):
+    _track(duration)
+
+def write(duration):
+    _track(duration)
+
+def max_concurrency():
+    res = running[1]
+    running[1] = 0
+    return res
+"""
+    daemon = DaemonProxy(ScriptDefinition(script), threads=threads, thread_safe=['query'])
+    try:
+        for name, expected in (('fetch', 4), ('query', 4), ('write', 1)):
+            # through the object proxy: the attribute is resolved before each call, concurrently too
+            results = []
+            callers = [Thread(target=lambda: results.append(getattr(daemon.obj_proxy, name)(0.2))) for _ in range(4)]
+            for t in callers:
+                t.start()
+            for t in callers:
+                t.join()
+            assert results == [('fetched' if name == 'fetch' else None)] * 4
+            assert daemon.obj_proxy.max_concurrency() == (1 if threads is None else expected)
+    finally:
+        daemon.terminate_daemon()
+
+
+def test_is_plain_attribute_path():
+    """ Tests that reading attributes is only thread-safe if it does not execute code of the object """
+
+    class Foo(object):
+        __slots__ = 'a', 'empty'
+        b = 1
+
+        def m(self):
+            pass
+
+        @property
+        def p(self):
+            return 1
+
+    class Bar(object):
+        def __getattr__(self, item):
+            return 1
+
+    foo = Foo()
+    foo.a = Bar()
+    bar = Bar()
+    bar.foo = foo
+    assert is_plain_attribute_path(bar, ['foo', 'a'])
+    assert is_plain_attribute_path(bar, ['foo', 'b'])
+    assert is_plain_attribute_path(bar, ['foo', 'm'])
+    assert not is_plain_attribute_path(bar, ['foo', 'p'])
+    assert not is_plain_attribute_path(bar, ['foo', 'empty'])
+    assert not is_plain_attribute_path(bar, ['foo', 'a', 'dynamic'])
+    assert is_thread_safe_call(bar, 'resolve_attribute', dict(names=['foo', 'm']))
+    assert not is_thread_safe_call(bar, 'get_object', dict(names=['foo', 'p']))
+    assert is_plain_attribute_path(bar, ['foo', 'a', '__init__'])
+    assert is_plain_attribute_path([], ['append'])
+
+
+@pytest.mark.skipif(sys.version_info < (3, 8), reason="functools.cached_property")
+def test_is_plain_attribute_path_cached_property():
+    """ Tests that non-data descriptors are not read concurrently, unless their value is in the instance dict """
+    from functools import cached_property
+
+    class Foo(object):
+        @cached_property
+        def c(self):
+            return 1
+
+    foo = Foo()
+    assert not is_plain_attribute_path(foo, ['c'])
+    assert not is_thread_safe_call(foo, 'resolve_attribute', dict(names=['c']))
+    assert foo.c == 1
+    # now a plain instance attribute
+    assert is_plain_attribute_path(foo, ['c'])
+
+
+@pytest.mark.parametrize('on_timeout', ['raise', 'restart'])
+def test_timeouts(on_timeout):
+    """ Tests that calls time out, and that the daemon is kept or restarted """
+
+    script = """
+import os
+from time import sleep
+
+def slow(duration):
+    sleep(duration)
+    return duration
+
+def pid():
+    return os.getpid()
+"""
+    daemon = DaemonProxy(ScriptDefinition(script), timeout=0.5, on_timeout=on_timeout)
+    remote_script = daemon.obj_proxy
+    try:
+        pid = remote_script.pid()
+        assert remote_script.slow(0.1) == 0.1
+        with pytest.raises(DaemonTimeoutError):
+            remote_script.slow(1)
+
+        # per-call timeouts and deadlines
+        with pytest.raises(DaemonTimeoutError):
+            remote_script.slow.with_timeout(0.2)(0.4)
+        with pytest.raises(DaemonTimeoutError):
+            with daemon.deadline(0.3):
+                remote_script.slow(0.2)
+                remote_script.slow(0.2)
+
+        # the late responses were dropped
+        daemon.timeout = 5
+        assert remote_script.slow(0.2) == 0.2
+        if on_timeout == 'restart':
+            assert remote_script.pid() != pid
+        else:
+            assert remote_script.pid() == pid
+            assert len(daemon._responses) == 0
+
+        # calls in flight when the daemon is restarted
+        pending = daemon.remote_call_nowait(EXEC_CMD, call_method_on_object, to_execute_args=(1, ), names=['slow'])
+        daemon.restart()
+        with pytest.raises(DaemonRestartedError):
+            pending.result()
+        assert remote_script.slow(0) == 0
+    finally:
+        daemon.terminate_daemon()
+
+
+def test_timeout_while_another_thread_receives():
+    """ Tests that a response timing out while another thread receives is dropped when this thread receives it """
+
+    daemon = DaemonProxy(ScriptDefinition("from time import sleep\ndef slow(duration):\n    sleep(duration)\n"))
+    try:
+        first = daemon.remote_call_nowait(EXEC_CMD, call_method_on_object, to_execute_args=(0.3, ), names=['slow'])
+        second = daemon.remote_call_nowait(EXEC_CMD, call_method_on_object, to_execute_args=(0.3, ), names=['slow'])
+        # this thread receives the first response while waiting for the second one
+        receiver = Thread(target=second.result)
+        receiver.start()
+        sleep(0.1)
+        with pytest.raises(DaemonTimeoutError):
+            first.result(timeout=0.1)
+        receiver.join()
+        assert len(daemon._responses) == 0
+        assert len(daemon._discarded) == 0
+    finally:
+        daemon.terminate_daemon()
+
+@pytest.mark.skipif(PY2, reason="the process sentinel requires python 3.3+")
+def test_daemon_died():
+    """ Tests that the death of the daemon is detected immediately, with its exit code """
+
+    script = """
+import os
+import signal
+
+def crash():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def exit_now(code):
+    os._exit(code)
+"""
+    daemon = DaemonProxy(ScriptDefinition(script))
+    with pytest.raises(DaemonDiedError) as exc_info:
+        daemon.obj_proxy.crash()
+    assert exc_info.value.signal == 9
+
+    # subsequent calls fail too, and the proxy can still be terminated
+    with pytest.raises(DaemonDiedError):
+        daemon.obj_proxy.crash()
+    daemon.terminate_daemon()
+
+    daemon = DaemonProxy(ScriptDefinition(script))
+    with pytest.raises(DaemonDiedError) as exc_info:
+        daemon.obj_proxy.exit_now(3)
+    assert exc_info.value.exitcode == 3
+    daemon.terminate_daemon()
+
+
+def test_terminate_all():
+    """ Tests that daemons are terminated together, and that stuck daemons are killed after the grace period """
+
+    script = """
+import signal
+import time
+
+def ignore_sigterm():
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def block():
+    time.sleep(60)
+"""
+    daemons = [DaemonProxy(ScriptDefinition(script)) for _ in range(4)]
+    processes = [d.p for d in daemons]
+
+    # two daemons are stuck in a call, one of them ignoring SIGTERM
+    daemons[0].obj_proxy.ignore_sigterm()
+    for d in daemons[:2]:
+        d.remote_call_nowait(EXEC_CMD, call_method_on_object, names=['block'])
+
+    start = time()
+    terminate_all(daemons, grace=0.5)
+    assert time() - start < 5
+    assert not any(p.is_alive() for p in processes)
+    assert processes[0].exitcode == -9
+    assert processes[1].exitcode == -15
+    assert processes[2].exitcode == processes[3].exitcode == 0
+    assert not any(d.is_started() for d in daemons)
+
+    # terminating again does nothing
+    terminate_all(daemons)
@@ -0,0 +1,107 @@
+from threading import Thread
+from time import sleep
+
+import pytest
+
+try:  # python 3.3+
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from spawny import DaemonPool, DaemonProxy, ScriptDefinition, WarmSpares
+
+SCRIPT = """
+import os
+from time import sleep
+
+def slow_pid(duration):
+    sleep(duration)
+    return os.getpid()
+
+def square(x):
+    return x * x
+
+def identity(x):
+    return x
+"""
+
+
+def test_pool_least_loaded_routing():
+    """ Tests that concurrent calls on a pool are routed to different workers """
+    with DaemonPool(ScriptDefinition(SCRIPT), size=3) as pool:
+        assert len(set(w.p.pid for w in pool.workers)) == 3
+
+        pids = []
+        threads = [Thread(target=lambda: pids.append(pool.obj_proxy.slow_pid(0.3))) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # each call was sent to a different worker, since the other ones were busy
+        assert sorted(pids) == sorted(w.p.pid for w in pool.workers)
+        assert pool.inflight() == [0, 0, 0]
+
+
+def test_pool_map():
+    """ Tests that pool-level map distributes the chunks and returns the results in order """
+    with DaemonPool(ScriptDefinition(SCRIPT), size=2) as pool:
+        assert pool.obj_proxy.square.map(range(1000), chunksize=7) == [x * x for x in range(1000)]
+        assert pool.inflight() == [0, 0]
+
+
+def test_pool_map_large_chunks():
+    """ Tests that mapping with chunks larger than the pipe buffer does not deadlock, and that kwargs are forwarded """
+    with DaemonPool(ScriptDefinition(SCRIPT), size=2, timeout=30) as pool:
+        assert [w.timeout for w in pool.workers] == [30, 30]
+        items = [bytes(bytearray([i % 256])) * 2000 for i in range(6000)]
+        assert pool.obj_proxy.identity.map(items, chunksize=1000) == items
+        assert pool.inflight() == [0, 0]
+
+
+def test_warm_spares():
+    """ Tests that warm spares are handed out and refilled in the background """
+    with WarmSpares(ScriptDefinition(SCRIPT), spares=2) as spares:
+        d1 = spares.acquire(timeout=10)
+        d2 = spares.acquire(timeout=10)
+        try:
+            assert d1.p.pid != d2.p.pid
+            assert d1.obj_proxy.square(3) == 9
+
+            # the spares are refilled
+            d3 = spares.acquire(timeout=10)
+            d3.terminate_daemon()
+            for _ in range(100):
+                if spares.ready_count() == 2:
+                    break
+                sleep(0.05)
+            assert spares.ready_count() == 2
+        finally:
+            d1.terminate_daemon()
+            d2.terminate_daemon()
+
+    with pytest.raises(ValueError):
+        spares.acquire()
+
+
+def test_warm_spares_spawn_failure():
+    """ Tests that a failed spawn is reported once by `acquire` and retried in the background """
+    def flaky_daemon(*args, **kwargs):
+        if flaky_daemon.failures > 0:
+            flaky_daemon.failures -= 1
+            raise OSError("transient failure")
+        return DaemonProxy(*args, **kwargs)
+    flaky_daemon.failures = 1
+
+    with patch('spawny.main_pool.SPAWN_RETRY_DELAY', 0.5), patch('spawny.main_pool.DaemonProxy', flaky_daemon):
+        with WarmSpares(ScriptDefinition(SCRIPT), timeout=30) as spares:
+            with pytest.raises(OSError):
+                spares.acquire(timeout=10)
+
+            # the error is not raised again, the next spare is ready after the retry
+            d = spares.acquire(timeout=10)
+            try:
+                assert d.timeout == 30
+                assert d.obj_proxy.square(3) == 9
+            finally:
+                d.terminate_daemon()
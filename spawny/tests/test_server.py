@@ -0,0 +1,95 @@
+import multiprocessing as mp
+import os
+from threading import Thread
+from time import sleep
+
+import pytest
+
+from spawny import ConnectedDaemonProxy, DaemonConnectionPool, DaemonServer, ScriptDefinition
+from spawny.main_server import parse_address
+
+SCRIPT = """
+import os
+from spawny.main import _handles
+
+counter = [0]
+
+def incr():
+    counter[0] += 1
+    return counter[0]
+
+def make_list(n):
+    return list(range(n))
+
+def handle_count():
+    return len(_handles)
+"""
+
+AUTHKEY = b'secret'
+
+
+def _serve(address):
+    DaemonServer(ScriptDefinition(SCRIPT), address, authkey=AUTHKEY).serve_forever()
+
+
+@pytest.fixture
+def server_address(tmpdir):
+    address = str(tmpdir.join('spawny.sock'))
+    p = mp.Process(target=_serve, args=(address, ))
+    p.start()
+    try:
+        for _ in range(200):
+            if os.path.exists(address):
+                break
+            sleep(0.05)
+        yield address
+    finally:
+        p.terminate()
+        p.join()
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="unix sockets")
+def test_connected_daemons(server_address):
+    """ Tests that several clients share the object served by a daemon server """
+    d1 = ConnectedDaemonProxy(server_address, authkey=AUTHKEY)
+    d2 = ConnectedDaemonProxy(server_address, authkey=AUTHKEY, results_by_ref=True)
+    assert d1.p.pid == d2.p.pid != os.getpid()
+
+    assert d1.obj_proxy.incr() == 1
+    assert d2.obj_proxy.incr.by_value() == 2
+
+    # handles are released when their connection is closed
+    l = d2.obj_proxy.make_list(3)
+    assert d2.fetch(l) == [0, 1, 2]
+    assert d1.obj_proxy.handle_count() == 1
+    d2.terminate_daemon()
+    assert d1.obj_proxy.handle_count() == 0
+
+    # the server is still alive
+    assert d1.obj_proxy.incr() == 3
+    with pytest.raises(ValueError):
+        d1.fork()
+    d1.terminate_daemon()
+
+    with pytest.raises(Exception):
+        ConnectedDaemonProxy(server_address, authkey=b'wrong')
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="unix sockets")
+def test_connection_pool(server_address):
+    """ Tests that a connection pool spreads the calls of several threads over its connections """
+    with DaemonConnectionPool(server_address, size=3, authkey=AUTHKEY) as pool:
+        results = []
+        threads = [Thread(target=lambda: results.extend(pool.obj_proxy.incr() for _ in range(10))) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(results) == list(range(1, 31))
+        assert pool.inflight() == [0, 0, 0]
+
+
+def test_parse_address():
+    assert parse_address('localhost:5000') == ('localhost', 5000)
+    assert parse_address(':5000') == ('127.0.0.1', 5000)
+    assert parse_address('/tmp/spawny.sock') == '/tmp/spawny.sock'
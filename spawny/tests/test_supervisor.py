@@ -0,0 +1,80 @@
+import os
+import sys
+from time import sleep, time
+
+import pytest
+
+from spawny import SupervisedDaemonProxy, ScriptDefinition, DaemonDiedError, DaemonRestartedError
+from spawny.main import EXEC_CMD, call_method_on_object
+
+SCRIPT = """
+import os
+import signal
+
+def pid():
+    return os.getpid()
+
+def crash():
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def freeze():
+    os.kill(os.getpid(), signal.SIGSTOP)
+
+def crash_once(path):
+    if not os.path.exists(path):
+        open(path, 'w').close()
+        crash()
+    return 'done'
+"""
+
+
+def _wait_for_generation(daemon, generation):
+    for _ in range(100):
+        if daemon.generation >= generation:
+            return
+        sleep(0.05)
+    raise AssertionError("The daemon was not respawned")
+
+
+@pytest.mark.skipif(sys.version_info < (3, 3) or not hasattr(os, 'kill'), reason="posix signals, process sentinel")
+def test_supervised_daemon(tmpdir):
+    """ Tests that a supervised daemon is respawned when it dies or freezes, and the failover policies """
+    daemon = SupervisedDaemonProxy(ScriptDefinition(SCRIPT), heartbeat_interval=0.1, heartbeat_timeout=0.5)
+    remote_script = daemon.obj_proxy
+    try:
+        pid = remote_script.pid()
+        assert daemon.ping(1)
+
+        # death: the call fails, and the daemon is respawned immediately
+        with pytest.raises(DaemonDiedError):
+            remote_script.crash()
+        _wait_for_generation(daemon, 1)
+        new_pid = remote_script.pid()
+        assert new_pid != pid
+
+        # frozen daemon: it does not answer the heartbeats anymore
+        with pytest.raises(DaemonRestartedError):
+            remote_script.freeze()
+        assert daemon.generation == 2
+        assert remote_script.pid() != new_pid
+
+        # retry policy: the call is sent again to the new daemon
+        daemon.failover = 'retry'
+        assert remote_script.crash_once(str(tmpdir.join('crashed'))) == 'done'
+        assert daemon.generation == 3
+    finally:
+        daemon.terminate_daemon()
+    assert not daemon._watcher.is_alive()
+
+
+@pytest.mark.skipif(sys.version_info < (3, 3) or not hasattr(os, 'kill'), reason="posix signals, process sentinel")
+def test_supervised_daemon_terminate_while_pinging():
+    """ Tests that terminating a frozen supervised daemon does not wait for the heartbeat timeout """
+    daemon = SupervisedDaemonProxy(ScriptDefinition(SCRIPT), heartbeat_interval=0.05, heartbeat_timeout=30)
+    daemon.remote_call_nowait(EXEC_CMD, call_method_on_object, names=['freeze'])
+    # let the watching thread wait for a heartbeat answer
+    sleep(0.5)
+    start = time()
+    daemon.terminate_daemon(grace=0.5)
+    assert time() - start < 5
+    assert daemon.generation == 0
@@ -0,0 +1,136 @@
+try:  # python 3.3+
+    from time import monotonic as _now
+except ImportError:
+    from time import time as _now
+
+try:  # python 3.5+
+    from typing import Union, Any, List, Tuple, Type, Optional
+except ImportError:
+    pass
+
+
+CACHE_ALWAYS = 'always'
+"""Cache policy: once fetched, the metadata of an attribute is trusted until it is explicitly invalidated"""
+
+CACHE_NEVER = 'never'
+"""Cache policy: the metadata of an attribute is fetched from the daemon on every access"""
+
+
+def _check_policy(policy  # type: Union[str, float, int]
+                  ):
+    # type: (...) -> Union[str, float]
+    """
+    Validates a cache policy. Valid policies are `CACHE_ALWAYS`, `CACHE_NEVER`, or a strictly positive number
+    representing the time-to-live of cache entries, in seconds.
+
+    :param policy:
+    :return: the policy, where a time-to-live is converted to float
+    """
+    if policy in (CACHE_ALWAYS, CACHE_NEVER):
+        return policy
+    try:
+        if isinstance(policy, bool):
+            raise TypeError()
+        ttl = float(policy)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid attribute cache policy: %r. It should be %r, %r, or a time-to-live in seconds"
+                         % (policy, CACHE_ALWAYS, CACHE_NEVER))
+    if ttl <= 0:
+        raise ValueError("Invalid attribute cache policy: time-to-live should be strictly positive, found %s" % ttl)
+    return ttl
+
+
+class AttrMetadataCache(object):
+    """
+    A client-side cache of the metadata of remote attributes, keyed on the attribute path from the daemon's root object
+    (the `names` list used by `ObjectProxy`). For each path it stores whether the attribute is a function or an object,
+    and in the latter case its remote type (a `TypeDescriptor` if the type could not be sent by the daemon).
+
+    It is used by `ObjectProxy.__getattr__` to avoid asking the daemon the same questions over and over again.
+    """
+    __slots__ = '_policy', '_entries'
+
+    def __init__(self,
+                 policy=CACHE_NEVER  # type: Union[str, float, int]
+                 ):
+        """
+
+        :param policy: `CACHE_NEVER` (default) to disable the cache, `CACHE_ALWAYS` to trust cached entries until they
+            are explicitly invalidated, or a number of seconds after which an entry expires.
+        """
+        self._policy = _check_policy(policy)
+        self._entries = dict()
+
+    @property
+    def policy(self):
+        # type: (...) -> Union[str, float]
+        return self._policy
+
+    @policy.setter
+    def policy(self, policy):
+        self._policy = _check_policy(policy)
+        if policy == CACHE_NEVER:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self,
+            names  # type: List[str]
+            ):
+        # type: (...) -> Optional[Tuple[bool, Optional[Type[Any]]]]
+        """
+        Returns the cached (is_function, type) tuple for attribute path `names`, or None if there is no valid entry.
+
+        :param names:
+        :return:
+        """
+        if self._policy == CACHE_NEVER:
+            return None
+
+        key = tuple(names)
+        try:
+            is_func, typ, stored_at = self._entries[key]
+        except KeyError:
+            return None
+
+        if self._policy != CACHE_ALWAYS and (_now() - stored_at) > self._policy:
+            # expired
+            self._entries.pop(key, None)
+            return None
+
+        return is_func, typ
+
+    def put(self,
+            names,    # type: List[str]
+            is_func,  # type: bool
+            typ       # type: Optional[Type[Any]]
+            ):
+        """
+        Stores the metadata for attribute path `names`. This is a no-op if the policy is `CACHE_NEVER`.
+
+        :param names:
+        :param is_func:
+        :param typ:
+        :return:
+        """
+        if self._policy != CACHE_NEVER:
+            self._entries[tuple(names)] = (is_func, typ, _now())
+
+    def invalidate(self,
+                   names=None  # type: List[str]
+                   ):
+        """
+        Removes the entry for attribute path `names` and for all its sub-paths (`names + [...]`). If `names` is None
+        the whole cache is cleared.
+
+        :param names:
+        :return:
+        """
+        if names is None:
+            self._entries.clear()
+        else:
+            prefix = tuple(names)
+            n = len(prefix)
+            for key in [k for k in self._entries if k[0:n] == prefix]:
+                self._entries.pop(key, None)
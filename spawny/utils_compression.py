@@ -0,0 +1,205 @@
+import zlib
+from threading import Lock
+from timeit import default_timer
+
+from six import string_types
+
+try:  # python 3.3+
+    import lzma
+except ImportError:
+    lzma = None
+
+try:  # python 3.5+
+    from typing import Union, Dict
+except ImportError:
+    pass
+
+
+class Compressor(object):
+    """
+    Base class of the codecs used to compress the large messages exchanged with the daemons. Compressors are sent to
+    the daemon when it is spawned, so they should be picklable.
+    """
+    __slots__ = ()
+
+    name = None  # type: str
+
+    def __repr__(self):
+        return '%s()' % self.__class__.__name__
+
+    def compress(self,
+                 data  # type: bytes
+                 ):
+        # type: (...) -> bytes
+        raise NotImplementedError()
+
+    def decompress(self,
+                   data  # type: bytes
+                   ):
+        # type: (...) -> bytes
+        raise NotImplementedError()
+
+
+class ZlibCompressor(Compressor):
+    """A compressor using `zlib` at its fastest level, a good default for text and pickled python structures."""
+    __slots__ = ()
+
+    name = 'zlib'
+
+    def compress(self, data):
+        return zlib.compress(data, 1)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class LzmaCompressor(Compressor):
+    """
+    A compressor using `lzma` at its fastest preset. Much slower than zlib but compresses better: it may pay off for
+    huge and very redundant messages. Requires python 3.3+.
+    """
+    __slots__ = ()
+
+    name = 'lzma'
+
+    def compress(self, data):
+        return lzma.compress(data, preset=1)
+
+    def decompress(self, data):
+        return lzma.decompress(data)
+
+
+class Lz4Compressor(Compressor):
+    """
+    A compressor using the `lz4` frame format, that compresses less than zlib but is several times faster.
+    `lz4` should be installed on both sides.
+    """
+    __slots__ = ()
+
+    name = 'lz4'
+
+    def compress(self, data):
+        import lz4.frame
+        return lz4.frame.compress(data)
+
+    def decompress(self, data):
+        import lz4.frame
+        return lz4.frame.decompress(data)
+
+
+COMPRESSORS = dict((c.name, c) for c in (ZlibCompressor, LzmaCompressor, Lz4Compressor))
+"""The compressors available by name"""
+
+
+def get_compressor(compression  # type: Union[str, Compressor]
+                   ):
+    # type: (...) -> Compressor
+    """
+    Returns the `Compressor` corresponding to `compression`: either a compressor instance or one of the names in
+    `COMPRESSORS`.
+
+    :param compression:
+    :return:
+    """
+    if isinstance(compression, Compressor):
+        return compression
+    elif isinstance(compression, string_types):
+        try:
+            compressor_cls = COMPRESSORS[compression]
+        except KeyError:
+            raise ValueError("Unknown compression: %r. Available compressions: %s" % (compression, sorted(COMPRESSORS)))
+        # fail early if an optional dependency is missing
+        if compression == LzmaCompressor.name:
+            if lzma is None:
+                raise ValueError("The lzma compression requires python 3.3+")
+        elif compression == Lz4Compressor.name:
+            import lz4.frame  # noqa
+        return compressor_cls()
+    else:
+        raise TypeError("compression should be a name or a `Compressor` instance, found: %r" % compression)
+
+
+class CompressionStats(object):
+    """
+    Statistics about the messages compressed and decompressed by one side of a `Transport`:
+
+     - `compressed_count`, `raw_bytes` and `compressed_bytes`: the number of messages sent compressed, and their total
+       size before and after compression. `ratio` is the compressed size divided by the original size.
+     - `uncompressed_count`: the number of messages above the threshold sent uncompressed since compression did not
+       reduce them.
+     - `compress_time`: the total time spent compressing, in seconds.
+     - `decompressed_count` and `decompress_time`: the number of messages received compressed, and the total time spent
+       decompressing them.
+
+    Use `as_dict` to get a consistent snapshot from any thread.
+    """
+    __slots__ = '_lock', 'compressed_count', 'uncompressed_count', 'raw_bytes', 'compressed_bytes', 'compress_time', \
+                'decompressed_count', 'decompress_time'
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Resets all counters to zero"""
+        with self._lock:
+            self.compressed_count = 0
+            self.uncompressed_count = 0
+            self.raw_bytes = 0
+            self.compressed_bytes = 0
+            self.compress_time = 0.
+            self.decompressed_count = 0
+            self.decompress_time = 0.
+
+    @property
+    def ratio(self):
+        # type: (...) -> float
+        """The compressed size divided by the original size of the messages sent compressed. None if there was none"""
+        with self._lock:
+            return self.compressed_bytes / float(self.raw_bytes) if self.raw_bytes > 0 else None
+
+    def as_dict(self):
+        # type: (...) -> Dict[str, Union[int, float]]
+        """Returns a snapshot of all counters, and the compression ratio"""
+        ratio = self.ratio
+        with self._lock:
+            res = dict((k, getattr(self, k)) for k in self.__slots__ if not k.startswith('_'))
+        res['ratio'] = ratio
+        return res
+
+    def __repr__(self):
+        return 'CompressionStats<%s>' % ', '.join('%s=%s' % item for item in sorted(self.as_dict().items()))
+
+    def compress(self,
+                 compressor,  # type: Compressor
+                 data         # type: bytes
+                 ):
+        # type: (...) -> bytes
+        """Compresses data with compressor. Returns None if the compressed data is not smaller than data"""
+        start = default_timer()
+        compressed = compressor.compress(data)
+        elapsed = default_timer() - start
+        with self._lock:
+            self.compress_time += elapsed
+            if len(compressed) < len(data):
+                self.compressed_count += 1
+                self.raw_bytes += len(data)
+                self.compressed_bytes += len(compressed)
+            else:
+                self.uncompressed_count += 1
+                compressed = None
+        return compressed
+
+    def decompress(self,
+                   compressor,  # type: Compressor
+                   data         # type: bytes
+                   ):
+        # type: (...) -> bytes
+        """Decompresses data with compressor"""
+        start = default_timer()
+        res = compressor.decompress(data)
+        elapsed = default_timer() - start
+        with self._lock:
+            self.decompressed_count += 1
+            self.decompress_time += elapsed
+        return res
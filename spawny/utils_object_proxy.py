@@ -3,6 +3,57 @@ from types import MethodType
 
 from spawny.utils_logging import default_logger
 
+try:  # python 3.5+
+    from typing import Any, List, Type, Union
+except ImportError:
+    pass
+
+
+class TypeDescriptor(object):
+    """
+    A picklable description of a remote type, used when the type itself can not be sent over the wire (for example
+    when it is defined in a module that can not be imported on the client side). It contains the names of the
+    dunder methods of the type, so that object proxies can still be configured with them.
+    """
+    __slots__ = 'module', 'name', 'dunder_names'
+
+    def __init__(self,
+                 module,       # type: str
+                 name,         # type: str
+                 dunder_names  # type: List[str]
+                 ):
+        self.module = module
+        self.name = name
+        self.dunder_names = dunder_names
+
+    @staticmethod
+    def create_from(typ  # type: Type[Any]
+                    ):
+        # type: (...) -> TypeDescriptor
+        return TypeDescriptor(getattr(typ, '__module__', None), getattr(typ, '__qualname__', typ.__name__),
+                              [n for n in dir(typ) if n.startswith('__')])
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<remote type '%s.%s'>" % (self.module, self.name)
+
+
+def get_dunder_names(cls_or_descriptor  # type: Union[Type[Any], TypeDescriptor]
+                     ):
+    # type: (...) -> List[str]
+    """
+    Returns the list of dunder names available on a class or described in a `TypeDescriptor`.
+
+    :param cls_or_descriptor:
+    :return:
+    """
+    if isinstance(cls_or_descriptor, TypeDescriptor):
+        return cls_or_descriptor.dunder_names
+    else:
+        return [name for name in dir(cls_or_descriptor) if name.startswith("__")]
+
 
 def replace_all_dundermethods_with_getattr(ignore,
                                            from_cls,
@@ -23,7 +74,8 @@ def replace_all_dundermethods_with_getattr(ignore,
     replaced
 
     :param ignore: a list of names to ignore
-    :param from_cls: the original class from which all not ignored dunder methods should be copied
+    :param from_cls: the original class from which all not ignored dunder methods should be copied. It may also be a
+        `TypeDescriptor`
     :param to_cls_or_inst:
     :param is_class:
     :param logger:
@@ -35,7 +87,7 @@ def replace_all_dundermethods_with_getattr(ignore,
             return self.__getattr__(name)
         return proxy
 
-    to_replace = [name for name in dir(from_cls) if name.startswith("__") and name not in ignore]
+    to_replace = [name for name in get_dunder_names(from_cls) if name not in ignore]
     if is_class:
         logger.debug('Replacing methods ' + str(to_replace) + ' on class ' + to_cls_or_inst.__name__
                      + ' by explicit calls to __getattr__')
@@ -0,0 +1,222 @@
+import io
+import marshal
+from pickle import loads as pickle_loads
+
+from six import string_types
+
+try:  # python 3.3+
+    from collections import ChainMap
+    from multiprocessing.reduction import ForkingPickler
+except ImportError:
+    from multiprocessing.forking import ForkingPickler
+
+try:  # python 3.5+
+    from typing import Any, Union
+except ImportError:
+    pass
+
+
+class Serializer(object):
+    """
+    Base class of the codecs used to convert the messages exchanged with the daemons to bytes and back. Serializers are
+    sent to the daemon when it is spawned, so they should be picklable.
+
+    Messages are tuples containing the request id, the command or response flag, and python objects (function to
+    execute, arguments, results, exceptions). The serializer of a daemon is used to serialize all of them.
+    """
+    __slots__ = ()
+
+    name = None  # type: str
+
+    def __repr__(self):
+        return '%s()' % self.__class__.__name__
+
+    def dumps(self,
+              obj  # type: Any
+              ):
+        # type: (...) -> bytes
+        raise NotImplementedError()
+
+    def loads(self,
+              data  # type: bytes
+              ):
+        # type: (...) -> Any
+        raise NotImplementedError()
+
+
+class PickleSerializer(Serializer):
+    """
+    The default serializer, using the same pickler than `multiprocessing.Connection.send` (able to send connections).
+    """
+    __slots__ = ()
+
+    name = 'pickle'
+
+    def dumps(self, obj):
+        return ForkingPickler.dumps(obj)
+
+    def loads(self, data):
+        return pickle_loads(data)
+
+
+class CloudpickleSerializer(Serializer):
+    """
+    A serializer based on `cloudpickle`, able to send lambda functions, closures and classes defined interactively.
+    `cloudpickle` should be installed on both sides.
+    """
+    __slots__ = ()
+
+    name = 'cloudpickle'
+
+    def dumps(self, obj):
+        buf = io.BytesIO()
+        _get_cloud_pickler_cls()(buf).dump(obj)
+        return buf.getvalue()
+
+    def loads(self, data):
+        return pickle_loads(data)
+
+
+_cloud_pickler_cls = None
+
+
+def _get_cloud_pickler_cls():
+    """
+    Returns a subclass of `cloudpickle.CloudPickler` that also uses the reducers registered by multiprocessing, so that
+    connections can be sent. It is created on first use since cloudpickle is optional.
+    """
+    global _cloud_pickler_cls
+    if _cloud_pickler_cls is None:
+        from cloudpickle import CloudPickler
+
+        class _CloudPickler(CloudPickler):
+            # the dispatch table is read when the pickler is created: it has to be a class attribute
+            dispatch_table = ChainMap(ForkingPickler._extra_reducers, CloudPickler.dispatch_table)
+
+        _cloud_pickler_cls = _CloudPickler
+    return _cloud_pickler_cls
+
+
+# the first byte of the messages encoded by a `FallbackSerializer`
+_ENCODED_TAG = b'\x01'
+_PICKLED_TAG = b'\x00'
+
+
+class FallbackSerializer(Serializer):
+    """
+    Base class for fast serializers supporting a limited set of types. Messages that can not be encoded are pickled
+    instead. The first byte of each encoded message tells which one was used.
+    """
+    __slots__ = ()
+
+    def encode(self, obj):
+        # type: (...) -> bytes
+        """Encodes obj, or raises a `TypeError` or `ValueError` if it contains unsupported types"""
+        raise NotImplementedError()
+
+    def decode(self, data):
+        """Decodes data returned by `encode`"""
+        raise NotImplementedError()
+
+    def dumps(self, obj):
+        try:
+            return _ENCODED_TAG + self.encode(obj)
+        except (TypeError, ValueError):
+            return _PICKLED_TAG + ForkingPickler.dumps(obj)
+
+    def loads(self, data):
+        data = memoryview(data)
+        if data[0:1] == _ENCODED_TAG:
+            return self.decode(data[1:])
+        else:
+            return pickle_loads(data[1:])
+
+
+class MarshalSerializer(FallbackSerializer):
+    """
+    A serializer using `marshal` for messages containing only builtin types (None, bool, int, float, complex, str,
+    bytes, tuple, list, dict, set...), which is much faster than pickle for them. Other messages are pickled.
+
+    Since the `marshal` format may change between python versions, only use it when the daemon runs the same python
+    version than the client.
+    """
+    __slots__ = ()
+
+    name = 'marshal'
+
+    def encode(self, obj):
+        return marshal.dumps(obj)
+
+    def decode(self, data):
+        return marshal.loads(data)
+
+
+_MSGPACK_TUPLE = 1
+"""The msgpack extension type code used to encode tuples (msgpack only has arrays)"""
+
+
+class MsgpackSerializer(FallbackSerializer):
+    """
+    A serializer using `msgpack` for messages containing only None, bool, int, float, str, bytes, tuple, list and dict.
+    Other messages are pickled. `msgpack` should be installed on both sides.
+    """
+    __slots__ = ()
+
+    name = 'msgpack'
+
+    def encode(self, obj):
+        import msgpack
+        return msgpack.packb(obj, use_bin_type=True, strict_types=True, default=_msgpack_default)
+
+    def decode(self, data):
+        import msgpack
+        return msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=_msgpack_ext_hook)
+
+
+def _msgpack_default(obj):
+    if type(obj) is tuple:
+        import msgpack
+        return msgpack.ExtType(_MSGPACK_TUPLE, msgpack.packb(list(obj), use_bin_type=True, strict_types=True,
+                                                             default=_msgpack_default))
+    raise TypeError("Can not encode %r with msgpack" % type(obj))
+
+
+def _msgpack_ext_hook(code, data):
+    if code == _MSGPACK_TUPLE:
+        import msgpack
+        return tuple(msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=_msgpack_ext_hook))
+    raise ValueError("Unknown msgpack extension type: %s" % code)
+
+
+SERIALIZERS = dict((s.name, s) for s in (PickleSerializer, CloudpickleSerializer, MarshalSerializer,
+                                         MsgpackSerializer))
+"""The serializers available by name"""
+
+
+def get_serializer(serializer=None  # type: Union[str, Serializer]
+                   ):
+    # type: (...) -> Serializer
+    """
+    Returns the `Serializer` corresponding to `serializer`: either a serializer instance, one of the names in
+    `SERIALIZERS`, or None for the default `PickleSerializer`.
+
+    :param serializer:
+    :return:
+    """
+    if serializer is None:
+        return PickleSerializer()
+    elif isinstance(serializer, Serializer):
+        return serializer
+    elif isinstance(serializer, string_types):
+        try:
+            serializer_cls = SERIALIZERS[serializer]
+        except KeyError:
+            raise ValueError("Unknown serializer: %r. Available serializers: %s" % (serializer, sorted(SERIALIZERS)))
+        # fail early if an optional dependency is missing
+        if serializer == CloudpickleSerializer.name:
+            import cloudpickle  # noqa
+        elif serializer == MsgpackSerializer.name:
+            import msgpack  # noqa
+        return serializer_cls()
+    else:
+        raise TypeError("serializer should be a name or a `Serializer` instance, found: %r" % serializer)
@@ -0,0 +1,537 @@
+import io
+import mmap
+import os
+import struct
+from multiprocessing.connection import Connection
+from pickle import Pickler, Unpickler
+
+try:  # python 3.8+
+    from multiprocessing import shared_memory, resource_tracker
+    from multiprocessing.reduction import ForkingPickler
+except ImportError:
+    shared_memory = resource_tracker = None
+    ForkingPickler = Pickler
+
+try:  # python 3.8+, posix
+    import _posixshmem
+except ImportError:
+    _posixshmem = None
+
+try:  # python 3.4+
+    from multiprocessing.reduction import ForkingPickler as _ForkingPickler
+    _pickle_dumps = _ForkingPickler.dumps
+except (ImportError, AttributeError):
+    # python 2: messages are pickled by `Connection.send`
+    _pickle_dumps = None
+
+try:  # python 3.5+
+    from typing import Any, Iterable, List, Tuple, Optional, Union
+except ImportError:
+    pass
+
+from spawny.utils_compression import Compressor, CompressionStats, get_compressor
+from spawny.utils_serializers import Serializer, PickleSerializer, get_serializer
+
+
+OOB_AVAILABLE = shared_memory is not None
+"""Out-of-band buffers require python 3.8+ (pickle protocol 5)"""
+
+SHM_AVAILABLE = OOB_AVAILABLE and _posixshmem is not None
+"""Shared memory transport requires python 3.8+ (pickle protocol 5 and `multiprocessing.shared_memory`), and posix
+shared memory since segments must survive the sender closing them"""
+
+
+# the kinds of buffers sent out-of-band
+_BYTES = 0
+_BYTEARRAY = 1
+_PICKLE_BUFFER = 2
+
+# the first byte of the messages when compression is enabled
+_RAW_TAG = b'\x00'
+_COMPRESSED_TAG = b'\x01'
+
+DEFAULT_COMPRESSION_THRESHOLD = 65536
+"""The default size in bytes from which messages are compressed, when compression is enabled"""
+
+
+class _OobPickler(ForkingPickler):
+    """
+    A pickler sending large buffers out-of-band. Pickle protocol 5 out-of-band buffers (numpy arrays...) are handled with
+    the `buffer_callback`. Since `bytes` and `bytearray` are pickled in-band even with protocol 5, the ones larger than
+    the threshold are handled as persistent objects instead: `save_buffer` is called to store them, and returns their
+    id.
+    """
+    def __init__(self, file, buffer_callback, threshold, save_buffer):
+        # `ForkingPickler.__init__` does not accept keyword arguments: reproduce it
+        Pickler.__init__(self, file, 5, buffer_callback=buffer_callback)
+        self.dispatch_table = self._copyreg_dispatch_table.copy()
+        self.dispatch_table.update(self._extra_reducers)
+        self.threshold = threshold
+        self.save_buffer = save_buffer
+        # persistent ids are looked up before the memo: remember them so that shared objects are only sent once
+        self.saved = dict()
+
+    def persistent_id(self, obj):
+        typ = type(obj)
+        if (typ is bytes or typ is bytearray) and len(obj) >= self.threshold:
+            try:
+                return self.saved[id(obj)][0]
+            except KeyError:
+                pid = self.save_buffer(memoryview(obj), _BYTES if typ is bytes else _BYTEARRAY)
+                # keep a reference on obj so that its id is not reused
+                self.saved[id(obj)] = pid, obj
+                return pid
+        return None
+
+
+class _OobUnpickler(Unpickler):
+    """The unpickler associated with `_OobPickler`. `load_buffer` returns the object with the given persistent id."""
+    def __init__(self, file, buffers, load_buffer):
+        Unpickler.__init__(self, file, buffers=buffers)
+        self.load_buffer = load_buffer
+
+    def persistent_load(self, pid):
+        return self.load_buffer(pid)
+
+
+def _recv_bytes_into(conn,
+                     buf  # type: bytearray
+                     ):
+    """
+    Receives the next frame sent with `conn.send_bytes` into `buf`, whose size should be the frame size.
+
+    `Connection.recv_bytes_into` reads the frame into an intermediate `BytesIO` before copying it into `buf`. For
+    connections based on a unix file descriptor, we rather parse the frame header (a signed 4-bytes size, or -1 followed
+    by an unsigned 8-bytes size) and read the contents directly into `buf`.
+
+    :param conn:
+    :param buf:
+    :return:
+    """
+    if not isinstance(conn, Connection) or not hasattr(os, 'readv'):
+        conn.recv_bytes_into(buf)
+        return
+
+    fd = conn.fileno()
+    size, = struct.unpack("!i", _read_exactly(fd, 4))
+    if size == -1:
+        size, = struct.unpack("!Q", _read_exactly(fd, 8))
+    if size != len(buf):
+        raise ValueError("Received a frame of %s bytes, expected %s" % (size, len(buf)))
+    view = memoryview(buf)
+    while len(view) > 0:
+        n = os.readv(fd, [view])
+        if n == 0:
+            raise EOFError
+        view = view[n:]
+
+
+def _read_exactly(fd,   # type: int
+                  size  # type: int
+                  ):
+    # type: (...) -> bytes
+    chunks = []
+    while size > 0:
+        chunk = os.read(fd, size)
+        if len(chunk) == 0:
+            raise EOFError
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _unlink_segment(shm):
+    """
+    Closes and destroys a segment that was unregistered from the resource tracker (see `Transport.send`)
+
+    :param shm:
+    :return:
+    """
+    shm.close()
+    # register it again so that unlink, that unregisters it, leaves the resource tracker in a consistent state
+    resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+def _map_segment(name,  # type: str
+                 size   # type: int
+                 ):
+    # type: (...) -> mmap.mmap
+    """
+    Maps the first `size` bytes of the segment sent by the other side in memory, and destroys the segment: its memory is
+    freed as soon as the returned map is garbage collected.
+
+    :param name: the name of the segment, as found in the message header
+    :param size:
+    :return:
+    """
+    fd = _posixshmem.shm_open('/' + name, os.O_RDWR, mode=0o600)
+    try:
+        _posixshmem.shm_unlink('/' + name)
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+
+def _destroy_segment(name  # type: str
+                     ):
+    """
+    Destroys a segment if it still exists, for example because the receiver will never read it (see
+    `Transport.discard`).
+
+    :param name: the name of the segment, as found in the message header
+    :return:
+    """
+    try:
+        _posixshmem.shm_unlink('/' + name)
+    except FileNotFoundError:
+        pass
+
+
+class EncodedMessage(object):
+    """
+    A message serialized with `Transport.encode`, to be written with `Transport.write`. It contains the frames to send,
+    and the shared memory segments created for the message, that are destroyed if it is not written (see `discard`).
+    """
+    __slots__ = 'frames', 'segments', 'nbytes', 'obj'
+
+    def __init__(self,
+                 frames,         # type: Optional[List[Any]]
+                 nbytes,         # type: int
+                 segments=(),    # type: List[shared_memory.SharedMemory]
+                 obj=None        # type: Any
+                 ):
+        """
+
+        :param frames: the frames to send with `conn.send_bytes`, or None to send `obj` with `conn.send`
+        :param nbytes: the size of the message in the pipe. Unknown (0) for the messages pickled by the connection
+        :param segments: the shared memory segments created for the message
+        :param obj: the message to send with `conn.send` if `frames` is None
+        """
+        self.frames = frames
+        self.nbytes = nbytes
+        self.segments = segments
+        self.obj = obj
+
+    def release(self,
+                sent  # type: bool
+                ):
+        """
+        Releases the shared memory segments of this message: if it was sent (its first frame at least), the receiver is
+        responsible for destroying them. Otherwise they are destroyed.
+
+        :param sent:
+        :return:
+        """
+        for shm in self.segments:
+            if sent:
+                shm.close()
+            else:
+                _unlink_segment(shm)
+        self.segments = ()
+
+    def discard(self):
+        """Destroys the shared memory segments of this message, that will not be sent"""
+        self.release(sent=False)
+
+
+class Transport(object):
+    """
+    Sends and receives the messages exchanged between a `DaemonProxy` and its daemon over a multiprocessing connection.
+    The same transport is used on both sides.
+
+    By default messages are pickled and sent with `conn.send`. Another `serializer` may be used instead, see
+    `spawny.utils_serializers`. With the default serializer, setting a threshold changes the way the buffers (`bytes`,
+    `bytearray`, numpy arrays and any object supporting pickle protocol 5 out-of-band buffers) larger than it are sent:
+
+     - if `oob_threshold` is set, the buffers of at least `oob_threshold` bytes are sent out-of-band, as separate frames
+       following the pickled message. This avoids copying them into the pickle stream: the receiver reads each frame
+       directly into the buffer given to the unpickler.
+     - if `shm_threshold` is set, the buffers of at least `shm_threshold` bytes are copied into
+       `multiprocessing.shared_memory` segments, and only the segment names go over the pipe. The receiver maps the
+       segments in memory and destroys them right away. The pickle protocol 5 buffers (numpy arrays...) are then used
+       in place, without copy, and their memory is freed when the objects are garbage collected; `bytes` and
+       `bytearray` are copied out of the segments. If the message can not be sent, the sender destroys them. The
+       segments of the messages that are sent but never received must be destroyed with `discard`. This takes
+       precedence over `oob_threshold`.
+
+    If `compression` is set, the serialized messages of at least `compression_threshold` bytes are compressed before
+    being sent, unless this does not reduce their size. Buffers sent out-of-band or through shared memory are not
+    compressed. Each side records the compressions and decompressions it performs in its `stats`
+    (a `CompressionStats`).
+    """
+    __slots__ = 'shm_threshold', 'oob_threshold', 'serializer', 'compressor', 'compression_threshold', 'stats'
+
+    def __init__(self,
+                 shm_threshold=None,  # type: int
+                 oob_threshold=None,  # type: int
+                 serializer=None,     # type: Union[str, Serializer]
+                 compression=None,    # type: Union[str, Compressor]
+                 compression_threshold=DEFAULT_COMPRESSION_THRESHOLD  # type: int
+                 ):
+        """
+
+        :param shm_threshold: the size in bytes from which buffers go through shared memory. None (default) disables
+            the shared memory transport.
+        :param oob_threshold: the size in bytes from which buffers are sent out-of-band. None (default) disables
+            out-of-band buffers.
+        :param serializer: the `Serializer` to use, or its name (see `SERIALIZERS`). By default pickle is used.
+        :param compression: the `Compressor` to use, or its name (see `COMPRESSORS`). None (default) disables
+            compression.
+        :param compression_threshold: the size in bytes from which serialized messages are compressed.
+        """
+        self.serializer = get_serializer(serializer)
+        if type(self.serializer) is not PickleSerializer and (shm_threshold is not None or oob_threshold is not None):
+            raise ValueError("`shm_threshold` and `oob_threshold` can only be used with the default pickle serializer")
+
+        if shm_threshold is not None:
+            if not SHM_AVAILABLE:
+                raise ValueError("The shared memory transport requires python 3.8+ and a posix system")
+            if shm_threshold < 1:
+                raise ValueError("shm_threshold should be strictly positive")
+        if oob_threshold is not None:
+            if not OOB_AVAILABLE:
+                raise ValueError("Out-of-band buffers require python 3.8+")
+            if oob_threshold < 1:
+                raise ValueError("oob_threshold should be strictly positive")
+        self.shm_threshold = shm_threshold
+        self.oob_threshold = oob_threshold
+
+        self.compressor = get_compressor(compression) if compression is not None else None
+        if compression_threshold < 0:
+            raise ValueError("compression_threshold should be positive")
+        self.compression_threshold = compression_threshold
+        self.stats = CompressionStats()
+
+    def __getstate__(self):
+        # the stats are not sent to the other side: each side has its own
+        return self.shm_threshold, self.oob_threshold, self.serializer, self.compressor, self.compression_threshold
+
+    def __setstate__(self, state):
+        self.shm_threshold, self.oob_threshold, self.serializer, self.compressor, self.compression_threshold = state
+        self.stats = CompressionStats()
+
+    def __repr__(self):
+        return 'Transport<serializer=%s, shm_threshold=%s, oob_threshold=%s, compression=%s>' \
+               % (self.serializer.name, self.shm_threshold, self.oob_threshold,
+                  self.compressor.name if self.compressor is not None else None)
+
+    def _encode_frame(self,
+                      data  # type: bytes
+                      ):
+        # type: (...) -> bytes
+        """Returns data as one frame, compressed if compression is enabled and data is large enough"""
+        if self.compressor is None:
+            return data
+        if len(data) >= self.compression_threshold:
+            compressed = self.stats.compress(self.compressor, data)
+            if compressed is not None:
+                return _COMPRESSED_TAG + compressed
+        return _RAW_TAG + data
+
+    def _recv_frame(self,
+                    conn
+                    ):
+        # type: (...) -> bytes
+        """Receives a frame encoded with `_encode_frame`"""
+        data = conn.recv_bytes()
+        if self.compressor is None:
+            return data
+        elif data[0:1] == _COMPRESSED_TAG:
+            return self.stats.decompress(self.compressor, memoryview(data)[1:])
+        else:
+            return memoryview(data)[1:]
+
+    def send(self,
+             conn,
+             msg  # type: Tuple[Any, ...]
+             ):
+        """
+        Sends `msg` over `conn`.
+
+        :param conn:
+        :param msg:
+        :return:
+        """
+        if self.shm_threshold is None and self.oob_threshold is None and self.compressor is None \
+                and type(self.serializer) is PickleSerializer:
+            conn.send(msg)
+        else:
+            self.write(conn, self.encode(msg))
+
+    def write(self,
+              conn,
+              encoded  # type: EncodedMessage
+              ):
+        """
+        Sends a message serialized with `encode` over `conn`.
+
+        :param conn:
+        :param encoded:
+        :return:
+        """
+        if encoded.frames is None:
+            conn.send(encoded.obj)
+            return
+        elif len(encoded.segments) == 0:
+            for frame in encoded.frames:
+                conn.send_bytes(frame)
+            return
+
+        sent = False
+        try:
+            for frame in encoded.frames:
+                conn.send_bytes(frame)
+                # from now on the receiver is responsible for the segments
+                sent = True
+        finally:
+            encoded.release(sent)
+
+    def encode(self,
+               msg  # type: Tuple[Any, ...]
+               ):
+        # type: (...) -> EncodedMessage
+        """
+        Serializes `msg`, so that it can be sent later with `write`. This is used to know the size of a message before
+        sending it. If it is finally not sent, `EncodedMessage.discard` should be called.
+
+        :param msg:
+        :return:
+        """
+        if self.shm_threshold is None and self.oob_threshold is None:
+            if self.compressor is None and type(self.serializer) is PickleSerializer:
+                if _pickle_dumps is None:
+                    return EncodedMessage(None, 0, obj=msg)
+                # this is what `conn.send` does
+                frame = _pickle_dumps(msg)
+            else:
+                frame = self._encode_frame(self.serializer.dumps(msg))
+            return EncodedMessage([frame], len(frame))
+
+        threshold = min(t for t in (self.shm_threshold, self.oob_threshold) if t is not None)
+
+        # the (shared memory segment or None, buffer, size, kind) for all buffers sent out-of-band, in pickling order.
+        # Buffers without segment are sent as frames.
+        oob = []
+
+        def save_buffer(data, kind):
+            if self.shm_threshold is not None and data.nbytes >= self.shm_threshold:
+                shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+                oob.append((shm, None, data.nbytes, kind))
+                shm.buf[:data.nbytes] = data
+                # the receiver is responsible for destroying the segment
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            else:
+                oob.append((None, data, data.nbytes, kind))
+            return len(oob) - 1
+
+        def buffer_callback(pb):
+            try:
+                raw = pb.raw()
+            except BufferError:
+                # non-contiguous buffer
+                return True
+            if raw.nbytes < threshold:
+                # small buffer: pickle it in-band
+                return True
+            save_buffer(raw, _PICKLE_BUFFER)
+            return False
+
+        try:
+            buf = io.BytesIO()
+            _OobPickler(buf, buffer_callback, threshold, save_buffer).dump(msg)
+            header = [(shm.name if shm is not None else None, size, kind) for shm, _, size, kind in oob]
+            frames = [self._encode_frame(ForkingPickler.dumps((header, buf.getvalue())))]
+        except BaseException:
+            for shm, _, _, _ in oob:
+                if shm is not None:
+                    _unlink_segment(shm)
+            raise
+        frames.extend(data for shm, data, _, _ in oob if shm is None)
+        return EncodedMessage(frames, sum(memoryview(f).nbytes for f in frames),
+                              segments=[shm for shm, _, _, _ in oob if shm is not None])
+
+    def recv(self,
+             conn
+             ):
+        # type: (...) -> Tuple[Any, ...]
+        """
+        Receives a message sent with `send` on the other side of `conn`.
+
+        :param conn:
+        :return:
+        """
+        if self.shm_threshold is None and self.oob_threshold is None:
+            if self.compressor is None and type(self.serializer) is PickleSerializer:
+                return conn.recv()
+            else:
+                return self.serializer.loads(self._recv_frame(conn))
+
+        header, data = ForkingPickler.loads(self._recv_frame(conn))
+        contents = []
+        buffers = []
+        error = None
+        # read all frames and destroy all segments, even if one of them fails
+        for name, size, kind in header:
+            try:
+                if name is None:
+                    if kind == _BYTES:
+                        contents.append(conn.recv_bytes())
+                    else:
+                        contents.append(bytearray(size))
+                        _recv_bytes_into(conn, contents[-1])
+                else:
+                    segment = _map_segment(name, size)
+                    if kind == _PICKLE_BUFFER:
+                        # the object keeps a reference to its buffer, and therefore to the map
+                        contents.append(memoryview(segment))
+                    else:
+                        try:
+                            contents.append(segment[:] if kind == _BYTES else bytearray(segment))
+                        finally:
+                            segment.close()
+            except Exception as e:
+                if error is None:
+                    error = e
+                contents.append(None)
+            if kind == _PICKLE_BUFFER:
+                buffers.append(contents[-1])
+
+        if error is not None:
+            raise error
+        return _OobUnpickler(io.BytesIO(data), buffers, contents.__getitem__).load()
+
+    def discard(self,
+                conn
+                ):
+        """
+        Receives the next message sent with `send` on the other side of `conn` without deserializing it, and destroys
+        the shared memory segments that it references. This should be used to consume the messages remaining in the pipe
+        when the other side is gone, otherwise their segments would never be destroyed.
+
+        :param conn:
+        :return:
+        """
+        if self.shm_threshold is None and self.oob_threshold is None:
+            conn.recv_bytes()
+            return
+
+        header, _ = ForkingPickler.loads(self._recv_frame(conn))
+        for name, _, _ in header:
+            if name is None:
+                conn.recv_bytes()
+            else:
+                _destroy_segment(name)
+
+    def destroy_segments(self,
+                         names  # type: Iterable[str]
+                         ):
+        """
+        Destroys the shared memory segments of messages sent to the other side, if it did not read them. This should be
+        used once the other side is gone, since the segments of sent messages are then owned by the receiver.
+
+        :param names: the names of the segments (see `EncodedMessage.segments`)
+        :return:
+        """
+        for name in names:
+            _destroy_segment(name)